@@ -20,6 +20,7 @@ setup(
                 'src/codrestd',
                 'src/codlcd',
                 'src/codlircd',
+                'src/codsinkd',
                 ],
 
     package_dir = { '': 'src' },
@@ -49,6 +50,7 @@ setup(
     ext_modules = [
         Extension('codplayer.c_alsa_sink',
                   ['src/codplayer/c_alsa_sink.c'],
+                  depends = ['src/codplayer/c_swap_bytes.h'],
                   libraries = ['asound'])],
 
 
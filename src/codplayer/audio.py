@@ -4,6 +4,99 @@
 #
 # Distributed under an MIT license, please see LICENSE in the top dir.
 
+import sys
+import array
+import bisect
+import collections
+
+
+class DiscFrameMap(object):
+    """Precomputed track and index boundaries of a disc, in the
+    play order of the tracks.  Positions on the disc are counted in
+    frames from the start of the first track pregap, with the tracks
+    following each other without gaps.
+
+    The boundaries are kept in flat arrays, so looking up a position
+    is a bisect rather than a walk over the tracks and their indices.
+
+    Attributes, all arrays indexed by track number (counting from 0):
+
+    track_starts: disc position of the start of each track pregap
+
+    pregap_offsets: length of each pregap
+
+    track_lengths: length of each track including the pregap
+
+    length_secs: length of each track from index 1, in whole seconds
+
+    disc_length: total length of the disc
+    """
+
+    def __init__(self, disc):
+        rate = disc.audio_format.rate
+
+        self.track_starts = array.array('l')
+        self.pregap_offsets = array.array('l')
+        self.track_lengths = array.array('l')
+        self.length_secs = array.array('l')
+
+        # Start position of each index on the disc, with the
+        # corresponding track and index numbers
+        self.index_starts = array.array('l')
+        self.index_tracks = array.array('l')
+        self.index_numbers = array.array('l')
+
+        pos = 0
+        for track_number, track in enumerate(disc.tracks):
+            self.track_starts.append(pos)
+            self.pregap_offsets.append(track.pregap_offset)
+            self.track_lengths.append(track.length)
+            self.length_secs.append(int((track.length - track.pregap_offset) / rate))
+
+            index_starts = [0, track.pregap_offset]
+            index_starts.extend(track.index)
+
+            for index, start in enumerate(index_starts):
+                self.index_starts.append(pos + start)
+                self.index_tracks.append(track_number)
+                self.index_numbers.append(index)
+
+            pos += track.length
+
+        self.disc_length = pos
+
+
+    def get_index(self, track_number, abs_pos):
+        """Return the index at ABS_POS from the start of the pregap
+        of TRACK_NUMBER.
+        """
+        i = bisect.bisect_right(self.index_starts,
+                                self.track_starts[track_number] + abs_pos) - 1
+        return self.index_numbers[i]
+
+
+    def get_disc_pos(self, track_number, rel_pos):
+        """Return the disc position of REL_POS from index 1 of TRACK_NUMBER.
+        """
+        return (self.track_starts[track_number]
+                + self.pregap_offsets[track_number] + rel_pos)
+
+
+    def get_track_pos(self, disc_pos):
+        """Return a tuple (track_number, rel_pos) for DISC_POS, or
+        None if it is beyond the end of the disc.  Positions before
+        the start of the disc are moved to the start.
+        """
+        if disc_pos >= self.disc_length:
+            return None
+
+        disc_pos = max(disc_pos, 0)
+        track_number = bisect.bisect_right(self.track_starts, disc_pos) - 1
+
+        # bisect_right passes over any zero-length tracks
+        return (track_number,
+                disc_pos - self.get_disc_pos(track_number, 0))
+
 
 class AudioPacket(object):
     """A packet of audio data coming from a single track and index.
@@ -36,11 +129,28 @@ class AudioPacket(object):
 
     flags: currently only one possible:
       - PAUSE_AFTER
+
+    context: set by the Transport to the context the packet belongs to
+
+    The packets are slotted, as quite a few of them are alive at any
+    time.  They can be reused by a PacketPool.
     """
 
+    __slots__ = ('disc', 'track', 'track_number', 'format', 'index',
+                 'abs_pos', 'rel_pos', 'length', 'flags', 'file_pos',
+                 'data', 'context')
+
     PAUSE_AFTER = 0x01
 
-    def __init__(self, disc, track, track_number, abs_pos, length, flags = 0):
+    def __init__(self, disc, track, track_number, abs_pos, length, flags = 0,
+                 frame_map = None):
+        self.reset(disc, track, track_number, abs_pos, length, flags, frame_map)
+
+
+    def reset(self, disc, track, track_number, abs_pos, length, flags = 0,
+              frame_map = None):
+        """(Re)initialise the packet, see the class doc for the arguments.
+        """
         self.disc = disc
         self.track = track
         self.track_number = track_number
@@ -49,15 +159,12 @@ class AudioPacket(object):
         
         assert abs_pos + length <= track.length
 
-        if abs_pos < track.pregap_offset:
+        if frame_map is not None:
+            self.index = frame_map.get_index(track_number, abs_pos)
+        elif abs_pos < track.pregap_offset:
             self.index = 0
         else:
-            self.index = 1
-
-            for index_pos in track.index:
-                if abs_pos < index_pos:
-                    break
-                self.index += 1
+            self.index = 1 + bisect.bisect_right(track.index, abs_pos)
 
         self.abs_pos = abs_pos
         self.rel_pos = abs_pos - track.pregap_offset
@@ -72,6 +179,7 @@ class AudioPacket(object):
             self.file_pos = track.file_offset + abs_pos - track.pregap_silence
 
         self.data = None
+        self.context = None
 
 
     def __repr__(self):
@@ -79,9 +187,15 @@ class AudioPacket(object):
 
 
     @classmethod
-    def iterate(cls, disc, track_number, packets_per_second):
+    def iterate(cls, disc, track_number, packets_per_second, position = 0,
+                frame_map = None, pool = None):
         """Iterate over DISC, splitting it into packets starting at
-        TRACK_NUMBER index 1.
+        TRACK_NUMBER index 1, or POSITION frames from that (which can
+        be negative to start in the pregap).
+
+        FRAME_MAP is the DiscFrameMap for DISC, which is created if
+        not provided.  If a PacketPool is provided in POOL, the packets
+        are taken from it.
 
         The maximum size of the packets returned is controlled by
         PACKETS_PER_SECOND.
@@ -95,20 +209,28 @@ class AudioPacket(object):
 
         assert track_number >= 0 and track_number < len(disc.tracks)
 
+        if frame_map is None:
+            frame_map = DiscFrameMap(disc)
+
         track = disc.tracks[track_number]
 
+        assert -track.pregap_offset <= position < track.length - track.pregap_offset
+
         packet_frame_size = (
             disc.audio_format.rate / packets_per_second)
 
-        # Mock up a packet that ends at the start of index 1, so the
-        # first packet generated starts at that position
-        p = cls(disc, track, track_number, track.pregap_offset, 0)
+        # Mock up a packet that ends at the start position, so the
+        # first packet generated starts there
+        p = cls(disc, track, track_number, track.pregap_offset + position, 0,
+                frame_map = frame_map)
 
         while True:
             # Calculate offsets of next packet
             abs_pos = p.abs_pos + p.length
 
-            if abs_pos < track.pregap_offset:
+            if abs_pos < track.pregap_silence:
+                length = min(track.pregap_silence - abs_pos, packet_frame_size)
+            elif abs_pos < track.pregap_offset:
                 length = min(track.pregap_offset - abs_pos, packet_frame_size)
             else:
                 length = min(track.length - abs_pos, packet_frame_size)
@@ -128,7 +250,7 @@ class AudioPacket(object):
                     # That was the last track, no more packets
                     return
 
-                p = cls(disc, track, track_number, 0, 0)                
+                p = cls(disc, track, track_number, 0, 0, frame_map = frame_map)
 
             else:
                 # Generate next packet
@@ -138,7 +260,77 @@ class AudioPacket(object):
                     and track_number + 1 < len(disc.tracks)):
                     flags |= p.PAUSE_AFTER
 
-                p = cls(disc, track, track_number, abs_pos, length, flags)
+                if pool is not None:
+                    p = pool.get(disc, track, track_number, abs_pos, length, flags, frame_map)
+                else:
+                    p = cls(disc, track, track_number, abs_pos, length, flags, frame_map)
                 yield p
 
     
+
+
+class PacketPool(object):
+    """Recycle AudioPackets to avoid allocating new ones all the time.
+
+    Packets are handed back with release() when the transport is done
+    with them, but the sink may still hold on to them until they have
+    been played.  To be safe, a released packet is only reused when
+    its reference count shows that nothing but the pool refers to it.
+    Packets are released in playing order, so only the oldest one
+    needs to be checked.
+
+    get() must only be called by one thread, but release() can be
+    called from another one, relying on the deque operations being
+    atomic.  A release() into a full pool drops the oldest packet, so
+    get() takes the packet out of the pool before checking it.
+    """
+
+    # References to a free packet in get(): the local variable and the
+    # argument to sys.getrefcount()
+    FREE_REFCOUNT = 2
+
+    def __init__(self, max_size):
+        self.released = collections.deque(maxlen = max_size)
+        self.allocated = 0
+        self.reused = 0
+
+
+    def get(self, disc, track, track_number, abs_pos, length, flags = 0,
+            frame_map = None):
+        """Return a packet initialised with the arguments, which are
+        the same as for AudioPacket().
+        """
+
+        try:
+            p = self.released.popleft()
+        except IndexError:
+            p = None
+
+        if p is not None:
+            if sys.getrefcount(p) <= self.FREE_REFCOUNT:
+                p.reset(disc, track, track_number, abs_pos, length, flags, frame_map)
+                self.reused += 1
+                return p
+
+            # Still in use, so put it back as the oldest packet
+            self.released.appendleft(p)
+            del p
+
+        self.allocated += 1
+        return AudioPacket(disc, track, track_number, abs_pos, length, flags, frame_map)
+
+
+    def release(self, packet):
+        """Hand back a packet that may be reused when no longer in use.
+        """
+        self.released.append(packet)
+
+
+    def stats(self):
+        """Return a dict of pool statistics."""
+        return {
+            'allocated': self.allocated,
+            'reused': self.reused,
+            'released': len(self.released),
+            'packet_bytes': sys.getsizeof(AudioPacket.__new__(AudioPacket)),
+            }
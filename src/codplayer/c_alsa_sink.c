@@ -27,14 +27,49 @@
 #include <stdio.h>
 #include <pthread.h>
 #include <sched.h>
+#include <time.h>
+#include <sys/time.h>
+#include <errno.h>
 
+#include "c_swap_bytes.h"
 
-/* Will run on approx 10Hz for PCM */
+
+/* Defaults for the buffer geometry.  Will run on approx 10Hz for PCM */
 #define PERIOD_FRAMES 4096
 #define PERIOD_MSECS 100
 
 #define BUFFER_SECONDS 5
-#define MAX_PERIODS_PER_SECOND 40
+
+/* The packets array is sized to hold the periods of a buffer at up
+ * to this rate, with the configured period size.
+ */
+#define MAX_RATE 192000
+
+/* Upper limits in milliseconds of the write latency histogram
+ * buckets, same as sink.WRITE_LATENCY_LIMITS_MS.  There's an
+ * additional last bucket for slower writes.
+ */
+static const int write_latency_limits_ms[] = {
+    1, 2, 5, 10, 20, 50, 100, 200, 500 };
+#define WRITE_LATENCY_BUCKETS \
+    ((int) (sizeof(write_latency_limits_ms) / sizeof(write_latency_limits_ms[0])) + 1)
+
+/* Counters kept by the player thread, see stats() */
+typedef struct {
+    unsigned long periods_written;
+    unsigned long xruns;
+    unsigned long recovers;
+    unsigned long write_errors;
+    double write_seconds;
+    double write_max_seconds;
+    unsigned long write_latency[WRITE_LATENCY_BUCKETS];
+
+    /* Bytes in the buffer before each write, since start() */
+    int fill_min;
+    int fill_max;
+    double fill_sum;
+    unsigned long fill_samples;
+} thread_stats_t;
 
 /* States in which add_packet() should try to put stuff into the
  * buffer has this bit set.
@@ -92,8 +127,11 @@ typedef struct {
     
     /* Buffer between playing thread and Python env */
 
-    /* The rest of this structure is protected by
-       a mutex, and data exchanged with cond signalling.
+    /* The rest of this structure is protected by a mutex, and state
+       changes signalled with the cond, except for the ring buffer
+       positions described below.  state is only changed when holding
+       the mutex, but the player thread also reads it without the
+       mutex (with GET_STATE()) while writing data to the device.
     */
     pthread_mutex_t mutex;
     pthread_cond_t cond;
@@ -109,9 +147,29 @@ typedef struct {
     int rate;
     int big_endian;
 
+    /* Buffer geometry requested in the constructor */
+    int config_period_frames;
+    int buffer_seconds;
+    int use_mmap;
+
     /* Actual hardware settings, set by thread_set_format() */
     int period_frames;
     int swap_bytes;
+    int mmap_access;
+
+    /* Format of the open device, which may differ from the format
+     * above if the device is kept open while the sink is closed.
+     */
+    int open_channels;
+    int open_rate;
+    int open_big_endian;
+
+    /* If > 0, keep the device open this many seconds after the sink
+     * is closed, so it can be reused if started again with the same
+     * format.  The deadline is set when the sink is closed.
+     */
+    int keep_open_seconds;
+    struct timespec keep_open_deadline;
 
     const char *device_error;  /* Current error, or NULL */
 
@@ -123,19 +181,61 @@ typedef struct {
     const char *log_param;
 
     /* All buffer parameters are in bytes, not frames or periods.
-     * play_pos and data_end are < buffer_size.
+     *
+     * The buffer is a single-producer, single-consumer ring: the
+     * Transport sink thread adds data at write_pos and the player
+     * thread plays it from read_pos.  The positions run from 0 to
+     * 2 * buffer_size, so a full buffer can be told from an empty one.
+     *
+     * write_pos is only changed by the Transport thread, and read_pos
+     * only by the player thread, except when both are reset when the
+     * sink is closed.  They are accessed with RING_LOAD()/RING_STORE()
+     * so the player thread can write to the device without taking the
+     * mutex.  The Transport thread only publishes new data while
+     * holding the mutex, but copies the data into the buffer without
+     * it.
+     *
+     * A thread that waits for the other one to move its position
+     * sets its *_waiting flag first, so the other one knows it must
+     * signal the cond.
+     *
+     * This only takes the mutex out of the data path, not out of
+     * the synchronisation.  The Transport thread still takes it for
+     * each write, to publish write_pos and check consumer_waiting.
+     * When producer_waiting is set, the player thread still does a
+     * blocking lock to signal the cond.  The Transport thread only
+     * holds the mutex for a few instructions then, so the player
+     * thread waits very briefly, but it can block.  A fully lock-free
+     * wakeup, e.g. with an eventfd, is left undone on purpose.
      */
     int period_size;
     int buffer_size;
-    int play_pos;
-    int data_end;
-    int data_size;
+    int read_pos;
+    int write_pos;
+    int producer_waiting;
+    int consumer_waiting;
+
+    /* Frames written to the device since the sink was started, and
+     * the device delay (frames not yet heard) measured after the
+     * last write.  The player thread only updates these when it can
+     * get the mutex without waiting for it.
+     */
+    long long written_frames;
+    snd_pcm_sframes_t device_delay;
+
+    /* Copy of thread_stats, updated along with written_frames */
+    thread_stats_t stats;
+
+    /* Time spent swapping bytes by the Transport thread */
+    double swap_seconds;
+    unsigned long long swapped_bytes;
 
     /* Frames buffered waiting to be played. */
     unsigned char *buffer;
 
     /* Packet objects mapping to each period in the buffer */ 
     PyObject **packets;
+    int max_periods;
 
     /* End of thread buffer structure */
 
@@ -143,11 +243,19 @@ typedef struct {
     /* Thread private data */
 
     snd_pcm_t *handle;         /* NULL if closed */
+    long long thread_written_frames;
+    thread_stats_t thread_stats;
 
     /* Transport sink thread private data */
     PyObject *prev_playing_packet;
     const char *prev_device_error;
 
+    /* Python string for the last device error returned, reused
+     * until the error changes.
+     */
+    PyObject *device_error_obj;
+    const char *device_error_str;
+
     /* Performanace logging */
     FILE *thread_perf_log;
 
@@ -159,24 +267,48 @@ typedef struct {
 #define NOTIFY(self) pthread_cond_broadcast(&(self)->cond)
 #define WAIT(self) pthread_cond_wait(&(self)->cond, &(self)->mutex)
 
+#define GET_STATE(self) __atomic_load_n(&(self)->state, __ATOMIC_ACQUIRE)
+#define SET_STATE(self, s) __atomic_store_n(&(self)->state, (s), __ATOMIC_RELEASE)
+
+/* Sequentially consistent, since the *_waiting flags rely on that */
+#define RING_LOAD(var) __atomic_load_n(&(var), __ATOMIC_SEQ_CST)
+#define RING_STORE(var, value) __atomic_store_n(&(var), (value), __ATOMIC_SEQ_CST)
+
+/* Bytes of data in the ring buffer */
+#define RING_USED(self) \
+    ((RING_LOAD((self)->write_pos) - RING_LOAD((self)->read_pos) \
+      + 2 * (self)->buffer_size) % (2 * (self)->buffer_size))
+
 
 static PyObject* alsa_sink_start(alsa_thread_t *self, PyObject *args);
 static PyObject* alsa_sink_stop(alsa_thread_t *self, PyObject *args);
 static PyObject* alsa_sink_add_packet(alsa_thread_t *self, PyObject *args);
+static PyObject* alsa_sink_add_silence(alsa_thread_t *self, PyObject *args);
+static PyObject* alsa_sink_add_packets(alsa_thread_t *self, PyObject *args);
+static PyObject* alsa_sink_played_frames(alsa_thread_t *self, PyObject *args);
+static PyObject* alsa_sink_stats(alsa_thread_t *self, PyObject *args);
 static PyObject* alsa_sink_drain(alsa_thread_t *self, PyObject *args);
 static PyObject* alsa_sink_pause(alsa_thread_t *self, PyObject *args);
 static PyObject* alsa_sink_resume(alsa_thread_t *self, PyObject *args);
 static PyObject* alsa_sink_log_helper(alsa_thread_t *self, PyObject *args);
 
-static void copy_and_swap(unsigned char *dest, int pos,
-                          const unsigned char *src, int length);
 static int thread_open_device(alsa_thread_t *self);
 static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle);
 static void* thread_main(void *arg);
 static void thread_loop(alsa_thread_t *self);
 static void thread_play_once(alsa_thread_t *self);
+static void thread_write_periods(alsa_thread_t *self);
+static snd_pcm_sframes_t thread_mmap_write(alsa_thread_t *self,
+                                           const unsigned char *data,
+                                           snd_pcm_uframes_t frames);
+static double elapsed_seconds(const struct timeval *start,
+                              const struct timeval *end);
+static void thread_record_fill(alsa_thread_t *self, int used);
+static void thread_record_write(alsa_thread_t *self, double seconds);
 static void thread_pause(alsa_thread_t *self);
 static void thread_resume(alsa_thread_t *self);
+static void thread_close_device(alsa_thread_t *self);
+static void thread_standby(alsa_thread_t *self);
 
 
 /* Translate a card id to a ALSA cardname 
@@ -344,14 +476,27 @@ alsa_thread_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
     char *cardname = NULL;
     int start_without_device = 0;
     int log_performance = 0;
+    int keep_open_seconds = 0;
+    int period_frames = PERIOD_FRAMES;
+    int buffer_seconds = BUFFER_SECONDS;
+    int use_mmap = 0;
     snd_pcm_t *handle = NULL;
     pthread_attr_t thread_attr;
     struct sched_param sched;
     
-    if (!PyArg_ParseTuple(args, "Osii:CAlsaSink",
-                          &parent, &cardname, &start_without_device, &log_performance))
+    if (!PyArg_ParseTuple(args, "Osii|iiii:CAlsaSink",
+                          &parent, &cardname, &start_without_device, &log_performance,
+                          &keep_open_seconds, &period_frames, &buffer_seconds,
+                          &use_mmap))
         return NULL;
     
+    if (period_frames <= 0 || buffer_seconds <= 0)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "period frames and buffer seconds must be positive");
+        return NULL;
+    }
+
 
     if (!(self = (alsa_thread_t *)PyObject_New(alsa_thread_t, &CAlsaSinkType)))
         return NULL;
@@ -382,14 +527,27 @@ alsa_thread_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
     pthread_mutex_init(&(self->mutex), NULL);
     pthread_cond_init(&(self->cond), NULL);
 
-    self->state = SINK_CLOSED;
+    SET_STATE(self, SINK_CLOSED);
     self->handle = 0;
 
     self->channels = 0;
     self->rate = 0;
     self->big_endian = 0;
+    self->config_period_frames = period_frames;
+    self->buffer_seconds = buffer_seconds;
+    self->use_mmap = use_mmap;
+
     self->period_frames = 0;
     self->swap_bytes = 0;
+    self->mmap_access = 0;
+
+    self->open_channels = 0;
+    self->open_rate = 0;
+    self->open_big_endian = 0;
+
+    self->keep_open_seconds = keep_open_seconds;
+    self->keep_open_deadline.tv_sec = 0;
+    self->keep_open_deadline.tv_nsec = 0;
 
     self->device_error = NULL;
     self->log_message = NULL;
@@ -397,20 +555,32 @@ alsa_thread_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
 
     /* Buffer is set up when we know the format */
     self->buffer_size = 0;
-    self->play_pos = 0;
-    self->data_end = 0;
-    self->data_size = 0;
+    self->read_pos = 0;
+    self->write_pos = 0;
+    self->producer_waiting = 0;
+    self->consumer_waiting = 0;
     self->buffer = NULL;
+    self->written_frames = 0;
+    self->device_delay = 0;
+    self->thread_written_frames = 0;
+    memset(&self->thread_stats, 0, sizeof(self->thread_stats));
+    memset(&self->stats, 0, sizeof(self->stats));
+    self->swap_seconds = 0;
+    self->swapped_bytes = 0;
 
     /* But we grab this right away with some assumptions about
      * what period size we might end up with */
-    self->packets = calloc(sizeof(PyObject*), BUFFER_SECONDS * MAX_PERIODS_PER_SECOND);
+    self->max_periods = buffer_seconds * (MAX_RATE / period_frames + 1);
+    self->packets = calloc(sizeof(PyObject*), self->max_periods);
     if (self->packets == NULL)
         return PyErr_NoMemory();
 
     self->prev_playing_packet = NULL;
     self->prev_device_error = NULL;
 
+    self->device_error_obj = NULL;
+    self->device_error_str = NULL;
+
     /* Try to open card straight away to verify access rights etc */
 
     alsa_debug2(self, "opening card", self->cardname);
@@ -503,7 +673,7 @@ static void alsa_thread_dealloc(alsa_thread_t *self)
     {/* LOCK SCOPE */
         BEGIN_LOCK(self);
 
-        self->state = SINK_SHUTDOWN;
+        SET_STATE(self, SINK_SHUTDOWN);
         NOTIFY(self);
 
         END_LOCK(self);
@@ -545,10 +715,22 @@ alsa_sink_start(alsa_thread_t *self, PyObject *args)
         if (self->state == SINK_CLOSED)
         {
             alsa_debug1(self, "starting sink");
-            self->state = SINK_STARTING;
+            SET_STATE(self, SINK_STARTING);
             self->channels = channels;
             self->rate = rate;
             self->big_endian = big_endian;
+            self->written_frames = 0;
+            self->device_delay = 0;
+            self->thread_written_frames = 0;
+
+            /* Buffer fill is measured per play, the other counters
+             * are kept for the life of the sink.
+             */
+            self->thread_stats.fill_min = 0;
+            self->thread_stats.fill_max = 0;
+            self->thread_stats.fill_sum = 0;
+            self->thread_stats.fill_samples = 0;
+            self->stats = self->thread_stats;
 
             NOTIFY(self);
         }
@@ -584,7 +766,7 @@ alsa_sink_stop(alsa_thread_t *self, PyObject *args)
 
         if (self->state != SINK_CLOSED && self->state != SINK_SHUTDOWN)
         {
-            self->state = SINK_CLOSING;
+            SET_STATE(self, SINK_CLOSING);
             NOTIFY(self);
         }
 
@@ -601,10 +783,32 @@ alsa_sink_stop(alsa_thread_t *self, PyObject *args)
 }
     
 
+/* Wait for the player thread to play data (or the state to change),
+ * if the buffer still holds USED bytes.
+ */
+static void
+producer_wait(alsa_thread_t *self, int used)
+{
+    /* LOCK SCOPE: self->mutex is already locked when this function is
+     * called.
+     */
+
+    RING_STORE(self->producer_waiting, 1);
+
+    if (RING_USED(self) == used)
+    {
+        WAIT(self);
+    }
+
+    RING_STORE(self->producer_waiting, 0);
+}
+
+
 static int
 playing_once(
     alsa_thread_t *self,
     PyObject *packet, const unsigned char *data, Py_ssize_t data_size,
+    int silence,
 
     // Return variables
     PyObject **playing_packet, const char **device_error)
@@ -641,51 +845,101 @@ playing_once(
          */
         if ((self->state & BUFFER_STATE) != 0)
         {
-            if (data != NULL)
+            if (data != NULL || silence)
             {
-                if (self->data_size >= self->buffer_size)
+                if (RING_USED(self) >= self->buffer_size)
                 {
                     /* Wait for more room in buffer */
-                    WAIT(self);
+                    producer_wait(self, self->buffer_size);
                 }
 
-                if ((self->state & BUFFER_STATE) != 0 && self->data_size < self->buffer_size)
+                if ((self->state & BUFFER_STATE) != 0
+                    && RING_USED(self) < self->buffer_size)
                 {
                     /* Can fit more data */
 
-                    int buffer_free = self->buffer_size - self->data_size;
+                    int write_pos = self->write_pos;
+                    int data_end = write_pos % self->buffer_size;
+                    int buffer_free = self->buffer_size - RING_USED(self);
+                    double swap_seconds = 0;
                     
                     stored = data_size;
                     if (stored > buffer_free)
                         stored = buffer_free;
 
                     /* But don't wrap the end of the buffer */
-                    if (self->data_end + stored > self->buffer_size)
-                        stored = self->buffer_size - self->data_end;
+                    if (data_end + stored > self->buffer_size)
+                        stored = self->buffer_size - data_end;
+
+                    first_data_period = data_end / self->period_size;
+                    last_data_period = (data_end + stored) / self->period_size;
+
+                    { /* UNLOCKED CONTEXT */
+
+                        /* Copy without holding the lock, so the
+                         * player thread never waits for it.  The
+                         * buffer and the byte order are only changed
+                         * by thread_set_format() when the sink is
+                         * starting, and only this thread can start()
+                         * the sink.  So they stay in place even if
+                         * the sink is stopped or the device is
+                         * reopened meanwhile.
+                         */
+                        END_LOCK(self);
+
+                        if (silence)
+                        {
+                            /* Zeroes look the same in any byte order */
+                            memset(self->buffer + data_end, 0, stored);
+                        }
+                        else if (self->swap_bytes)
+                        {
+                            struct timeval start, end;
+
+                            gettimeofday(&start, NULL);
+                            swap_bytes_copy(self->buffer, data_end, data, stored);
+                            gettimeofday(&end, NULL);
+
+                            swap_seconds = elapsed_seconds(&start, &end);
+                        }
+                        else
+                        {
+                            memcpy(self->buffer + data_end, data, stored);
+                        }
+
+                        BEGIN_LOCK(self);
+                    }
 
-                    first_data_period = self->data_end / self->period_size;
-                    last_data_period = (self->data_end + stored) / self->period_size;
-                    
-                    if (self->swap_bytes)
+                    if (swap_seconds > 0)
+                    {
+                        self->swap_seconds += swap_seconds;
+                        self->swapped_bytes += stored;
+                    }
+
+                    if ((self->state & BUFFER_STATE) != 0)
                     {
-                        copy_and_swap(self->buffer, self->data_end, data, stored);
+                        /* Tell playing thread about the new data */
+                        RING_STORE(self->write_pos,
+                                   (write_pos + stored) % (2 * self->buffer_size));
+
+                        if (self->consumer_waiting)
+                        {
+                            NOTIFY(self);
+                        }
                     }
                     else
                     {
-                        memcpy(self->buffer + self->data_end, data, stored);
+                        /* Stopped while copying, so the buffer has
+                         * been reset and the data is discarded.
+                         */
+                        first_data_period = -1;
                     }
-
-                    self->data_end = (self->data_end + stored) % self->buffer_size;
-                    self->data_size += stored;
-
-                    /* Tell playing thread about the new data */
-                    NOTIFY(self);
                 }
             }
             else
             {
                 /* Draining, so wait for updates to playing_packet etc */
-                WAIT(self);
+                producer_wait(self, RING_USED(self));
             }
         }
 
@@ -698,14 +952,14 @@ playing_once(
         /* Bring the return parameters out of the lock and into Python land
          */
 
-        if (self->data_size > 0)
+        if (RING_USED(self) > 0)
         {
-            /* By checking data_size we ensure that we have a valid pointer in self->packets.
+            /* By checking the used size we ensure that we have a valid pointer in self->packets.
              * There are patological cases where this means we can't report progress, but if we don't
              * have data in the buffer when we get to this point we have bigger problems than
              * not updating the player status.
              */
-            play_period = self->play_pos / self->period_size;
+            play_period = (RING_LOAD(self->read_pos) % self->buffer_size) / self->period_size;
         }
 
         *device_error = self->device_error;
@@ -756,38 +1010,43 @@ playing_once(
 }    
     
 
-static void
-copy_and_swap(unsigned char *dest, int pos,
-              const unsigned char *src, int length)
+/* Return a new reference to a Python string for ERROR, or None.  The
+ * device errors are static strings, so the object from the last call
+ * can be reused as long as the pointer is the same.
+ */
+static PyObject *
+get_device_error_obj(alsa_thread_t *self, const char *error)
 {
-    int i;
-    for (i = pos; i < pos + length; i++, src++)
+    if (error == NULL)
     {
-        /* Use XOR to flip odd to even and vice versa.  This means we
-         * might in patological cases write a byte ahead of what we
-         * strictly speaking are allowed to, but since we know that
-         * the play thread always consumes whole periods and not odd
-         * bytes this is safe.
-         */
-        dest[i ^ 1] = *src;
+        Py_RETURN_NONE;
     }
+
+    if (self->device_error_obj == NULL || self->device_error_str != error)
+    {
+        PyObject *obj = PyString_FromString(error);
+        if (obj == NULL)
+            return NULL;
+
+        Py_XDECREF(self->device_error_obj);
+        self->device_error_obj = obj;
+        self->device_error_str = error;
+    }
+
+    Py_INCREF(self->device_error_obj);
+    return self->device_error_obj;
 }
 
 
 static PyObject *
-alsa_sink_add_packet(alsa_thread_t *self, PyObject *args)
+add_data(alsa_thread_t *self,
+         PyObject *packet, const unsigned char *data, Py_ssize_t data_size,
+         int silence)
 {
-    const unsigned char *data = NULL;
-    Py_ssize_t data_size = 0;
-    PyObject *packet = NULL;
     int stored = 0;
     PyObject *playing_packet = self->prev_playing_packet;
     const char *device_error = self->prev_device_error;
-
-    if (!PyArg_ParseTuple(args, "s#O:CAlsaSink.add_packet",
-                          &data, &data_size, &packet))
-        return NULL;
-
+    PyObject *error_obj;
 
     /* We'll keep running here until something happens that may
      * require the Transport state to be updated.  Return on:
@@ -802,7 +1061,7 @@ alsa_sink_add_packet(alsa_thread_t *self, PyObject *args)
            && (self->prev_playing_packet == playing_packet)
            && (self->prev_device_error == device_error))
     {
-        stored = playing_once(self, packet, data, data_size,
+        stored = playing_once(self, packet, data, data_size, silence,
                               &playing_packet, &device_error);
     }
 
@@ -811,7 +1070,7 @@ alsa_sink_add_packet(alsa_thread_t *self, PyObject *args)
 
     if (stored < 0)
     {
-        alsa_debug1(self, "add_packet: sink closed");
+        alsa_debug1(self, silence ? "add_silence: sink closed" : "add_packet: sink closed");
 
         /* Used by playing_once when no longer in a BUFFER_STATE,
          * translate into add_packet() API.
@@ -819,9 +1078,214 @@ alsa_sink_add_packet(alsa_thread_t *self, PyObject *args)
         stored = 0;
     }
 
-    // TODO: remember device_error to avoid spawning new strings all the time
+    error_obj = get_device_error_obj(self, device_error);
+    if (error_obj == NULL)
+        return NULL;
+
+    return Py_BuildValue("iON", stored, playing_packet, error_obj);
+}
+
+
+/* add_packet(data, packet[, offset]): add data, starting at offset,
+ * to the buffer.  data can be any object supporting the buffer
+ * interface, and is only held for the duration of the call.
+ */
+static PyObject *
+alsa_sink_add_packet(alsa_thread_t *self, PyObject *args)
+{
+    Py_buffer view;
+    Py_ssize_t offset = 0;
+    PyObject *packet = NULL;
+    PyObject *res;
+
+    if (!PyArg_ParseTuple(args, "s*O|n:CAlsaSink.add_packet",
+                          &view, &packet, &offset))
+        return NULL;
+
+    if (offset < 0 || offset > view.len)
+    {
+        PyBuffer_Release(&view);
+        return PyErr_Format(CAlsaSinkError, "add_packet: offset out of range");
+    }
+
+    /* The view keeps the data alive while the lock is released */
+    res = add_data(self, packet, (const unsigned char *) view.buf + offset,
+                   view.len - offset, 0);
+
+    PyBuffer_Release(&view);
+    return res;
+}
+
+
+/* Get a read-only view of the data in OBJ, falling back on the old
+ * buffer interface for objects that don't support the new one
+ * (e.g. buffer objects).  The view must be released with
+ * PyBuffer_Release().
+ */
+static int
+get_data_view(PyObject *obj, Py_buffer *view)
+{
+    const void *buf;
+    Py_ssize_t len;
+
+    if (PyObject_CheckBuffer(obj))
+    {
+        return PyObject_GetBuffer(obj, view, PyBUF_SIMPLE);
+    }
+
+    if (PyObject_AsReadBuffer(obj, &buf, &len) < 0)
+        return -1;
+
+    return PyBuffer_FillInfo(view, obj, (void *) buf, len, 1, PyBUF_SIMPLE);
+}
+
+
+/* Same as add_packet(), but instead of copying data from a Python
+ * object just zero out the corresponding part of the buffer.
+ */
+static PyObject *
+alsa_sink_add_silence(alsa_thread_t *self, PyObject *args)
+{
+    Py_ssize_t data_size = 0;
+    PyObject *packet = NULL;
+
+    if (!PyArg_ParseTuple(args, "nO:CAlsaSink.add_silence",
+                          &data_size, &packet))
+        return NULL;
+
+    if (data_size < 0)
+    {
+        return PyErr_Format(CAlsaSinkError, "add_silence: negative size");
+    }
+
+    return add_data(self, packet, NULL, data_size, 1);
+}
+
+
+/* Batch version of add_packet()/add_silence(), taking a sequence of
+ * packet objects and the offset into the data of the first one.  The
+ * data is read from packet.data, and packets where file_pos is None
+ * are written as silence.
+ *
+ * Keeps adding data until all packets are stored or something happens
+ * that may require the Transport state to be updated, i.e. the same
+ * conditions as add_packet() except that storing data is not enough.
+ *
+ * Returns (packets_done, offset, playing_packet, device_error), where
+ * packets_done is the number of packets that have been completely
+ * stored, and offset is how far into the next one data has been
+ * stored.
+ */
+static PyObject *
+alsa_sink_add_packets(alsa_thread_t *self, PyObject *args)
+{
+    PyObject *packets_arg = NULL;
+    PyObject *packets = NULL;
+    Py_ssize_t offset = 0;
+    Py_ssize_t num_packets;
+    Py_ssize_t done = 0;
+    PyObject *playing_packet = Py_None;
+    const char *device_error = self->prev_device_error;
+    PyObject *error_obj;
+
+    if (!PyArg_ParseTuple(args, "On:CAlsaSink.add_packets",
+                          &packets_arg, &offset))
+        return NULL;
+
+    if (offset < 0)
+    {
+        return PyErr_Format(CAlsaSinkError, "add_packets: negative offset");
+    }
+
+    packets = PySequence_Fast(packets_arg, "add_packets: expected a sequence of packets");
+    if (packets == NULL)
+        return NULL;
+
+    num_packets = PySequence_Fast_GET_SIZE(packets);
+
+    while (done < num_packets)
+    {
+        PyObject *packet = PySequence_Fast_GET_ITEM(packets, done);
+        PyObject *data_obj = NULL;
+        PyObject *file_pos = NULL;
+        Py_buffer view;
+        Py_ssize_t data_size = 0;
+        int silence;
+        int stored;
+
+        data_obj = PyObject_GetAttrString(packet, "data");
+        if (data_obj == NULL)
+            goto error;
+
+        if (get_data_view(data_obj, &view) < 0)
+        {
+            Py_DECREF(data_obj);
+            goto error;
+        }
+        Py_DECREF(data_obj);
 
-    return Py_BuildValue("iOs", stored, playing_packet, device_error);
+        data_size = view.len;
+
+        file_pos = PyObject_GetAttrString(packet, "file_pos");
+        if (file_pos == NULL)
+        {
+            PyBuffer_Release(&view);
+            goto error;
+        }
+
+        silence = (file_pos == Py_None);
+        Py_DECREF(file_pos);
+
+        if (offset >= data_size)
+        {
+            PyBuffer_Release(&view);
+            done++;
+            offset = 0;
+            continue;
+        }
+
+        /* The view keeps the data alive while the lock is released */
+        stored = playing_once(self, packet,
+                              silence ? NULL : (const unsigned char *) view.buf + offset,
+                              data_size - offset, silence,
+                              &playing_packet, &device_error);
+
+        PyBuffer_Release(&view);
+
+        if (stored < 0)
+        {
+            alsa_debug1(self, "add_packets: sink closed");
+            break;
+        }
+
+        offset += stored;
+        if (offset >= data_size)
+        {
+            done++;
+            offset = 0;
+        }
+
+        if (self->prev_playing_packet != playing_packet
+            || self->prev_device_error != device_error)
+        {
+            break;
+        }
+    }
+
+    Py_DECREF(packets);
+
+    self->prev_playing_packet = playing_packet;
+    self->prev_device_error = device_error;
+
+    error_obj = get_device_error_obj(self, device_error);
+    if (error_obj == NULL)
+        return NULL;
+
+    return Py_BuildValue("nnON", done, offset, playing_packet, error_obj);
+
+  error:
+    Py_DECREF(packets);
+    return NULL;
 }
 
 
@@ -831,6 +1295,7 @@ alsa_sink_drain(alsa_thread_t *self, PyObject *args)
     int stored = 0;
     PyObject *playing_packet = self->prev_playing_packet;
     const char *device_error = self->prev_device_error;
+    PyObject *error_obj;
 
     if (!PyArg_ParseTuple(args, ":CAlsaSink.drain"))
         return NULL;
@@ -844,20 +1309,21 @@ alsa_sink_drain(alsa_thread_t *self, PyObject *args)
 
             alsa_debug1(self, "drain: switching to state draining");
 
-            self->state = SINK_DRAINING;
+            SET_STATE(self, SINK_DRAINING);
 
             /* Zero out the end of the last period, if that one is
              * only partially filled. We know this will fit, since the
              * play thread always reads in whole periods.
              */
-            partial = self->data_end % self->period_size;
+            partial = self->write_pos % self->period_size;
 
             if (partial > 0)
             {
-                memset(self->buffer + self->data_end, 0,
+                memset(self->buffer + (self->write_pos % self->buffer_size), 0,
                        self->period_size - partial);
-                self->data_end = (self->data_end + self->period_size - partial) % self->buffer_size;
-                self->data_size += self->period_size - partial;
+                RING_STORE(self->write_pos,
+                           (self->write_pos + self->period_size - partial)
+                           % (2 * self->buffer_size));
             }
 
             NOTIFY(self);
@@ -883,7 +1349,7 @@ alsa_sink_drain(alsa_thread_t *self, PyObject *args)
            && (self->prev_playing_packet == playing_packet)
            && (self->prev_device_error == device_error))
     {
-        stored = playing_once(self, NULL, NULL, 0,
+        stored = playing_once(self, NULL, NULL, 0, 0,
                               &playing_packet, &device_error);
     }
 
@@ -898,11 +1364,136 @@ alsa_sink_drain(alsa_thread_t *self, PyObject *args)
         Py_RETURN_NONE;
     }
 
-    // TODO: should remember prev_playing_packet/prev_device_error in self across calls
+    error_obj = get_device_error_obj(self, device_error);
+    if (error_obj == NULL)
+        return NULL;
+
+    return Py_BuildValue("ON", playing_packet, error_obj);
+}
 
-    // TODO: remember device_error to avoid spawning new strings all the time
 
-    return Py_BuildValue("Os", playing_packet, device_error);
+static PyObject *
+alsa_sink_played_frames(alsa_thread_t *self, PyObject *args)
+{
+    long long played;
+
+    if (!PyArg_ParseTuple(args, ":CAlsaSink.played_frames"))
+        return NULL;
+
+    {/* LOCK SCOPE */
+        BEGIN_LOCK(self);
+        played = self->written_frames - self->device_delay;
+        END_LOCK(self);
+    }
+
+    if (played < 0)
+    {
+        played = 0;
+    }
+
+    return PyLong_FromLongLong(played);
+}
+
+
+/* Return a dict of performance counters, as described in
+ * sink.Sink.get_stats().
+ */
+static PyObject*
+alsa_sink_stats(alsa_thread_t *self, PyObject *args)
+{
+    thread_stats_t stats;
+    int buffer_size;
+    double swap_seconds;
+    unsigned long long swapped_bytes;
+    PyObject *latency;
+    PyObject *fill_min, *fill_max, *fill_avg;
+    PyObject *result;
+    int i;
+
+    if (!PyArg_ParseTuple(args, ":CAlsaSink.stats"))
+        return NULL;
+
+    {/* LOCK SCOPE */
+        BEGIN_LOCK(self);
+        stats = self->stats;
+        buffer_size = self->buffer_size;
+        swap_seconds = self->swap_seconds;
+        swapped_bytes = self->swapped_bytes;
+        END_LOCK(self);
+    }
+
+    latency = PyList_New(WRITE_LATENCY_BUCKETS);
+    if (latency == NULL)
+        return NULL;
+
+    for (i = 0; i < WRITE_LATENCY_BUCKETS; i++)
+    {
+        PyObject *bucket;
+
+        if (i < WRITE_LATENCY_BUCKETS - 1)
+        {
+            bucket = Py_BuildValue("(ik)", write_latency_limits_ms[i],
+                                   stats.write_latency[i]);
+        }
+        else
+        {
+            bucket = Py_BuildValue("(Ok)", Py_None, stats.write_latency[i]);
+        }
+
+        if (bucket == NULL)
+        {
+            Py_DECREF(latency);
+            return NULL;
+        }
+
+        PyList_SET_ITEM(latency, i, bucket);
+    }
+
+    /* Like SinkStats, the buffer fill is None until it has been
+     * recorded for a write.
+     */
+    if (stats.fill_samples > 0)
+    {
+        fill_min = Py_BuildValue("i", stats.fill_min);
+        fill_max = Py_BuildValue("i", stats.fill_max);
+        fill_avg = Py_BuildValue("d", stats.fill_sum / stats.fill_samples);
+    }
+    else
+    {
+        Py_INCREF(Py_None);
+        fill_min = Py_None;
+        Py_INCREF(Py_None);
+        fill_max = Py_None;
+        Py_INCREF(Py_None);
+        fill_avg = Py_None;
+    }
+
+    if (fill_min == NULL || fill_max == NULL || fill_avg == NULL)
+    {
+        Py_XDECREF(fill_min);
+        Py_XDECREF(fill_max);
+        Py_XDECREF(fill_avg);
+        Py_DECREF(latency);
+        return NULL;
+    }
+
+    result = Py_BuildValue(
+        "{s:k,s:k,s:k,s:k,s:d,s:d,s:N,s:i,s:N,s:N,s:N,s:d,s:K}",
+        "periods_written", stats.periods_written,
+        "xruns", stats.xruns,
+        "recovers", stats.recovers,
+        "write_errors", stats.write_errors,
+        "write_seconds", stats.write_seconds,
+        "write_max_seconds", stats.write_max_seconds,
+        "write_latency_ms", latency,
+        "buffer_size", buffer_size,
+        "buffer_fill_min", fill_min,
+        "buffer_fill_max", fill_max,
+        "buffer_fill_avg", fill_avg,
+        "swap_seconds", swap_seconds,
+        "swap_bytes", swapped_bytes);
+
+    return result;
 }
 
 
@@ -922,7 +1513,7 @@ alsa_sink_pause(alsa_thread_t *self, PyObject *args)
         if (self->state == SINK_PLAYING || self->state == SINK_DRAINING)
         {
             self->paused_in_state = self->state;
-            self->state = SINK_PAUSING;
+            SET_STATE(self, SINK_PAUSING);
             NOTIFY(self);
 
             while (self->state == SINK_PAUSING)
@@ -970,7 +1561,7 @@ alsa_sink_resume(alsa_thread_t *self, PyObject *args)
 
         if (self->state == SINK_PAUSED)
         {
-            self->state = SINK_RESUME;
+            SET_STATE(self, SINK_RESUME);
             NOTIFY(self);
 
             while (self->state == SINK_RESUME)
@@ -1096,8 +1687,27 @@ static void thread_loop(alsa_thread_t *self)
         switch (self->state)
         {
         case SINK_CLOSED:
-            /* Just wait for transport to start us */
-            WAIT(self);
+            if (self->handle)
+            {
+                /* Device kept open in standby: wait for transport to
+                 * start us, but close it when idle too long.
+                 */
+                if (pthread_cond_timedwait(&self->cond, &self->mutex,
+                                           &self->keep_open_deadline) == ETIMEDOUT
+                    && self->state == SINK_CLOSED && self->handle)
+                {
+                    self->log_message = "closing idle pcm device";
+                    self->log_param = NULL;
+                    NOTIFY(self);
+
+                    thread_close_device(self);
+                }
+            }
+            else
+            {
+                /* Just wait for transport to start us */
+                WAIT(self);
+            }
             break;
 
         case SINK_STARTING:
@@ -1118,7 +1728,7 @@ static void thread_loop(alsa_thread_t *self)
             break;
 
         case SINK_DRAINING:
-            if (self->data_size > 0)
+            if (RING_USED(self) > 0)
             {
                 thread_play_once(self);
                 break;
@@ -1127,7 +1737,12 @@ static void thread_loop(alsa_thread_t *self)
 
         case SINK_CLOSING:
         case SINK_SHUTDOWN:
-            if (self->handle)
+            if (self->handle && self->keep_open_seconds > 0
+                && self->state != SINK_SHUTDOWN)
+            {
+                thread_standby(self);
+            }
+            else if (self->handle)
             {
                 int res;
                 int drain = self->state == SINK_DRAINING;
@@ -1151,12 +1766,11 @@ static void thread_loop(alsa_thread_t *self)
                         res = snd_pcm_drop(self->handle);
                     }
 
-                    snd_pcm_close(self->handle);
-                    self->handle = 0;
-
                     BEGIN_LOCK(self);
                 }
 
+                thread_close_device(self);
+
                 if (res < 0)
                 {
                     self->log_message = drain ?
@@ -1178,16 +1792,15 @@ static void thread_loop(alsa_thread_t *self)
             else
             {
                 /* Reset state */
-                self->state = SINK_CLOSED;
+                SET_STATE(self, SINK_CLOSED);
                 self->channels = 0;
                 self->rate = 0;
                 self->big_endian = 0;
 
                 self->device_error = NULL;
 
-                self->play_pos = 0;
-                self->data_end = 0;
-                self->data_size = 0;
+                RING_STORE(self->read_pos, 0);
+                RING_STORE(self->write_pos, 0);
 
                 NOTIFY(self);
             }
@@ -1200,12 +1813,109 @@ static void thread_loop(alsa_thread_t *self)
 }
 
 
+/* Stop playing but keep the device open, ready to be reused by the
+ * next start() with the same format.
+ */
+static void thread_standby(alsa_thread_t *self)
+{
+    /* LOCK SCOPE: self->mutex is already locked when this function is
+     * called.
+     */
+
+    int res;
+    int drain = self->state == SINK_DRAINING;
+
+    self->log_message = "keeping pcm device open";
+    self->log_param = drain ? "draining" : "dropping";
+    NOTIFY(self);
+
+    { /* UNLOCKED CONTEXT */
+        END_LOCK(self);
+
+        if (drain)
+        {
+            res = snd_pcm_drain(self->handle);
+        }
+        else
+        {
+            res = snd_pcm_drop(self->handle);
+        }
+
+        /* Get ready for the next write */
+        if (res >= 0)
+        {
+            res = snd_pcm_prepare(self->handle);
+        }
+
+        BEGIN_LOCK(self);
+    }
+
+    if (res < 0)
+    {
+        self->log_message = "error stopping pcm device, closing it";
+        self->log_param = snd_strerror(res);
+        thread_close_device(self);
+        return;
+    }
+
+    clock_gettime(CLOCK_REALTIME, &self->keep_open_deadline);
+    self->keep_open_deadline.tv_sec += self->keep_open_seconds;
+}
+
+
+static void thread_close_device(alsa_thread_t *self)
+{
+    /* LOCK SCOPE: self->mutex is already locked when this function is
+     * called.
+     */
+
+    snd_pcm_t *handle = self->handle;
+    self->handle = NULL;
+    self->open_channels = 0;
+    self->open_rate = 0;
+    self->open_big_endian = 0;
+
+    { /* UNLOCKED CONTEXT */
+        END_LOCK(self);
+        snd_pcm_close(handle);
+        BEGIN_LOCK(self);
+    }
+}
+
+
 static void thread_play_once(alsa_thread_t *self)
 {
     /* LOCK SCOPE: self->mutex is already locked when this function is
      * called.
      */
 
+    if (self->handle != NULL && self->state == SINK_STARTING)
+    {
+        /* Device kept open from the last time, use it if the format
+         * is the same.
+         */
+        if (self->open_channels == self->channels
+            && self->open_rate == self->rate
+            && self->open_big_endian == self->big_endian)
+        {
+            SET_STATE(self, SINK_PLAYING);
+            self->device_error = NULL;
+            if (self->log_message == NULL)
+            {
+                self->log_message = "reusing open device";
+                self->log_param = (self->swap_bytes ?
+                                   "swapping bytes" : "not swapping bytes");
+            }
+            NOTIFY(self);
+        }
+        else
+        {
+            self->log_message = "format changed, reopening device";
+            self->log_param = NULL;
+            thread_close_device(self);
+        }
+    }
+
     if (self->handle == NULL)
     {
         /* Attempt to (re)open device */
@@ -1217,59 +1927,291 @@ static void thread_play_once(alsa_thread_t *self)
 
     /* Now we know we have a good pcm handle */
 
-    if (self->data_size < self->period_size)
+    if (RING_USED(self) < self->period_size)
     {
         /* Wait for data - we can block here as long as needed */
-        WAIT(self);
+        RING_STORE(self->consumer_waiting, 1);
+
+        if (RING_USED(self) < self->period_size)
+        {
+            WAIT(self);
+        }
+
+        RING_STORE(self->consumer_waiting, 0);
+        return;
     }
 
-    /* Just put one period into the device to ensure state changes are
-     * promptly handled.  We'll loop around without releasing the lock
-     * anyway if there's data.
+    thread_write_periods(self);
+}
+
+
+/* Write whole periods to the device for as long as there is data in
+ * the buffer and the state doesn't change.  The lock is only taken
+ * to wake up the Transport thread, so it can keep adding data while
+ * this thread is blocked in snd_pcm_writei().
+ */
+static void thread_write_periods(alsa_thread_t *self)
+{
+    /* LOCK SCOPE: self->mutex is already locked when this function is
+     * called.
      */
-    if (self->data_size >= self->period_size)
+
+    sink_state_t state = self->state;
+    int res = 0;
+
+    { /* UNLOCKED CONTEXT */
+        END_LOCK(self);
+
+        while (GET_STATE(self) == state && RING_USED(self) >= self->period_size)
+        {
+            int read_pos = RING_LOAD(self->read_pos);
+            snd_pcm_sframes_t delay = -1;
+            struct timeval start, end;
+
+            thread_record_fill(self, RING_USED(self));
+            gettimeofday(&start, NULL);
+
+            if (self->mmap_access)
+            {
+                res = thread_mmap_write(self,
+                                        self->buffer + (read_pos % self->buffer_size),
+                                        self->period_frames);
+            }
+            else
+            {
+                /* Suddenly the size argument is frames, not bytes... */
+                res = snd_pcm_writei(self->handle,
+                                     self->buffer + (read_pos % self->buffer_size),
+                                     self->period_frames);
+            }
+
+            gettimeofday(&end, NULL);
+            thread_record_write(self, elapsed_seconds(&start, &end));
+
+            if (self->thread_perf_log)
+            {
+                fprintf(self->thread_perf_log, "%ld.%06ld %ld.%06ld write\n",
+                        (long) start.tv_sec, (long) start.tv_usec,
+                        (long) end.tv_sec, (long) end.tv_usec);
+            }
+
+            switch (res)
+            {
+            case -EPIPE:
+                self->thread_stats.xruns++;
+                /* FALL-THROUGH */
+
+            case -EINTR:
+            case -ESTRPIPE:
+                self->thread_stats.recovers++;
+                res = snd_pcm_recover(self->handle, res, 1);
+                break;
+            }
+
+            if (res < 0)
+            {
+                self->thread_stats.write_errors++;
+                break;
+            }
+
+            if (res > 0)
+            {
+                /* Find out how much is still to be heard, for position reporting */
+                if (snd_pcm_delay(self->handle, &delay) < 0)
+                {
+                    delay = -1;
+                }
+
+                /* Hand the period back to the Transport thread */
+                RING_STORE(self->read_pos,
+                           (read_pos + self->period_size) % (2 * self->buffer_size));
+                self->thread_written_frames += res;
+                self->thread_stats.periods_written++;
+
+                /* The only blocking lock in this loop, held briefly
+                 * by the Transport thread.  See the ring buffer
+                 * description in alsa_thread_t.
+                 */
+                if (RING_LOAD(self->producer_waiting))
+                {
+                    BEGIN_LOCK(self);
+                    NOTIFY(self);
+                    END_LOCK(self);
+                }
+
+                /* The position is only for reporting, so skip updating
+                 * it rather than wait for the lock.
+                 */
+                if (pthread_mutex_trylock(&self->mutex) == 0)
+                {
+                    self->written_frames = self->thread_written_frames;
+                    self->stats = self->thread_stats;
+                    if (delay >= 0)
+                    {
+                        self->device_delay = delay;
+                    }
+                    END_LOCK(self);
+                }
+            }
+        }
+
+        BEGIN_LOCK(self);
+    }
+
+    self->written_frames = self->thread_written_frames;
+    self->stats = self->thread_stats;
+
+    if (res < 0)
     {
-        unsigned char *data;
+        snd_pcm_close(self->handle);
+        self->handle = NULL;
+        self->log_message = "error writing to device";
+        self->log_param = snd_strerror(res);
+        self->device_error = snd_strerror(res);
+        NOTIFY(self);
+    }
+}
+
+
+static double elapsed_seconds(const struct timeval *start,
+                              const struct timeval *end)
+{
+    return ((end->tv_sec - start->tv_sec)
+            + (end->tv_usec - start->tv_usec) / 1e6);
+}
+
+
+/* Record that the buffer held USED bytes before a write */
+static void thread_record_fill(alsa_thread_t *self, int used)
+{
+    thread_stats_t *stats = &self->thread_stats;
+
+    if (stats->fill_samples == 0 || used < stats->fill_min)
+    {
+        stats->fill_min = used;
+    }
+
+    if (used > stats->fill_max)
+    {
+        stats->fill_max = used;
+    }
+
+    stats->fill_sum += used;
+    stats->fill_samples++;
+}
+
+
+/* Record a write to the device that took SECONDS */
+static void thread_record_write(alsa_thread_t *self, double seconds)
+{
+    thread_stats_t *stats = &self->thread_stats;
+    int ms = (int) (seconds * 1000);
+    int i;
+
+    stats->write_seconds += seconds;
+    if (seconds > stats->write_max_seconds)
+    {
+        stats->write_max_seconds = seconds;
+    }
+
+    for (i = 0; i < WRITE_LATENCY_BUCKETS - 1; i++)
+    {
+        if (ms < write_latency_limits_ms[i])
+        {
+            break;
+        }
+    }
+
+    stats->write_latency[i]++;
+}
+
+
+/* Copy FRAMES frames of DATA straight into the device buffer, waiting
+ * for room as necessary.  Works like snd_pcm_writei(), returning the
+ * number of frames written or a negative error code.
+ *
+ * This makes the same single copy as snd_pcm_writei(), but for most
+ * devices it avoids the system call that writei makes for each write.
+ */
+static snd_pcm_sframes_t thread_mmap_write(alsa_thread_t *self,
+                                           const unsigned char *data,
+                                           snd_pcm_uframes_t frames)
+{
+    /* LOCK SCOPE: this is called without holding self->mutex */
+
+    int frame_size = self->channels * 2;
+    snd_pcm_uframes_t written = 0;
+
+    while (written < frames)
+    {
+        const snd_pcm_channel_area_t *areas;
+        snd_pcm_uframes_t offset, size;
+        snd_pcm_sframes_t avail, committed;
         int res;
 
-        data = self->buffer + self->play_pos;
+        avail = snd_pcm_avail_update(self->handle);
+        if (avail < 0)
+        {
+            return avail;
+        }
 
-        { /* UNLOCKED CONTEXT */
-            END_LOCK(self);
+        if ((snd_pcm_uframes_t) avail < frames - written)
+        {
+            /* The device must be running to ever get more room */
+            if (snd_pcm_state(self->handle) == SND_PCM_STATE_PREPARED)
+            {
+                res = snd_pcm_start(self->handle);
+                if (res < 0)
+                {
+                    return res;
+                }
+            }
 
-            /* Suddenly the size argument is frames, not bytes... */
-            res = snd_pcm_writei(self->handle, data, self->period_frames);
-            BEGIN_LOCK(self);
+            res = snd_pcm_wait(self->handle, 1000);
+            if (res < 0)
+            {
+                return res;
+            }
+            continue;
         }
 
-        switch (res)
+        size = frames - written;
+        res = snd_pcm_mmap_begin(self->handle, &areas, &offset, &size);
+        if (res < 0)
         {
-        case -EINTR:
-        case -EPIPE:
-        case -ESTRPIPE:
-            /* UNLOCKED CONTEXT */
-            END_LOCK(self);
-            res = snd_pcm_recover(self->handle, res, 1);
-            BEGIN_LOCK(self);
-            break;
+            return res;
         }
 
-        if (res > 0)
+        /* Interleaved, so all samples of a frame follow each other */
+        memcpy((unsigned char *) areas[0].addr
+               + (areas[0].first + offset * areas[0].step) / 8,
+               data + written * frame_size,
+               size * frame_size);
+
+        committed = snd_pcm_mmap_commit(self->handle, offset, size);
+        if (committed < 0)
         {
-            self->play_pos = (self->play_pos + self->period_size) % self->buffer_size;
-            self->data_size -= self->period_size;
-            NOTIFY(self);
+            return committed;
         }
-        else if (res < 0)
+        if ((snd_pcm_uframes_t) committed != size)
         {
-            snd_pcm_close(self->handle);
-            self->handle = NULL;
-            self->log_message = "error writing to device";
-            self->log_param = snd_strerror(res);
-            self->device_error = snd_strerror(res);
-            NOTIFY(self);
+            return -EPIPE;
+        }
+
+        written += size;
+    }
+
+    /* Unlike writei, committing doesn't start the device */
+    if (snd_pcm_state(self->handle) == SND_PCM_STATE_PREPARED)
+    {
+        int res = snd_pcm_start(self->handle);
+        if (res < 0)
+        {
+            return res;
         }
     }
+
+    return written;
 }
 
 
@@ -1311,7 +2253,7 @@ static void thread_pause(alsa_thread_t *self)
     /* Even if pausing fails, go into PAUSED since the music will stop
      * at this point anyway.
      */
-    self->state = SINK_PAUSED;
+    SET_STATE(self, SINK_PAUSED);
     NOTIFY(self);
 }
 
@@ -1355,7 +2297,7 @@ static void thread_resume(alsa_thread_t *self)
      * if resuming the device failed, since thread_play_once() will
      * try to fix it by reopening.
      */
-    self->state = self->paused_in_state;
+    SET_STATE(self, self->paused_in_state);
     NOTIFY(self);
 }
 
@@ -1381,6 +2323,9 @@ static int thread_open_device(alsa_thread_t *self)
         if (thread_set_format(self, handle))
         {
             self->handle = handle;
+            self->open_channels = self->channels;
+            self->open_rate = self->rate;
+            self->open_big_endian = self->big_endian;
             self->device_error = NULL;
 
             if (self->log_message == NULL)
@@ -1397,7 +2342,7 @@ static int thread_open_device(alsa_thread_t *self)
                 /* Now we know the transport thread can put frames
                  * into the buffer.
                  */
-                self->state = SINK_PLAYING;
+                SET_STATE(self, SINK_PLAYING);
             }
 
             NOTIFY(self);
@@ -1447,9 +2392,11 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
     snd_pcm_format_t sample_format, set_sample_format;
     unsigned int periods;
     snd_pcm_hw_params_t *hwparams;
+    int swap_bytes = 0;
+    int starting = self->state == SINK_STARTING;
         
         
-    self->swap_bytes = 0;
+    self->mmap_access = self->use_mmap;
     sample_format = self->big_endian ? SND_PCM_FORMAT_S16_BE : SND_PCM_FORMAT_S16_LE;
     periods = 4;
 
@@ -1466,14 +2413,27 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
             return 0;
         }
 
-        snd_pcm_hw_params_set_access(handle, hwparams, 
-                                     SND_PCM_ACCESS_RW_INTERLEAVED);
+        if (self->mmap_access
+            && snd_pcm_hw_params_set_access(handle, hwparams,
+                                            SND_PCM_ACCESS_MMAP_INTERLEAVED) < 0)
+        {
+            self->log_message = "device doesn't support mmap access";
+            self->log_param = "using writei";
+            self->mmap_access = 0;
+        }
+
+        if (!self->mmap_access)
+        {
+            snd_pcm_hw_params_set_access(handle, hwparams, 
+                                         SND_PCM_ACCESS_RW_INTERLEAVED);
+        }
+
         snd_pcm_hw_params_set_format(handle, hwparams, sample_format);
         snd_pcm_hw_params_set_channels(handle, hwparams, self->channels);
 
         dir = 0;
         snd_pcm_hw_params_set_rate(handle, hwparams, self->rate, dir);
-        snd_pcm_hw_params_set_period_size(handle, hwparams, PERIOD_FRAMES, dir);
+        snd_pcm_hw_params_set_period_size(handle, hwparams, self->config_period_frames, dir);
         snd_pcm_hw_params_set_periods(handle, hwparams, periods, 0);
     
         /* Write it to the device */
@@ -1524,11 +2484,11 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
         }
         else
         {
-            if (!self->swap_bytes)
+            if (!swap_bytes)
             {
                 /* Retry with the other endianness and swap bytes ourselves */
                 sample_format = self->big_endian ? SND_PCM_FORMAT_S16_LE : SND_PCM_FORMAT_S16_BE;
-                self->swap_bytes = 1;
+                swap_bytes = 1;
             }
             else
             {
@@ -1539,6 +2499,31 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
         }
     }
 
+    if (!starting)
+    {
+        /* Reopening the device while playing.  The transport thread
+         * may be copying into the buffer without holding the lock,
+         * so the buffer and the byte order of the data in it must
+         * stay as they are.  Writes don't have to match the device
+         * period size, so a different one is fine.
+         */
+        if (swap_bytes != self->swap_bytes)
+        {
+            set_device_error(self, "device changed byte order");
+            return 0;
+        }
+
+        if (self->period_frames != set_period_size)
+        {
+            self->log_message = "device changed period size, keeping buffer";
+            self->log_param = "";
+        }
+
+        return 1;
+    }
+
+    self->swap_bytes = swap_bytes;
+
     /* Just use the period size determined by card.  Now we know it,
      * we can allocate the buffer, or just use an existing one with
      * the right parameters.
@@ -1546,8 +2531,13 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
 
     if (self->period_frames != set_period_size)
     {
-        /* If rate is too high, the packets array is too small and we can't run */
-        if ((self->rate / set_period_size) >= MAX_PERIODS_PER_SECOND)
+        int buffer_frames = self->rate * self->buffer_seconds;
+        buffer_frames -= buffer_frames % set_period_size;
+
+        /* If there are too many periods, the packets array is too
+         * small and we can't run.
+         */
+        if (buffer_frames / set_period_size > self->max_periods)
         {
             set_device_error(self, "period set by device is too small");
             return 0;
@@ -1555,9 +2545,7 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
 
         self->period_frames = set_period_size;
             
-        int buffer_size = self->rate * BUFFER_SECONDS;
-        buffer_size -= buffer_size % self->period_frames;
-        buffer_size *= self->channels * 2;
+        int buffer_size = buffer_frames * self->channels * 2;
 
         if (self->buffer)
         {
@@ -1580,9 +2568,8 @@ static int thread_set_format(alsa_thread_t *self, snd_pcm_t *handle)
 
         self->buffer_size = buffer_size;
         self->period_size = self->period_frames * self->channels * 2;
-        self->play_pos = 0;
-        self->data_end = 0;
-        self->data_size = 0;
+        RING_STORE(self->read_pos, 0);
+        RING_STORE(self->write_pos, 0);
     }
     
     return 1;
@@ -1595,6 +2582,10 @@ static PyMethodDef alsa_thread_methods[] = {
     { "start", (PyCFunction) alsa_sink_start, METH_VARARGS },
     { "stop", (PyCFunction) alsa_sink_stop, METH_VARARGS },
     { "add_packet", (PyCFunction) alsa_sink_add_packet, METH_VARARGS },
+    { "add_silence", (PyCFunction) alsa_sink_add_silence, METH_VARARGS },
+    { "add_packets", (PyCFunction) alsa_sink_add_packets, METH_VARARGS },
+    { "played_frames", (PyCFunction) alsa_sink_played_frames, METH_VARARGS },
+    { "stats", (PyCFunction) alsa_sink_stats, METH_VARARGS },
     { "drain", (PyCFunction) alsa_sink_drain, METH_VARARGS },
     { "pause", (PyCFunction) alsa_sink_pause, METH_VARARGS },
     { "resume", (PyCFunction) alsa_sink_resume, METH_VARARGS },
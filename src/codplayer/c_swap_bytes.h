@@ -0,0 +1,159 @@
+/* c_swap_bytes - copy 16-bit samples while swapping their byte order
+ *
+ * Copyright 2014 Peter Liljenberg <peter.liljenberg@gmail.com>
+ *
+ * Distributed under an MIT license, please see LICENSE in the top dir.
+ *
+ * Used by c_alsa_sink when the device can't play the byte order of
+ * the audio files, and by tools/bench_swap_bytes.c to compare the
+ * different implementations.
+ *
+ * swap_bytes_copy() is the best implementation available for the
+ * target: SSE2 or NEON if the compiler enables them, otherwise eight
+ * bytes at a time in a plain 64-bit word.  Any odd bytes at the end
+ * are swapped one sample at a time.
+ */
+
+#ifndef C_SWAP_BYTES_H
+#define C_SWAP_BYTES_H
+
+#include <stdint.h>
+#include <string.h>
+
+#if defined(__SSE2__)
+#include <emmintrin.h>
+#define SWAP_BYTES_SSE2 1
+#endif
+
+#if defined(__ARM_NEON) || defined(__ARM_NEON__)
+#include <arm_neon.h>
+#define SWAP_BYTES_NEON 1
+#endif
+
+
+/* The original implementation, one byte at a time at absolute buffer
+ * positions.  Used for odd positions, and as the reference.
+ */
+static inline void
+swap_bytes_copy_bytewise(unsigned char *dest, int pos,
+                         const unsigned char *src, int length)
+{
+    int i;
+    for (i = pos; i < pos + length; i++, src++)
+    {
+        /* Use XOR to flip odd to even and vice versa.  This means we
+         * might in patological cases write a byte ahead of what we
+         * strictly speaking are allowed to, but since we know that
+         * the play thread always consumes whole periods and not odd
+         * bytes this is safe.
+         */
+        dest[i ^ 1] = *src;
+    }
+}
+
+
+/* One sample at a time.  Handles the tail of the vectorised versions.
+ * LENGTH must be even.
+ */
+static inline void
+swap_bytes_copy_samples(unsigned char *dest, const unsigned char *src,
+                        size_t length)
+{
+    size_t i;
+    for (i = 0; i < length; i += 2)
+    {
+        dest[i] = src[i + 1];
+        dest[i + 1] = src[i];
+    }
+}
+
+
+/* Four samples at a time in a 64-bit word.  The memcpy()s compile to
+ * plain (unaligned) loads and stores.  LENGTH must be even.
+ */
+static inline void
+swap_bytes_copy_words(unsigned char *dest, const unsigned char *src,
+                      size_t length)
+{
+    const uint64_t mask = 0x00ff00ff00ff00ffULL;
+    size_t i;
+
+    for (i = 0; i + 8 <= length; i += 8)
+    {
+        uint64_t w;
+        memcpy(&w, src + i, 8);
+        w = ((w & mask) << 8) | ((w >> 8) & mask);
+        memcpy(dest + i, &w, 8);
+    }
+
+    swap_bytes_copy_samples(dest + i, src + i, length - i);
+}
+
+
+#ifdef SWAP_BYTES_SSE2
+/* Eight samples at a time in an SSE2 register.  LENGTH must be even. */
+static inline void
+swap_bytes_copy_sse2(unsigned char *dest, const unsigned char *src,
+                     size_t length)
+{
+    size_t i;
+
+    for (i = 0; i + 16 <= length; i += 16)
+    {
+        __m128i v = _mm_loadu_si128((const __m128i *) (src + i));
+        v = _mm_or_si128(_mm_slli_epi16(v, 8), _mm_srli_epi16(v, 8));
+        _mm_storeu_si128((__m128i *) (dest + i), v);
+    }
+
+    swap_bytes_copy_words(dest + i, src + i, length - i);
+}
+#endif
+
+
+#ifdef SWAP_BYTES_NEON
+/* Eight samples at a time in a NEON register.  LENGTH must be even. */
+static inline void
+swap_bytes_copy_neon(unsigned char *dest, const unsigned char *src,
+                     size_t length)
+{
+    size_t i;
+
+    for (i = 0; i + 16 <= length; i += 16)
+    {
+        vst1q_u8(dest + i, vrev16q_u8(vld1q_u8(src + i)));
+    }
+
+    swap_bytes_copy_words(dest + i, src + i, length - i);
+}
+#endif
+
+
+/* Copy LENGTH bytes from SRC to DEST + POS, swapping the bytes of
+ * each sample as counted from the start of DEST.
+ */
+static inline void
+swap_bytes_copy(unsigned char *dest, int pos,
+                const unsigned char *src, int length)
+{
+    if ((pos & 1) == 0)
+    {
+        int even = length & ~1;
+
+#if defined(SWAP_BYTES_SSE2)
+        swap_bytes_copy_sse2(dest + pos, src, even);
+#elif defined(SWAP_BYTES_NEON)
+        swap_bytes_copy_neon(dest + pos, src, even);
+#else
+        swap_bytes_copy_words(dest + pos, src, even);
+#endif
+
+        pos += even;
+        src += even;
+        length -= even;
+    }
+
+    /* Any odd byte at the end or odd start position */
+    swap_bytes_copy_bytewise(dest, pos, src, length);
+}
+
+#endif /* C_SWAP_BYTES_H */
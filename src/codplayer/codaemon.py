@@ -11,6 +11,9 @@ import grp
 import threading
 import time
 import traceback
+import signal
+import fcntl
+import errno
 
 # http://www.python.org/dev/peps/pep-3143/
 from daemon import DaemonContext
@@ -37,6 +40,7 @@ class Daemon(object):
         self._daemon_config = cfg
         self._log_debug = debug
         self._io_loop = None
+        self._process_supervisor = None
         self._plugins = cfg.plugins or []
 
         self._preserve_files = []
@@ -186,6 +190,23 @@ class Daemon(object):
         return self._io_loop
 
 
+    def setup_process_supervisor(self):
+        """Create the ProcessSupervisor for this daemon.  Must be
+        called from the main thread, since it installs a SIGCHLD
+        handler.
+        """
+        if self._process_supervisor is None:
+            self._process_supervisor = ProcessSupervisor(self.io_loop)
+
+
+    @property
+    def process_supervisor(self):
+        """Access the ProcessSupervisor for this daemon, or None if
+        setup_process_supervisor() hasn't been called.
+        """
+        return self._process_supervisor
+
+
     def log(self, msg, *args, **kwargs):
         m = (time.strftime('%Y-%m-%d %H:%M:%S ') + threading.current_thread().name + ': '
              + msg.format(*args, **kwargs) + '\n')
@@ -225,6 +246,78 @@ class Plugin(object):
         pass
 
 
+class ProcessSupervisor(object):
+    """Call back in the IOLoop when child processes exit, instead of
+    polling them.
+
+    SIGCHLD is turned into an IOLoop event with signal.set_wakeup_fd(),
+    so this must be created in the main thread.  Only the processes
+    being watched are reaped, so this works alongside any other use of
+    the subprocess module.
+    """
+
+    def __init__(self, io_loop):
+        self._io_loop = io_loop
+
+        # pid -> (process, callback)
+        self._processes = {}
+
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        signal.set_wakeup_fd(self._wakeup_write)
+        signal.signal(signal.SIGCHLD, self._on_sigchld)
+
+        # Restart system calls in other threads rather than failing
+        # them with EINTR when a child exits
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+        io_loop.add_handler(self._wakeup_read, self._on_wakeup, io_loop.READ)
+
+
+    def watch(self, process, callback):
+        """Call CALLBACK(returncode) in the IOLoop when the
+        subprocess.Popen PROCESS has exited.
+        """
+        self._processes[process.pid] = (process, callback)
+
+        # It may already have exited
+        self._io_loop.add_callback(self._check_processes)
+
+
+    def close(self):
+        self._io_loop.remove_handler(self._wakeup_read)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+
+    def _on_sigchld(self, signum, frame):
+        # The wakeup fd does the work
+        pass
+
+
+    def _on_wakeup(self, fd, events):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+        self._check_processes()
+
+
+    def _check_processes(self):
+        for pid, (process, callback) in self._processes.items():
+            if process.poll() is not None:
+                del self._processes[pid]
+                callback(process.returncode)
+
+
 class DaemonIOLoop(zerohub.IOLoop):
     def handle_callback_exception(self, callback):
         self._cod_daemon.log('Unhandled exception:\n{}', traceback.format_exc())
@@ -85,18 +85,43 @@ class PlayerConfig(DaemonConfig):
         serialize.Attr('database', str),
         serialize.Attr('cdrom_device', str),
         serialize.Attr('cdrom_read_speed', int, optional = True),
+        serialize.Attr('rip_little_endian', bool, optional = True, default = False),
         serialize.Attr('cdparanoia_command', str),
         serialize.Attr('cdrdao_command', str),
         serialize.Attr('eject_command', str),
         serialize.Attr('audio_device_type', str),
         serialize.Attr('start_without_device', bool),
         serialize.Attr('log_performance', bool),
+        serialize.Attr('audio_file_mmap', bool, optional = True, default = False),
+        serialize.Attr('readahead_seconds', int, optional = True, default = 0),
+        serialize.Attr('head_cache_dir', str, optional = True),
+        serialize.Attr('head_cache_seconds', int, optional = True, default = 5),
+        serialize.Attr('head_cache_size_mb', int, optional = True, default = 200),
+        serialize.Attr('transport_buffer_seconds', int, optional = True, default = 20),
+        serialize.Attr('transport_buffer_min_seconds', int, optional = True, default = 5),
+        serialize.Attr('transport_buffer_adaptive', bool, optional = True, default = False),
+        serialize.Attr('transport_packets_per_second', int, optional = True, default = 5),
 
         # File device options
         serialize.Attr('file_play_speed', int),
 
         # Alsa device options
         serialize.Attr('alsa_card', str),
+        serialize.Attr('alsa_keep_open_seconds', int, optional = True, default = 0),
+        serialize.Attr('alsa_period_frames', int, optional = True, default = 4096),
+        serialize.Attr('alsa_buffer_seconds', int, optional = True, default = 5),
+        serialize.Attr('alsa_mmap', bool, optional = True, default = False),
+
+        # Network device options
+        serialize.Attr('net_sink_host', str, optional = True),
+        serialize.Attr('net_sink_port', int, optional = True, default = 7390),
+        serialize.Attr('net_sink_buffer_seconds', int, optional = True, default = 10),
+
+        # Fanout device options
+        serialize.Attr('fanout_devices', list_type = str, optional = True),
+        serialize.Attr('fanout_buffer_seconds', int, optional = True, default = 5),
+        serialize.Attr('fanout_max_lag_seconds', int, optional = True, default = 2),
+        serialize.Attr('fanout_lag_policy', str, optional = True, default = 'detach'),
 
         )
 
@@ -120,3 +145,27 @@ class LircConfig(DaemonConfig):
         serialize.Attr('codmq_conf_path', str),
         serialize.Attr('lircd_socket', str),
         )
+
+class SinkConfig(DaemonConfig):
+    DEFAULT_FILE = os.path.join(sys.prefix, 'local/etc/codsinkd.conf')
+
+    CONFIG_PARAMS = (
+        serialize.Attr('protocol', str),
+        serialize.Attr('listen_address', str, optional = True, default = ''),
+        serialize.Attr('port', int, optional = True, default = 7390),
+        serialize.Attr('jitter_buffer_seconds', (int, float), optional = True, default = 1),
+
+        serialize.Attr('audio_device_type', str),
+        serialize.Attr('start_without_device', bool),
+        serialize.Attr('log_performance', bool, optional = True, default = False),
+
+        # File device options
+        serialize.Attr('file_play_speed', int, optional = True, default = 1),
+
+        # Alsa device options
+        serialize.Attr('alsa_card', str, optional = True, default = 'default'),
+        serialize.Attr('alsa_keep_open_seconds', int, optional = True, default = 0),
+        serialize.Attr('alsa_period_frames', int, optional = True, default = 4096),
+        serialize.Attr('alsa_buffer_seconds', int, optional = True, default = 5),
+        serialize.Attr('alsa_mmap', bool, optional = True, default = False),
+        )
@@ -13,6 +13,8 @@ import string
 import base64
 import re
 import types
+import array
+import tempfile
 
 from . import model
 from . import serialize
@@ -68,7 +70,8 @@ class Database(object):
       Contains the Musicbrainz version of the disc ID.
       
     DISC_DIR/b8ffac79.cdr
-      Raw audio data (PCM samples) from the disc.
+      Raw audio data (PCM samples) from the disc, big-endian unless
+      the disc audio_format is model.PCM_LE.
 
     DISC_DIR/b8ffac79.toc
       TOC read by cdrdao from the disc.
@@ -388,6 +391,64 @@ class Database(object):
         self.save_disc_info(disc)
 
 
+    def convert_audio_format(self, db_id, audio_format):
+        """Convert the audio file of a ripped disc to AUDIO_FORMAT,
+        which must be model.PCM or model.PCM_LE, by swapping the bytes
+        of each sample.  The file is replaced by a converted copy, so
+        there must be room for both on disk.
+
+        This should not be done while the player is playing the disc.
+
+        Returns the updated DbDisc object.
+        """
+
+        disc = self.get_disc_by_db_id(db_id)
+        if disc is None:
+            raise DatabaseError(self.db_dir, 'attempting to convert an unknown disc: {0}'.format(db_id))
+
+        if not disc.rip:
+            raise DatabaseError(self.db_dir, 'disc audio not ripped yet: {0}'.format(db_id))
+
+        if disc.audio_format is audio_format:
+            return disc
+
+        if audio_format.bytes_per_sample != disc.audio_format.bytes_per_sample:
+            raise ValueError('cannot convert {0} to {1}'.format(
+                disc.audio_format.__name__, audio_format.__name__))
+
+        path = os.path.join(self.get_disc_dir(db_id), disc.data_file_name)
+
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(path),
+                                            prefix = '.convert')
+            try:
+                with os.fdopen(fd, 'wb') as dest, open(path, 'rb') as src:
+                    while True:
+                        # Keep chunks to whole samples
+                        data = src.read(1024 * 1024)
+                        if not data:
+                            break
+
+                        samples = array.array('h')
+                        samples.fromstring(data)
+                        samples.byteswap()
+                        samples.tofile(dest)
+
+                    os.fsync(dest.fileno())
+
+                os.rename(tmp_path, path)
+            except:
+                os.unlink(tmp_path)
+                raise
+
+        except (IOError, OSError, ValueError), e:
+            raise DatabaseError(self.db_dir, 'error converting audio file {0}: {1}'.format(path, e))
+
+        disc.audio_format = audio_format
+        self.save_disc_info(disc)
+        return disc
+
+
     def update_disc(self, ext_disc):
         """Update the database information about a disc, based on the
         information provided in EXT_DISC.
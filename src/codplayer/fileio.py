@@ -0,0 +1,186 @@
+# codplayer - low-level file helpers
+#
+# Copyright 2014 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Helpers for file operations that the Python standard library doesn't
+provide, accessed through libc with ctypes.  All of them degrade
+gracefully to something simpler when the system call isn't available.
+"""
+
+import os
+import errno
+import fcntl
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+except OSError:
+    _libc = None
+
+
+def _libc_func(name, restype, *argtypes):
+    try:
+        func = getattr(_libc, name)
+    except AttributeError:
+        return None
+
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+_inotify_init = _libc_func('inotify_init', ctypes.c_int)
+_inotify_add_watch = _libc_func('inotify_add_watch', ctypes.c_int,
+                                ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+
+# Use the 64-bit version where available to handle large files on
+# 32-bit systems
+_posix_fadvise = (
+    _libc_func('posix_fadvise64', ctypes.c_int,
+               ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int)
+    or _libc_func('posix_fadvise', ctypes.c_int,
+                  ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int))
+
+# From <fcntl.h>
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def fadvise(f, offset, length, advice):
+    """Give the kernel a hint about how the LENGTH bytes starting at
+    OFFSET in the file object or descriptor F will be used, typically
+    POSIX_FADV_WILLNEED or POSIX_FADV_DONTNEED.
+
+    Returns True if the hint was accepted, False if not available.
+    Raises OSError if the kernel refused it.
+    """
+
+    if _posix_fadvise is None:
+        return False
+
+    if not isinstance(f, (int, long)):
+        f = f.fileno()
+
+    res = _posix_fadvise(f, offset, length, advice)
+    if res != 0:
+        raise OSError(res, os.strerror(res))
+
+    return True
+
+
+class FileGrowthWaiter(object):
+    """Wait for a file to be created or written to by another process.
+
+    This watches the directory of the file with inotify, so it works
+    also for files that don't exist yet.  If inotify isn't available
+    it falls back on just sleeping for the timeout.
+
+    wait() can be interrupted by calling wake() from another thread,
+    while close() and wait() must be called from the same thread.
+    """
+
+    WATCH_EVENTS = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO
+
+    def __init__(self, path):
+        self.dir_path, self.file_name = os.path.split(os.path.abspath(path))
+        self.inotify_fd = None
+
+        if _inotify_init and _inotify_add_watch:
+            fd = _inotify_init()
+            if fd >= 0:
+                if _inotify_add_watch(fd, self.dir_path, self.WATCH_EVENTS) >= 0:
+                    self.inotify_fd = fd
+                else:
+                    os.close(fd)
+
+        self.wake_read_fd, self.wake_write_fd = os.pipe()
+        fcntl.fcntl(self.wake_write_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.wake_lock = threading.Lock()
+
+
+    def close(self):
+        with self.wake_lock:
+            for fd in (self.inotify_fd, self.wake_read_fd, self.wake_write_fd):
+                if fd is not None:
+                    os.close(fd)
+
+            self.inotify_fd = self.wake_read_fd = self.wake_write_fd = None
+
+
+    @property
+    def using_inotify(self):
+        return self.inotify_fd is not None
+
+
+    def wake(self):
+        """Cause the current or next call to wait() to return immediately.
+        """
+        with self.wake_lock:
+            if self.wake_write_fd is not None:
+                try:
+                    os.write(self.wake_write_fd, 'x')
+                except OSError, e:
+                    # A full pipe will wake wait() anyway
+                    if e.errno != errno.EAGAIN:
+                        raise
+
+
+    def wait(self, timeout):
+        """Wait up to TIMEOUT seconds for the file to change.
+
+        Returns True if there was a change to the file, and False on
+        timeouts, wake() calls or if inotify isn't available.  Either
+        way the caller should check the file again.
+        """
+
+        fds = [self.wake_read_fd]
+        if self.inotify_fd is not None:
+            fds.append(self.inotify_fd)
+
+        while True:
+            try:
+                readable, _, _ = select.select(fds, [], [], timeout)
+                break
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+        if self.wake_read_fd in readable:
+            os.read(self.wake_read_fd, 512)
+
+        if self.inotify_fd in readable:
+            return self._read_events()
+
+        return False
+
+
+    def _read_events(self):
+        data = os.read(self.inotify_fd, 4096)
+        changed = False
+
+        pos = 0
+        while pos + _INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, name_len = _INOTIFY_EVENT.unpack_from(data, pos)
+            pos += _INOTIFY_EVENT.size
+
+            name = data[pos : pos + name_len].rstrip('\0')
+            pos += name_len
+
+            if name == self.file_name:
+                changed = True
+
+        return changed
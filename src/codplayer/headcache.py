@@ -0,0 +1,177 @@
+# codplayer - cache of track starts on a fast medium
+#
+# Copyright 2014 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Keep the first seconds of played tracks in a directory on a medium
+that is always quick to access (e.g. an SD card or tmpfs), so playing
+can start immediately while a database disk that has spun down is
+waking up.
+"""
+
+import os
+import errno
+import collections
+import tempfile
+
+
+class HeadCacheError(Exception): pass
+
+
+class HeadCache(object):
+    """The cache is a directory with a subdirectory for each disc,
+    named by the database ID (with -le appended for discs with
+    little-endian audio files), containing one file per cached track:
+
+      CACHE_DIR/b8ffac79b6688994986a4661fa0ddca0aae67bc2/12345.cdr
+
+    The file name is the position in the disc audio file (in frames)
+    where the cached data starts, which makes it independent of any
+    editing of the track list.
+
+    The total size of the cache is kept below a limit by removing the
+    least recently used files.  The file modification time is used to
+    keep track of use, so this survives restarts.
+
+    This class is not thread-safe.
+    """
+
+    FILE_SUFFIX = '.cdr'
+
+    def __init__(self, cache_dir, max_bytes, log = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.log = log
+
+        # Path -> size, in LRU order
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+
+            files = []
+            for db_id in os.listdir(cache_dir):
+                disc_dir = os.path.join(cache_dir, db_id)
+                if not os.path.isdir(disc_dir):
+                    continue
+
+                for name in os.listdir(disc_dir):
+                    if name.endswith(self.FILE_SUFFIX):
+                        path = os.path.join(disc_dir, name)
+                        st = os.stat(path)
+                        files.append((st.st_mtime, path, st.st_size))
+
+        except OSError, e:
+            raise HeadCacheError('error reading head cache dir {0}: {1}'.format(cache_dir, e))
+
+        files.sort()
+        for mtime, path, size in files:
+            self.entries[path] = size
+            self.total_bytes += size
+
+        self.evict()
+
+
+    def get_path(self, db_id, file_pos):
+        return os.path.join(self.cache_dir, db_id,
+                            '{0}{1}'.format(file_pos, self.FILE_SUFFIX))
+
+
+    def __contains__(self, key):
+        return self.get_path(*key) in self.entries
+
+
+    def get(self, db_id, file_pos):
+        """Return the cached data starting at frame FILE_POS in the disc
+        DB_ID, or None if not cached.
+        """
+
+        path = self.get_path(db_id, file_pos)
+        if path not in self.entries:
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            # Mark as recently used
+            os.utime(path, None)
+            self.entries[path] = self.entries.pop(path)
+            return data
+
+        except (IOError, OSError), e:
+            self._log('error reading head cache file {0}: {1}', path, e)
+            self._remove(path)
+            return None
+
+
+    def store(self, db_id, file_pos, data):
+        """Cache DATA as starting at frame FILE_POS in the disc DB_ID,
+        evicting old entries if the cache grows too big.
+        """
+
+        if len(data) > self.max_bytes:
+            return
+
+        path = self.get_path(db_id, file_pos)
+        disc_dir = os.path.dirname(path)
+
+        try:
+            if not os.path.isdir(disc_dir):
+                os.mkdir(disc_dir)
+
+            # Write to a temporary file first, so a half-written file
+            # is never mistaken for a cached track
+            fd, tmp_path = tempfile.mkstemp(dir = disc_dir, prefix = '.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.rename(tmp_path, path)
+            except:
+                os.unlink(tmp_path)
+                raise
+
+        except (IOError, OSError), e:
+            self._log('error writing head cache file {0}: {1}', path, e)
+            return
+
+        if path in self.entries:
+            self.total_bytes -= self.entries.pop(path)
+
+        self.entries[path] = len(data)
+        self.total_bytes += len(data)
+        self.evict()
+
+
+    def evict(self):
+        """Remove the least recently used entries until the cache
+        size is below the limit.
+        """
+        while self.total_bytes > self.max_bytes and self.entries:
+            path = next(iter(self.entries))
+            self._remove(path)
+
+
+    def _remove(self, path):
+        self.total_bytes -= self.entries.pop(path, 0)
+
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                self._log('error removing head cache file {0}: {1}', path, e)
+
+        # Drop the disc dir when empty
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+    def _log(self, msg, *args):
+        if self.log:
+            self.log(msg, *args)
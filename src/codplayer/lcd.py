@@ -15,7 +15,6 @@ import codecs
 
 from . import zerohub
 from .state import State, RipState, StateClient
-from . import command
 from .codaemon import Daemon, DaemonError
 from . import full_version
 
@@ -154,7 +153,8 @@ class LCD(Daemon):
             io_loop = self.io_loop,
             on_state = self._on_state,
             on_rip_state = self._on_rip_state,
-            on_disc = self._on_disc
+            on_disc = self._on_disc,
+            rpc_channel = self._mq_cfg.player_rpc
         )
 
         # Blink LED on button presses
@@ -165,17 +165,6 @@ class LCD(Daemon):
                 'button.press.DISPLAYTOGGLE': self._on_display_toggle,
             })
 
-        # Kickstart things by requesting the current state from the player
-        rpc_client = command.AsyncCommandRPCClient(
-            zerohub.AsyncRPCClient(
-                channel = self._mq_cfg.player_rpc,
-                name = 'codlcd',
-                io_loop = self.io_loop))
-
-        rpc_client.call('source', on_response = self._on_disc)
-        rpc_client.call('state', on_response = self._on_state)
-        rpc_client.call('rip_state', on_response = self._on_rip_state)
-
         # Let the IO loop take care of the rest
         self.io_loop.start()
 
@@ -46,6 +46,13 @@ class PCM:
         return (((m * 60) + s) * 75 + f) * cls.audio_frames_per_cd_frame
 
 
+class PCM_LE(PCM):
+    """Same as PCM, but the samples are stored little-endian to avoid
+    swapping bytes when playing on devices that only take that.
+    """
+    big_endian = False
+
+
 
 class RAW_CD:
     file_suffix = '.cdr'
@@ -201,7 +208,7 @@ class DbDisc(Disc):
 
         serialize.Attr('data_file_name', serialize.str_unicode),
         serialize.Attr('data_file_format', enum = (RAW_CD, )),
-        serialize.Attr('audio_format', enum = (PCM, )),
+        serialize.Attr('audio_format', enum = (PCM, PCM_LE)),
         )
 
     MUTABLE_ATTRS = (
@@ -0,0 +1,1054 @@
+# codplayer - network audio sink and receiver
+#
+# Copyright 2014 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+Stream PCM audio over TCP or UDP to a codsinkd receiver, which plays
+it through its own sink behind a jitter buffer.
+
+Each message is a fixed header followed by a payload.  All messages
+carry the stream ID, which the sender changes on each start(), and
+the stream format, so the receiver can start playing from any
+message.  The receiver acknowledges what it has played, which the
+sender uses both for position reporting and to pace how far ahead
+of the receiver it sends audio.
+
+Control messages (pause, resume, drain, stop) are resent by the
+sender until an acknowledgement shows that they have taken effect,
+so they survive lost UDP datagrams.  Lost or late audio is replaced
+by silence by the receiver.
+"""
+
+import socket
+import select
+import struct
+import threading
+import time
+import random
+import collections
+
+from . import sink
+from .codaemon import Daemon
+
+PROTOCOLS = ('tcp', 'udp')
+
+DEFAULT_PORT = 7390
+
+MAGIC = 'CODS'
+VERSION = 1
+
+# Message types
+DATA = 1
+PAUSE = 2
+RESUME = 3
+DRAIN = 4
+STOP = 5
+ACK = 6
+
+# Flags in ACK messages
+ACK_PAUSED = 1
+ACK_DRAINED = 2
+ACK_STOPPED = 4
+
+# magic, version, type, stream_id,
+# channels, bytes_per_sample, big_endian, rate,
+# frame_pos, timestamp, flags, payload length
+HEADER = struct.Struct('!4sBBIBBBIQdBH')
+
+# Audio bytes per DATA message.  For UDP a message fits a datagram on
+# an ethernet without fragmenting.
+TCP_PAYLOAD_BYTES = 16384
+UDP_PAYLOAD_BYTES = 1408
+
+MAX_PAYLOAD_BYTES = 65535
+
+
+Message = collections.namedtuple(
+    'Message', ('type', 'stream_id', 'channels', 'bytes_per_sample', 'big_endian',
+                'rate', 'frame_pos', 'timestamp', 'flags', 'payload'))
+
+
+class ProtocolError(Exception): pass
+
+
+def encode_message(msg_type, stream_id, format, frame_pos,
+                   timestamp = 0, flags = 0, payload = ''):
+    """Return a message as a string.  FORMAT may be None for
+    messages that aren't about a stream format, i.e. ACKs.
+    """
+    if format is not None:
+        fmt = (format.channels, format.bytes_per_sample,
+               int(bool(format.big_endian)), format.rate)
+    else:
+        fmt = (0, 0, 0, 0)
+
+    payload = str(payload)[:MAX_PAYLOAD_BYTES]
+    return HEADER.pack(MAGIC, VERSION, msg_type, stream_id, *(
+            fmt + (frame_pos, timestamp, flags, len(payload)))) + payload
+
+
+class MessageParser(object):
+    """Split a byte stream, or a sequence of datagrams, into
+    Message objects.
+    """
+
+    def __init__(self):
+        self.data = ''
+
+    def feed(self, data):
+        """Add DATA and return a list of all complete messages
+        received so far.  Raises ProtocolError on invalid messages.
+        """
+        self.data += data
+        messages = []
+
+        while len(self.data) >= HEADER.size:
+            header = HEADER.unpack_from(self.data)
+            magic, version = header[:2]
+            if magic != MAGIC:
+                raise ProtocolError('bad message magic: {0!r}'.format(magic))
+            if version != VERSION:
+                raise ProtocolError('unsupported protocol version: {0}'.format(version))
+
+            end = HEADER.size + header[-1]
+            if len(self.data) < end:
+                break
+
+            fields = header[2:-1] + (self.data[HEADER.size:end], )
+            messages.append(Message(*fields))
+            self.data = self.data[end:]
+
+        return messages
+
+
+class StreamFormat(object):
+    """The audio format of a received stream, in the shape expected
+    by Sink.start().
+    """
+
+    def __init__(self, msg):
+        self.channels = msg.channels
+        self.bytes_per_sample = msg.bytes_per_sample
+        self.big_endian = bool(msg.big_endian)
+        self.rate = msg.rate
+
+    def __str__(self):
+        return '{0} Hz, {1} channels, {2} bytes/sample, {3}'.format(
+            self.rate, self.channels, self.bytes_per_sample,
+            'big-endian' if self.big_endian else 'little-endian')
+
+
+#
+# Sender
+#
+
+class NetworkSink(sink.Sink):
+    """Sink streaming the audio to a codsinkd receiver.
+
+    The playing position is the last one acknowledged by the
+    receiver, which includes the receiver's own device delay.
+    """
+
+    # Seconds to wait before reconnecting after an error
+    RECONNECT_DELAY = 3
+
+    CONNECT_TIMEOUT = 5
+
+    # Seconds to wait for acknowledgements before returning to the
+    # Transport when the receiver has no room or is draining
+    ACK_WAIT = 0.5
+
+    # Seconds between resends of unacknowledged control messages
+    CONTROL_RESEND = 0.5
+
+    def __init__(self, player, protocol, address = None):
+        """Stream to the receiver at ADDRESS (host, port), or the one
+        in the player configuration if None.
+        """
+        cfg = player.cfg
+        if address is None:
+            if not cfg.net_sink_host:
+                raise sink.SinkError('net_sink_host must be set for the {0} sink'.format(protocol))
+            address = (cfg.net_sink_host, cfg.net_sink_port)
+
+        self.log = player.log
+        self.debug = player.debug
+
+        self.protocol = protocol
+        self.address = address
+        self.buffer_seconds = cfg.net_sink_buffer_seconds
+
+        if protocol == 'tcp':
+            self.payload_bytes = TCP_PAYLOAD_BYTES
+        else:
+            self.payload_bytes = UDP_PAYLOAD_BYTES
+
+        # Protects everything below, and is notified on acks and stop
+        self.cond = threading.Condition()
+
+        # Serialises writing messages to the socket
+        self.send_lock = threading.Lock()
+
+        self.sock = None
+        self.ack_thread = None
+        self.connect_error = None
+        self.next_connect = 0
+
+        self.stream_id = random.getrandbits(32)
+        self.format = None
+        self.frame_size = 0
+        self.max_ahead_frames = 0
+
+        self.sent_frames = 0
+        self.acked_frames = 0
+        self.acked_flags = 0
+        self.receiver_error = None
+
+        # Last control message, resent until acknowledged
+        self.control = None
+        self.control_msg = None
+        self.control_sent = 0
+
+        self.stream = sink.StreamPackets()
+
+        # Counters for get_stats()
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.acks_received = 0
+        self.connects = 0
+        self.rtt = None
+        self.rtt_max = None
+
+
+    def pause(self):
+        with self.cond:
+            if self.format is None:
+                return False
+            msg = self._set_control(PAUSE)
+            sock = self.sock
+
+        if sock:
+            self._send(sock, msg)
+        return True
+
+
+    def resume(self):
+        with self.cond:
+            if self.format is None:
+                return
+            msg = self._set_control(RESUME)
+            sock = self.sock
+
+        if sock:
+            self._send(sock, msg)
+
+
+    def stop(self):
+        with self.cond:
+            if self.format is None:
+                return
+            msg = self._set_control(STOP)
+            sock = self.sock
+
+            self.format = None
+            self.stream.reset(0)
+            self.cond.notify_all()
+
+        if sock:
+            self._send(sock, msg)
+
+
+    def start(self, format):
+        with self.cond:
+            self.stream_id = (self.stream_id + 1) & 0xffffffff
+            self.format = format
+            self.frame_size = format.channels * format.bytes_per_sample
+            self.max_ahead_frames = self.buffer_seconds * format.rate
+
+            self.sent_frames = 0
+            self.acked_frames = 0
+            self.acked_flags = 0
+            self.receiver_error = None
+            self.control = None
+            self.control_msg = None
+
+            self.stream.reset(self.frame_size)
+
+            if self.sock is None:
+                self._connect()
+
+
+    def add_packet(self, packet, offset):
+        with self.cond:
+            if self.format is None:
+                # stopped in flight
+                return 0, packet, None
+
+            if self.sock is None and not self._connect():
+                # Don't spin the Transport while the receiver is unreachable
+                self.cond.wait(max(0, self.next_connect - time.time()))
+                return 0, self._playing_packet(), self._error()
+
+            if self.sent_frames - self.acked_frames >= self.max_ahead_frames:
+                self.cond.wait(self.ACK_WAIT)
+
+                room = self.max_ahead_frames - (self.sent_frames - self.acked_frames)
+                if self.format is None or self.sock is None or room <= 0:
+                    return 0, self._playing_packet(), self._error()
+
+            room = self.max_ahead_frames - (self.sent_frames - self.acked_frames)
+            end = min(len(packet.data), offset + room * self.frame_size)
+
+            messages = []
+            pos = offset
+            while pos < end:
+                length = min(self.payload_bytes, end - pos)
+                messages.append(encode_message(
+                        DATA, self.stream_id, self.format, self.sent_frames,
+                        time.time(), payload = buffer(packet.data, pos, length)))
+                self.sent_frames += length / self.frame_size
+                pos += length
+
+            self.stream.add(packet, offset, end)
+            sock = self.sock
+
+        # Audio lost on send errors is replaced by silence in the
+        # receiver, so just carry on after reconnecting
+        for msg in messages:
+            if not self._send(sock, msg):
+                break
+
+        with self.cond:
+            return end - offset, self._playing_packet(), self._error()
+
+
+    def drain(self):
+        with self.cond:
+            if self.format is None or self.acked_flags & ACK_DRAINED:
+                return None
+
+            if self.sock is None and not self._connect():
+                # Nothing more can be played without the receiver
+                return None
+
+            msg = None
+            if self.control != DRAIN:
+                msg = self._set_control(DRAIN, self.sent_frames)
+            sock = self.sock
+
+        if msg:
+            self._send(sock, msg)
+
+        with self.cond:
+            if not self.acked_flags & ACK_DRAINED:
+                self.cond.wait(self.ACK_WAIT)
+
+            if self.format is None or self.acked_flags & ACK_DRAINED:
+                return None
+
+            return self._playing_packet(), self._error()
+
+
+    def get_playing_offset(self):
+        with self.cond:
+            return self.stream.find(self.acked_frames)
+
+
+    def close(self):
+        """Stop the sink and disconnect from the receiver."""
+        self.stop()
+
+        with self.cond:
+            if self.sock:
+                self._disconnect(self.sock, 'closed')
+            thread = self.ack_thread
+
+        if thread:
+            thread.join()
+
+
+    def get_stats(self):
+        """Network sinks report these counters instead of the device
+        counters:
+
+          protocol: 'tcp' or 'udp'
+          connected: True if connected to the receiver
+          connects: connections made to the receiver
+          messages_sent/bytes_sent: messages sent to the receiver
+          acks_received: acknowledgements from the receiver
+          frames_ahead: frames sent but not yet played by the receiver
+          rtt_ms/rtt_max_ms: round trip time to the receiver
+        """
+        with self.cond:
+            return {
+                'protocol': self.protocol,
+                'connected': self.sock is not None,
+                'connects': self.connects,
+                'messages_sent': self.messages_sent,
+                'bytes_sent': self.bytes_sent,
+                'acks_received': self.acks_received,
+                'frames_ahead': self.sent_frames - self.acked_frames,
+                'rtt_ms': self.rtt * 1000 if self.rtt is not None else None,
+                'rtt_max_ms': self.rtt_max * 1000 if self.rtt_max is not None else None,
+                }
+
+
+    #
+    # Internal methods, called with self.cond held unless noted
+    #
+
+    def _playing_packet(self):
+        playing = self.stream.find(self.acked_frames)
+        return playing[0] if playing else None
+
+
+    def _error(self):
+        if self.receiver_error:
+            return self.receiver_error
+        if self.sock is None:
+            return self.connect_error
+        return None
+
+
+    def _set_control(self, msg_type, frame_pos = 0):
+        self.control = msg_type
+        self.control_msg = encode_message(
+            msg_type, self.stream_id, self.format, frame_pos, time.time())
+        self.control_sent = time.time()
+        return self.control_msg
+
+
+    def _connect(self):
+        now = time.time()
+        if now < self.next_connect:
+            return False
+
+        host, port = self.address
+        try:
+            if self.protocol == 'tcp':
+                sock = socket.create_connection(self.address, self.CONNECT_TIMEOUT)
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            else:
+                family, socktype, proto, _, addr = socket.getaddrinfo(
+                    host, port, 0, socket.SOCK_DGRAM)[0]
+                sock = socket.socket(family, socktype, proto)
+                sock.connect(addr)
+        except socket.error, e:
+            if self.connect_error is None:
+                self.log('error connecting to {0} receiver {1}:{2}: {3}',
+                         self.protocol, host, port, e)
+            self.connect_error = 'network sink: {0}'.format(e)
+            self.next_connect = now + self.RECONNECT_DELAY
+            return False
+
+        self.log('connected to {0} receiver {1}:{2}', self.protocol, host, port)
+        self.sock = sock
+        self.connect_error = None
+        self.connects += 1
+
+        self.ack_thread = threading.Thread(target = self._ack_loop, args = (sock, ),
+                                           name = 'net sink acks')
+        self.ack_thread.daemon = True
+        self.ack_thread.start()
+
+        # Bring the receiver up to date on the state of the stream
+        if self.control_msg:
+            self.control_sent = 0
+
+        return True
+
+
+    def _disconnect(self, sock, error):
+        if sock is not self.sock:
+            return
+
+        self.log('lost connection to receiver {0}:{1}: {2}',
+                 self.address[0], self.address[1], error)
+
+        self.sock = None
+        self.connect_error = 'network sink: {0}'.format(error)
+        self.next_connect = time.time() + self.RECONNECT_DELAY
+
+        try:
+            if self.protocol == 'tcp':
+                sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+        except socket.error:
+            pass
+
+        self.cond.notify_all()
+
+
+    def _send(self, sock, msg):
+        """Send MSG on SOCK, without holding self.cond.  Returns
+        False on errors.
+        """
+        try:
+            with self.send_lock:
+                if self.protocol == 'tcp':
+                    sock.sendall(msg)
+                else:
+                    sock.send(msg)
+
+                self.messages_sent += 1
+                self.bytes_sent += len(msg)
+
+        except socket.error, e:
+            with self.cond:
+                self._disconnect(sock, e)
+            return False
+
+        return True
+
+
+    def _handle_ack(self, msg):
+        if msg.stream_id != self.stream_id or self.format is None:
+            return
+
+        self.acks_received += 1
+
+        if msg.timestamp:
+            self.rtt = time.time() - msg.timestamp
+            self.rtt_max = max(self.rtt, self.rtt_max)
+
+        if msg.frame_pos > self.acked_frames:
+            self.acked_frames = min(msg.frame_pos, self.sent_frames)
+
+        self.acked_flags = msg.flags
+        self.receiver_error = msg.payload or None
+
+        if ((self.control == PAUSE and msg.flags & ACK_PAUSED)
+            or (self.control == RESUME and not msg.flags & ACK_PAUSED)
+            or (self.control == DRAIN and msg.flags & ACK_DRAINED)
+            or (self.control == STOP and msg.flags & ACK_STOPPED)):
+            self.control = None
+            self.control_msg = None
+
+        self.cond.notify_all()
+
+
+    def _ack_loop(self, sock):
+        """Thread reading acknowledgements from the receiver and
+        resending control messages.  Runs without self.cond.
+        """
+        parser = MessageParser()
+
+        while True:
+            with self.cond:
+                if sock is not self.sock:
+                    return
+
+                resend = None
+                if self.control_msg and time.time() - self.control_sent >= self.CONTROL_RESEND:
+                    resend = self.control_msg
+                    self.control_sent = time.time()
+
+            if resend:
+                self._send(sock, resend)
+
+            try:
+                r, w, x = select.select([sock], [], [], self.CONTROL_RESEND)
+                if not r:
+                    continue
+
+                data = sock.recv(65536)
+                if not data:
+                    raise socket.error('connection closed by receiver')
+
+                messages = parser.feed(data)
+
+            except (socket.error, select.error, ProtocolError), e:
+                with self.cond:
+                    self._disconnect(sock, e)
+                return
+
+            with self.cond:
+                for msg in messages:
+                    if msg.type == ACK:
+                        self._handle_ack(msg)
+
+
+#
+# Receiver
+#
+
+class JitterBuffer(object):
+    """Reorder received audio by its frame position in the stream.
+
+    Audio isn't handed out until target_frames have been buffered,
+    and after an underrun the buffer fills up to the target again
+    before playing resumes.  Late audio is dropped, and gaps in the
+    stream are filled with silence.
+    """
+
+    def __init__(self, frame_size, target_frames):
+        self.frame_size = frame_size
+        self.target_frames = target_frames
+
+        # frame_pos -> data
+        self.chunks = {}
+
+        # Next frame to hand out
+        self.next_pos = 0
+
+        # End of the audio received so far
+        self.end_pos = 0
+
+        # End of the stream, if known
+        self.final_pos = None
+
+        self.buffering = True
+        self.underruns = 0
+        self.late_frames = 0
+        self.silent_frames = 0
+
+
+    def put(self, frame_pos, data):
+        """Add DATA at FRAME_POS.  Returns False if the data was
+        too late to be played.
+        """
+        if frame_pos < self.next_pos:
+            self.late_frames += len(data) / self.frame_size
+            return False
+
+        self.chunks[frame_pos] = data
+        self.end_pos = max(self.end_pos, frame_pos + len(data) / self.frame_size)
+        return True
+
+
+    def set_end(self, frame_pos):
+        self.final_pos = frame_pos
+
+
+    def level(self):
+        """Return the number of frames buffered."""
+        return self.end_pos - self.next_pos
+
+
+    def at_end(self):
+        return self.final_pos is not None and self.next_pos >= self.final_pos
+
+
+    def get(self):
+        """Return the next audio to play as (frame_pos, data, silence),
+        or None if there is nothing to play right now.
+        """
+        if self.buffering:
+            if self.level() < self.target_frames and self.final_pos is None:
+                return None
+            self.buffering = False
+
+        pos = self.next_pos
+
+        data = self.chunks.pop(pos, None)
+        if data is not None:
+            self.next_pos += len(data) / self.frame_size
+            return pos, data, False
+
+        if pos < self.end_pos:
+            # Lost audio, play silence up to the next chunk we have
+            next_chunk = min(p for p in self.chunks if p > pos)
+            frames = next_chunk - pos
+            self.next_pos = next_chunk
+            self.silent_frames += frames
+            return pos, '\0' * (frames * self.frame_size), True
+
+        if self.final_pos is None:
+            self.underruns += 1
+            self.buffering = True
+
+        return None
+
+
+class ReceivedPacket(object):
+    """Audio passed from the jitter buffer to the receiver's sink.
+    Silence has no file_pos, like the silent packets of the player.
+    """
+
+    def __init__(self, frame_pos, data, frame_size, silence):
+        self.frame_pos = frame_pos
+        self.data = data
+        self.length = len(data) / frame_size
+        self.file_pos = None if silence else frame_pos
+
+
+class ReceivedStream(object):
+    def __init__(self, stream_id, format, jitter_seconds):
+        self.stream_id = stream_id
+        self.format = format
+        self.frame_size = format.channels * format.bytes_per_sample
+        self.jitter = JitterBuffer(self.frame_size,
+                                   int(jitter_seconds * format.rate))
+
+        self.started = False
+        self.paused = False
+        self.drained = False
+        self.played_frames = 0
+        self.error = None
+
+
+class SinkReceiver(object):
+    """Receive audio from a NetworkSink and play it through a local
+    sink.
+
+    A network thread receives messages and sends acknowledgements,
+    and a play thread feeds the sink from the jitter buffer.  Only
+    one sender is served at a time.
+    """
+
+    # Seconds between acknowledgements
+    ACK_INTERVAL = 0.2
+
+    def __init__(self, protocol, address, jitter_seconds, log, debug):
+        self.protocol = protocol
+        self.address = address
+        self.jitter_seconds = jitter_seconds
+        self.log = log
+        self.debug = debug
+
+        self.sink = None
+        self.sock = None
+
+        # Protects the stream state, notified when it changes
+        self.cond = threading.Condition()
+
+        # Serialises start(), stop(), pause() and resume() on the sink
+        self.control_lock = threading.Lock()
+
+        self.stream = None
+        self.stopped_stream_id = None
+
+        # Where to send UDP acknowledgements
+        self.peer = None
+
+        self.thread = None
+        self.closed = False
+
+
+    def bind(self):
+        """Create the listening socket.  Returns its address."""
+        host, port = self.address
+        if self.protocol == 'tcp':
+            socktype = socket.SOCK_STREAM
+        else:
+            socktype = socket.SOCK_DGRAM
+
+        family, socktype, proto, _, addr = socket.getaddrinfo(
+            host or None, port, 0, socktype, 0, socket.AI_PASSIVE)[0]
+
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(addr)
+        if self.protocol == 'tcp':
+            sock.listen(1)
+
+        self.sock = sock
+        return sock.getsockname()
+
+
+    def run(self, sink):
+        """Play received audio through SINK.  Runs the network loop in
+        the calling thread until close() is called.
+        """
+        self.sink = sink
+
+        t = threading.Thread(target = self._play_loop, name = 'net receiver play')
+        t.daemon = True
+        t.start()
+
+        if self.protocol == 'tcp':
+            while not self.closed:
+                try:
+                    conn, addr = self.sock.accept()
+                except socket.error, e:
+                    if self.closed:
+                        return
+                    raise
+
+                self.log('sender connected from {0}', addr)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                try:
+                    self._receive_loop(conn)
+                finally:
+                    conn.close()
+                self.log('sender disconnected')
+        else:
+            while not self.closed:
+                self._receive_loop(self.sock)
+
+
+    def start(self, sink):
+        """Run the receiver in a background thread."""
+        self.thread = threading.Thread(target = self.run, args = (sink, ),
+                                       name = 'net receiver')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def close(self):
+        """Stop receiving and close the socket."""
+        self.closed = True
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+        if self.thread:
+            self.thread.join()
+
+
+    #
+    # Network thread
+    #
+
+    def _receive_loop(self, sock):
+        parser = MessageParser()
+        next_ack = 0
+
+        while not self.closed:
+            ack_now = False
+            timestamp = 0
+
+            try:
+                r, w, x = select.select([sock], [], [], self.ACK_INTERVAL)
+                if r:
+                    if self.protocol == 'tcp':
+                        data = sock.recv(65536)
+                        if not data:
+                            return
+                        messages = parser.feed(data)
+                    else:
+                        data, self.peer = sock.recvfrom(65536)
+                        messages = MessageParser().feed(data)
+                else:
+                    messages = []
+
+            except ProtocolError, e:
+                self.log('invalid message from sender: {0}', e)
+                if self.protocol == 'tcp':
+                    return
+                continue
+
+            except (socket.error, select.error), e:
+                if not self.closed:
+                    self.log('error receiving from sender: {0}', e)
+                return
+
+            for msg in messages:
+                self._handle_message(msg)
+                timestamp = msg.timestamp
+                if msg.type != DATA:
+                    ack_now = True
+
+            now = time.time()
+            if ack_now or now >= next_ack:
+                next_ack = now + self.ACK_INTERVAL
+                self._send_ack(sock, timestamp)
+
+
+    def _handle_message(self, msg):
+        with self.cond:
+            if msg.type == STOP:
+                self._stop_stream(msg.stream_id)
+                return
+
+            if msg.type == ACK:
+                return
+
+            stream = self.stream
+            if stream is None or stream.stream_id != msg.stream_id:
+                if msg.stream_id == self.stopped_stream_id:
+                    # Late message for a stopped stream
+                    return
+                stream = self._new_stream(msg)
+
+            if msg.type == DATA:
+                stream.jitter.put(msg.frame_pos, msg.payload)
+
+            elif msg.type == PAUSE:
+                if not stream.paused:
+                    self.debug('pausing stream {0:08x}', stream.stream_id)
+                    stream.paused = True
+                    with self.control_lock:
+                        if stream.started:
+                            self.sink.pause()
+
+            elif msg.type == RESUME:
+                if stream.paused:
+                    self.debug('resuming stream {0:08x}', stream.stream_id)
+                    stream.paused = False
+                    with self.control_lock:
+                        if stream.started:
+                            self.sink.resume()
+
+            elif msg.type == DRAIN:
+                stream.jitter.set_end(msg.frame_pos)
+
+            self.cond.notify_all()
+
+
+    def _new_stream(self, msg):
+        if self.stream:
+            self._stop_stream(self.stream.stream_id)
+
+        format = StreamFormat(msg)
+        self.stream = ReceivedStream(msg.stream_id, format, self.jitter_seconds)
+        self.log('receiving stream {0:08x}: {1}', msg.stream_id, format)
+        return self.stream
+
+
+    def _stop_stream(self, stream_id):
+        self.stopped_stream_id = stream_id
+
+        stream = self.stream
+        if stream is None or stream.stream_id != stream_id:
+            return
+
+        self.debug('stopping stream {0:08x}', stream_id)
+        self.stream = None
+        with self.control_lock:
+            if stream.started:
+                self.sink.stop()
+                stream.started = False
+
+        jitter = stream.jitter
+        if jitter.underruns or jitter.late_frames or jitter.silent_frames:
+            self.log('stream {0:08x}: {1} underruns, {2} late frames, {3} frames lost',
+                     stream_id, jitter.underruns, jitter.late_frames, jitter.silent_frames)
+
+        self.cond.notify_all()
+
+
+    def _send_ack(self, sock, timestamp):
+        with self.cond:
+            stream = self.stream
+            if stream:
+                stream_id = stream.stream_id
+                frame_pos = stream.played_frames
+                flags = ((ACK_PAUSED if stream.paused else 0)
+                         | (ACK_DRAINED if stream.drained else 0))
+                error = stream.error or ''
+            elif self.stopped_stream_id is not None:
+                stream_id = self.stopped_stream_id
+                frame_pos = 0
+                flags = ACK_STOPPED
+                error = ''
+            else:
+                return
+
+        msg = encode_message(ACK, stream_id, None, frame_pos, timestamp, flags, error)
+
+        try:
+            if self.protocol == 'tcp':
+                sock.sendall(msg)
+            elif self.peer:
+                sock.sendto(msg, self.peer)
+        except socket.error, e:
+            self.debug('error sending ack: {0}', e)
+
+
+    #
+    # Play thread
+    #
+
+    def _play_loop(self):
+        while True:
+            with self.cond:
+                while True:
+                    stream = self.stream
+                    if (stream and not stream.drained
+                        and (stream.started or not stream.paused)):
+                        if stream.jitter.at_end():
+                            item = None
+                            break
+
+                        item = stream.jitter.get()
+                        if item:
+                            break
+
+                    self.cond.wait()
+
+            if not stream.started and not self._start_sink(stream):
+                continue
+
+            if item is None:
+                self._drain(stream)
+            else:
+                self._play(stream, item)
+
+
+    def _start_sink(self, stream):
+        with self.control_lock:
+            if stream is not self.stream or stream.paused:
+                return False
+
+            self.sink.start(stream.format)
+            stream.started = True
+            return True
+
+
+    def _play(self, stream, item):
+        frame_pos, data, silence = item
+        packet = ReceivedPacket(frame_pos, data, stream.frame_size, silence)
+
+        offset = 0
+        while offset < len(data) and stream is self.stream:
+            stored, current_packet, error = self.sink.add_packet(packet, offset)
+            offset += stored
+            self._update_position(stream, current_packet, error)
+
+
+    def _drain(self, stream):
+        while stream is self.stream:
+            res = self.sink.drain()
+            if res is None:
+                with self.cond:
+                    stream.drained = True
+                    stream.played_frames = stream.jitter.final_pos
+                return
+
+            current_packet, error = res
+            self._update_position(stream, current_packet, error)
+
+
+    def _update_position(self, stream, current_packet, error):
+        playing = self.sink.get_playing_offset()
+        if playing:
+            packet, offset = playing
+            frame_pos = packet.frame_pos + offset
+        elif current_packet:
+            frame_pos = current_packet.frame_pos
+        else:
+            frame_pos = None
+
+        with self.cond:
+            if frame_pos is not None and frame_pos > stream.played_frames:
+                stream.played_frames = frame_pos
+            stream.error = error
+
+
+class SinkDaemon(Daemon):
+    """The codsinkd daemon, playing audio from a NetworkSink."""
+
+    def __init__(self, cfg, debug = False):
+        self.cfg = cfg
+        self.receiver = SinkReceiver(cfg.protocol, (cfg.listen_address, cfg.port),
+                                     cfg.jitter_buffer_seconds, self.log, self.debug)
+
+        # Init parent last, since it will run the main loop
+        super(SinkDaemon, self).__init__(cfg, debug)
+
+
+    def setup_prefork(self):
+        addr = self.receiver.bind()
+        self.preserve_file(self.receiver.sock)
+        self.log('listening for {0} streams on {1}', self.cfg.protocol, addr)
+
+
+    def run(self):
+        self.receiver.run(sink.SINKS[self.cfg.audio_device_type](self))
@@ -16,7 +16,6 @@ import errno
 import subprocess
 import time
 import threading
-import Queue
 import traceback
 import copy
 
@@ -24,8 +23,11 @@ from . import full_version
 from . import serialize
 from . import db
 from . import model
+from . import audio
 from . import source
 from . import sink
+from . import headcache
+from . import ringbuffer
 from . import rip
 from .state import State, RipState
 from .command import CommandError
@@ -38,6 +40,9 @@ class PlayerError(DaemonError):
 
 
 class Player(Daemon):
+    # Default seconds to move with ff and rew
+    SKIP_SECONDS = 10
+
     def __init__(self, cfg, mq_cfg, database, debug = False):
         self.cfg = cfg
         self.mq_cfg = mq_cfg
@@ -47,6 +52,10 @@ class Player(Daemon):
         self.transport = None
         
         self.ripper = None
+        self.ripper_process = None
+        self.ripper_timeout = None
+        self.reading_disc = False
+        self.head_cache = None
 
         if self.cfg.log_performance:
             self.audio_streamer_perf_log = open('/tmp/cod_audio_streamer.log', 'wt')
@@ -64,21 +73,33 @@ class Player(Daemon):
 
 
     def run(self):
+        if self.cfg.head_cache_dir:
+            try:
+                self.head_cache = headcache.HeadCache(
+                    self.cfg.head_cache_dir,
+                    self.cfg.head_cache_size_mb * 1024 * 1024,
+                    self.log)
+                self.log('using head cache in {}', self.cfg.head_cache_dir)
+            except headcache.HeadCacheError, e:
+                self.log('disabling head cache: {}', e)
+
         try:
             self.transport = Transport(
                 self,
                 sink.SINKS[self.cfg.audio_device_type](self))
 
+            # Set up child process supervision in the main thread
+            self.setup_process_supervisor()
+
             self.log('sending state to {}', self.mq_cfg.state)
             self.log('receiving commands on {}', self.mq_cfg.player_commands)
             self.log('receiving RPC on {}', self.mq_cfg.player_rpc)
 
 
-            # Force out a bunch of updates at the start to improve the
-            # chance that already running state subscribers get the
-            # update
-            for i in range(30):
-                self.io_loop.add_timeout(time.time() + i, self.force_state_update)
+            # Publish the initial state once.  State subscribers
+            # fetch the current state over RPC when they connect, so
+            # they don't depend on getting this.
+            self.force_state_update()
 
             # Kick off IO loop to drive the rest of the events
             self.io_loop.start()
@@ -119,15 +140,23 @@ class Player(Daemon):
 
 
     def handle_command(self, cmd_args, cmd_func):
-        try:
-            self.debug('got command: {0}', cmd_args)
+        self.debug('got command: {0}', cmd_args)
+        return self.run_command(cmd_args, cmd_func, cmd_args[1:])
+
 
+    def run_command(self, cmd_args, func, *args):
+        """Call FUNC(*ARGS) to execute the command CMD_ARGS, and return
+        the reply to send.  Commands that finish in another thread
+        return a zerohub.AsyncReply, which is passed through.
+        """
+        try:
             cmd = cmd_args[0]
-            args = cmd_args[1:]
 
-            result = cmd_func(args)
+            result = func(*args)
 
-            if isinstance(result, State):
+            if isinstance(result, zerohub.AsyncReply):
+                return result
+            elif isinstance(result, State):
                 result_type = 'state'
             elif isinstance(result, RipState):
                 result_type = 'rip_state'
@@ -174,23 +203,24 @@ class Player(Daemon):
             if self.ripper:
                 raise CommandError("already ripping disc, can't rip another one yet")
 
-            try:
-                ripper = rip.Ripper(self)
-                disc = ripper.read_disc()
+            if self.reading_disc:
+                raise CommandError("already reading disc")
 
-                # Do first tick immediately to trigger any RipErrors here
-                if ripper.tick():
-                    # Ok, keep track of it and tick it
-                    self.ripper = ripper
-                    self.io_loop.add_timeout(time.time() + 1, self.tick_ripper)
+            # Reading the disc ID can take seconds while the drive
+            # spins up, so do it in a thread to keep handling other
+            # commands and RPCs.  The reply is sent when the disc has
+            # been read and started.
+            ripper = rip.Ripper(self)
+            reply = zerohub.AsyncReply()
+            self.reading_disc = True
 
-            except rip.RipError, e:
-                raise CommandError('rip failed: {}'.format(e))
+            t = threading.Thread(target = self.read_disc_thread,
+                                 args = (ripper, reply),
+                                 name = 'read disc')
+            t.daemon = True
+            t.start()
 
-            # Only follow links for physical discs.  When the user
-            # starts a disc by ID we assume they really want to listen
-            # to that one.
-            disc, source_disc_id = self.resolve_alias_links(disc)
+            return reply
 
         # Stash the source disc into the resolved one.  Slightly ugly
         # messing with model.DbDisc like this, but it's simple.
@@ -198,6 +228,48 @@ class Player(Daemon):
         return self.play_disc(disc)
 
 
+    def read_disc_thread(self, ripper, reply):
+        try:
+            disc = ripper.read_disc()
+            exc_info = None
+        except:
+            disc = None
+            exc_info = sys.exc_info()
+
+        self.io_loop.add_callback(
+            lambda: reply.send(self.run_command(
+                    ['disc'], self.play_inserted_disc, ripper, disc, exc_info)))
+
+
+    def play_inserted_disc(self, ripper, disc, exc_info):
+        """Called in the IOLoop when read_disc_thread() has read the
+        physical disc, or failed with exception EXC_INFO.
+        """
+        self.reading_disc = False
+
+        try:
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            # Do first tick immediately to trigger any RipErrors here
+            if ripper.tick():
+                # Ok, keep track of it and tick it
+                self.ripper = ripper
+                self.schedule_ripper(ripper)
+
+        except rip.RipError, e:
+            raise CommandError('rip failed: {}'.format(e))
+
+        # Only follow links for physical discs.  When the user
+        # starts a disc by ID we assume they really want to listen
+        # to that one.
+        disc, source_disc_id = self.resolve_alias_links(disc)
+
+        # Stash the source disc, as in cmd_disc()
+        disc.source_disc_id = source_disc_id
+        return self.play_disc(disc)
+
+
     def cmd_stop(self, args):
         return self.transport.stop()
 
@@ -222,6 +294,24 @@ class Player(Daemon):
         return self.transport.prev()
 
 
+    def cmd_seek(self, args):
+        try:
+            track = int(args[0])
+            position = float(args[1])
+        except (IndexError, ValueError):
+            raise CommandError('expected arguments: track position')
+
+        return self.transport.seek(track, position)
+
+
+    def cmd_ff(self, args):
+        return self.transport.skip(self.get_skip_seconds(args))
+
+
+    def cmd_rew(self, args):
+        return self.transport.skip(-self.get_skip_seconds(args))
+
+
     def cmd_quit(self, args):
         self.log('quitting on command')
         if self.ripper:
@@ -276,10 +366,29 @@ class Player(Daemon):
         return full_version()
 
 
+    def cmd_stats(self, args):
+        return self.transport.get_stats()
+
+
     #
     # Internal methods
     #
 
+    def get_skip_seconds(self, args):
+        if not args:
+            return self.SKIP_SECONDS
+
+        try:
+            seconds = float(args[0])
+        except ValueError:
+            raise CommandError('invalid number of seconds: {0}'.format(args[0]))
+
+        if seconds <= 0:
+            raise CommandError('number of seconds must be positive: {0}'.format(args[0]))
+
+        return seconds
+
+
     def eventually_stop(self):
         """Called when shutdown has been requested after a
         timeout to allow any IO to wrap up.
@@ -295,13 +404,21 @@ class Player(Daemon):
 
 
     def tick_ripper(self):
-        """Run once a second as long as there is a ripper.
-        Sets up the next call to itself if relevant.
+        """Run when the ripper process exits, or when the ripper wants
+        to update its progress.  Sets up the next call to itself if
+        relevant.
         """
+        if self.ripper_timeout:
+            self.io_loop.remove_timeout(self.ripper_timeout)
+            self.ripper_timeout = None
+
+        if not self.ripper:
+            return
+
         try:
             if self.ripper.tick():
                 # Ok, keep going
-                self.io_loop.add_timeout(time.time() + 1, self.tick_ripper)
+                self.schedule_ripper(self.ripper)
             else:
                 # Done
                 self.ripper = None
@@ -314,6 +431,27 @@ class Player(Daemon):
             self.transport.ripping_done()
 
 
+    def schedule_ripper(self, ripper):
+        """Tick RIPPER when its current process exits, or after the
+        interval it asked for.
+        """
+        process = ripper.current_process
+        if process and process is not self.ripper_process:
+            self.ripper_process = process
+            self.process_supervisor.watch(
+                process, lambda returncode: self.ripper_process_exited(ripper))
+
+        if ripper.tick_interval:
+            self.ripper_timeout = self.io_loop.add_timeout(
+                time.time() + ripper.tick_interval, self.tick_ripper)
+
+
+    def ripper_process_exited(self, ripper):
+        # Ignore processes of rippers that have been stopped
+        if ripper is self.ripper:
+            self.tick_ripper()
+
+
     def resolve_alias_links(self, disc):
         """Follow any disc alias links, returning the disc that should really
         be played.
@@ -387,15 +525,13 @@ class Player(Daemon):
                 self.log("error executing command {0!r}: {1}:", args, e)
                 return
 
-            def wait_for_eject():
-                if process.poll() == None:
-                    self.io_loop.add_callback(wait_for_eject)
-                elif process.returncode != 0:
-                    self.log("{} finished with error code: {}", args, process.returncode)
+            def eject_finished(returncode):
+                if returncode != 0:
+                    self.log("{} finished with error code: {}", args, returncode)
                 else:
                     self.debug("{} finished ok", args)
 
-            self.io_loop.add_callback(wait_for_eject)
+            self.process_supervisor.watch(process, eject_finished)
 
     #
     # State publishing
@@ -419,6 +555,8 @@ class Player(Daemon):
             # Send a dummy state
             self.publish_rip_state(RipState())
 
+        self.publish_disc(self.transport.get_source_disc())
+
 
 
 class Transport(object):
@@ -429,8 +567,8 @@ class Transport(object):
     implementing the commands from the Player.
 
     There are two threads managed by this class.  The source thread
-    gets audio packets from a Source iterator and pushes them onto a
-    Queue, which is then read by the sink thread which sends them to
+    gets audio packets from a Source iterator and pushes them into a
+    PacketRingBuffer, which is then read by the sink thread which sends them to
     the audio sink and updates the state according to the current
     played position.
 
@@ -449,8 +587,9 @@ class Transport(object):
     documentation on how this class works.
     """
 
-    # Perhaps make this configurable sometime
+    # Defaults when not configured
     MAX_BUFFER_SECS = 20
+    MIN_BUFFER_SECS = 5
     PACKETS_PER_SECOND = 5
 
 
@@ -468,13 +607,38 @@ class Transport(object):
 
         self.sink = sink
 
-        self.queue = Queue.Queue(self.PACKETS_PER_SECOND * self.MAX_BUFFER_SECS)
+        cfg = player.cfg
+        if cfg:
+            self.max_buffer_secs = cfg.transport_buffer_seconds
+            self.packets_per_second = cfg.transport_packets_per_second
+        else:
+            self.max_buffer_secs = self.MAX_BUFFER_SECS
+            self.packets_per_second = self.PACKETS_PER_SECOND
+
+        # In adaptive mode the buffer size follows the source read
+        # latency, otherwise it is always the max size
+        if cfg and cfg.transport_buffer_adaptive:
+            self.buffer_sizer = ringbuffer.AdaptiveBufferSize(
+                min(cfg.transport_buffer_min_seconds, self.max_buffer_secs),
+                self.max_buffer_secs, time.time())
+            buffer_secs = self.buffer_sizer.secs
+        else:
+            self.buffer_sizer = None
+            buffer_secs = self.max_buffer_secs
+
+        self.buffer = ringbuffer.PacketRingBuffer(
+            *self.get_buffer_size(buffer_secs))
+
+        # Recycle packets, with some room for those held by the sink
+        self.packet_pool = audio.PacketPool(
+            2 * self.packets_per_second * self.max_buffer_secs)
 
         # The following members can only be accessed when holding the lock
         self.lock = threading.Lock()
         self.context = 0
         self.source = None
         self.start_track = 0
+        self.start_position = 0
         self.state = State()
         self.paused_by_user = False
 
@@ -507,6 +671,35 @@ class Transport(object):
             return copy.copy(self.state)
 
 
+    def get_stats(self):
+        """Return a dict with transport statistics."""
+        packets, used_bytes = self.buffer.fill_level()
+        return {
+            'buffer': {
+                'seconds': self.buffer_secs,
+                'size_bytes': self.buffer.size,
+                'max_packets': self.buffer.max_packets,
+                'packets': packets,
+                'used_bytes': used_bytes,
+                'fill_percent': 100 * used_bytes / self.buffer.size,
+                'adaptive': self.buffer_sizer is not None,
+                },
+            'packet_pool': self.packet_pool.stats(),
+            'sink': self.sink.get_stats(),
+            }
+
+
+    def get_buffer_size(self, secs):
+        """Return (size, max_packets) for a buffer of SECS seconds, with
+        a little extra to leave space for a skipped packet when the
+        ring wraps around.
+        """
+        self.buffer_secs = secs
+        return ((secs * model.PCM.rate * model.PCM.bytes_per_frame
+                 * (self.packets_per_second + 1) / self.packets_per_second),
+                secs * self.packets_per_second)
+
+
     def get_source_disc(self):
         with self.lock:
             if self.source:
@@ -551,6 +744,7 @@ class Transport(object):
                 self.sink.stop()
 
             self.source = source
+            self.source.packet_pool = self.packet_pool
             self.update_disc()
 
             self.start_new_track(track)
@@ -699,6 +893,69 @@ class Transport(object):
             return copy.copy(self.state)
 
 
+    def seek(self, track, position):
+        """Play from POSITION seconds from index 1 of TRACK, which
+        counts from 1 just like State.track.  The position can be
+        negative to start in the pregap.
+        """
+
+        with self.lock:
+            if self.state.state not in (State.PLAY, State.PAUSE, State.STOP):
+                raise CommandError('ignoring seek() in state {0}'.format(
+                    self.state.state))
+
+            if track < 1 or track > self.state.no_tracks:
+                raise CommandError('invalid track: {0}'.format(track))
+
+            frame_map = self.source.frame_map
+            frame = int(round(position * self.source.disc.audio_format.rate))
+
+            if (frame < -frame_map.pregap_offsets[track - 1]
+                or frame >= frame_map.track_lengths[track - 1] - frame_map.pregap_offsets[track - 1]):
+                raise CommandError('position outside track {0}: {1}'.format(
+                    track, position))
+
+            self.log('transport seeking to track {0} position {1}', track, position)
+
+            if self.state.state != State.STOP:
+                self.sink.stop()
+
+            self.start_new_track(track - 1, frame)
+            return copy.copy(self.state)
+
+
+    def skip(self, seconds):
+        """Move SECONDS forward (or backward, if negative) from the
+        current position, continuing into the following (or
+        preceding) tracks as necessary.
+        """
+
+        with self.lock:
+            if self.state.state not in (State.PLAY, State.PAUSE):
+                raise CommandError('ignoring skip() in state {0}'.format(
+                    self.state.state))
+
+            frame_map = self.source.frame_map
+            rate = self.source.disc.audio_format.rate
+
+            disc_pos = (frame_map.get_disc_pos(self.state.track - 1, self.state.position_frames)
+                        + int(round(seconds * rate)))
+            track_pos = frame_map.get_track_pos(disc_pos)
+
+            self.sink.stop()
+
+            if track_pos is None:
+                self.log('transport stopping on skipping past last track')
+                self.new_context()
+                self.start_track = None
+                self.set_state_stop()
+            else:
+                self.log('transport skipping {0} seconds', seconds)
+                self.start_new_track(*track_pos)
+
+            return copy.copy(self.state)
+
+
     def ripping_done(self):
         with self.lock:
             # Special case: if the rip process failed, we
@@ -750,13 +1007,15 @@ class Transport(object):
             self.start_new_track(self.state.track)
 
 
-    def start_new_track(self, track):
+    def start_new_track(self, track, position = 0):
         self.new_context()
         self.start_track = track
+        self.start_position = position
         self.set_state_working()
 
     def new_context(self):
         self.context += 1
+        self.buffer.flush(self.context)
         self.source_context_changed.set()
         self.sink_context_changed.set()
         self.log('setting new context: {0}'.format(self.context))
@@ -773,7 +1032,8 @@ class Transport(object):
         self.state.track = self.start_track + 1
         self.state.no_tracks = len(self.source.disc.tracks)
         self.state.index = 0
-        self.state.position = 0
+        self.state.position = int(self.start_position / self.source.disc.audio_format.rate)
+        self.state.position_frames = self.start_position
         self.state.length = 0
         self.update_state()
 
@@ -783,6 +1043,7 @@ class Transport(object):
         self.state.track = 0
         self.state.index = 0
         self.state.position = 0
+        self.state.position_frames = 0
         self.state.length = 0
         self.update_state()
     
@@ -818,6 +1079,7 @@ class Transport(object):
                 context = self.context
                 src = self.source
                 start_track = self.start_track
+                start_position = self.start_position
 
                 # start_track behaves like a command to us on context
                 # changes, so reset it to avoid stale information
@@ -828,28 +1090,43 @@ class Transport(object):
                 self.log('using new context: {0}'.format(context))
 
             if src and start_track is not None:
-                self.debug('starting source: {0} at track {1}'.format(src.disc, start_track))
+                self.debug('starting source: {0} at track {1} position {2}'.format(
+                    src.disc, start_track, start_position))
 
                 # Packet loop: get packets from the source until we're told
                 # to do something else or reaches the end
 
                 try:
-                    for packet in src.iter_packets(start_track, self.PACKETS_PER_SECOND):
+                    for packet in src.iter_packets(start_track, self.packets_per_second,
+                                                   start_position):
                         if self.source_context_changed.is_set():
                             break
 
                         if packet is not None:
+                            if self.buffer_sizer and src.read_seconds is not None:
+                                self.adapt_buffer_size(src.read_seconds)
+
                             packet.context = context
-                            self.queue.put(packet)
+                            self.buffer.put(packet, context,
+                                            copy = not src.is_shared_data(packet))
 
                     else:
-                        self.debug('reached end of disc')
-                        self.queue.put(self.END_OF_STREAM(context))
+                        self.debug('reached end of disc, packet pool: {0}',
+                                   self.packet_pool.stats())
+                        self.buffer.put(self.END_OF_STREAM(context), context)
 
                 except source.SourceError, e:
                     self.log('source error for disc {0}: {1}'.format(src.disc, e))
 
 
+    def adapt_buffer_size(self, read_secs):
+        secs = self.buffer_sizer.update(read_secs, time.time())
+        if secs is not None:
+            self.log('changing transport buffer to {0} seconds after {1:.3f}s read',
+                     secs, read_secs)
+            self.buffer.resize(*self.get_buffer_size(secs))
+
+
     #
     # Sink thread
     #
@@ -870,7 +1147,7 @@ class Transport(object):
         context = 0
 
         while True:
-            packet = self.queue.get()
+            item = packet = self.buffer.get()
 
             with self.lock:
                 # If something's changed while not idle, go back to
@@ -907,6 +1184,12 @@ class Transport(object):
                         state = DRAINING
                         pause_when_drained = True
 
+            # Done with the packet data, so let the source reuse it
+            self.buffer.release(item)
+            if isinstance(item, audio.AudioPacket):
+                self.packet_pool.release(item)
+            item = packet = None
+
             if state == DRAINING:
                 self.sink_drain(context, pause_when_drained)
                 state = IDLE
@@ -924,8 +1207,8 @@ class Transport(object):
                 self.state.track = packet.track_number + 1
                 self.state.index = packet.index
                 self.state.position = int(packet.rel_pos / packet.format.rate)
-                self.state.length = int((packet.track.length - packet.track.pregap_offset)
-                                        / packet.format.rate)
+                self.state.position_frames = packet.rel_pos
+                self.state.length = self.source.frame_map.length_secs[packet.track_number]
                 self.update_state()
 
                 return True
@@ -956,13 +1239,14 @@ class Transport(object):
 
 
     def sink_packet(self, packet):
+        packets = (packet, )
         offset = 0
-        while offset < len(packet.data):
+        done = 0
+        while not done:
             if self.sink_context_changed.is_set():
                 return
             
-            sunk, playing_packet, error = self.sink.add_packet(packet, offset)
-            offset += sunk
+            done, offset, playing_packet, error = self.sink.add_packets(packets, offset)
             if playing_packet or error:
                 self.sink_update_state(playing_packet, error)
 
@@ -986,6 +1270,14 @@ class Transport(object):
         if error:
             error = 'Audio sink error: {0}'.format(error)
 
+        # Prefer the position heard from the device, which lags
+        # behind the packet being buffered by the sink
+        frame_offset = 0
+        if packet:
+            playing = self.sink.get_playing_offset()
+            if playing:
+                packet, frame_offset = playing
+
         with self.lock:
             # Always update the device error, regardless of context
             if error != self.state.error:
@@ -999,7 +1291,9 @@ class Transport(object):
             if packet.context != self.context:
                 return
             
-            pos = int(packet.rel_pos / packet.format.rate)
+            pos_frames = packet.rel_pos + frame_offset
+            pos = int(pos_frames / packet.format.rate)
+            self.state.position_frames = pos_frames
 
             if self.state.disc_id != packet.disc.disc_id:
                 self.state.disc_id = packet.disc.disc_id
@@ -1007,8 +1301,7 @@ class Transport(object):
                 self.state.track = packet.track_number + 1
                 self.state.index = packet.index
                 self.state.position = pos
-                self.state.length = int((packet.track.length - packet.track.pregap_offset)
-                                        / packet.format.rate)
+                self.state.length = self.source.frame_map.length_secs[packet.track_number]
                 self.update_state()
 
             elif (self.state.track != packet.track_number + 1
@@ -1016,8 +1309,7 @@ class Transport(object):
                 self.state.track = packet.track_number + 1
                 self.state.index = packet.index
                 self.state.position = pos
-                self.state.length = int((packet.track.length - packet.track.pregap_offset)
-                                        / packet.format.rate)
+                self.state.length = self.source.frame_map.length_secs[packet.track_number]
                 self.update_state()
 
             # Moved backward in track
@@ -1,4 +1,4 @@
-# codplayer - base class for the audio devices
+# codplayer - ALSA sink in pure Python
 #
 # Copyright 2013 Peter Liljenberg <peter.liljenberg@gmail.com>
 #
@@ -11,53 +11,119 @@ import sys
 import threading
 import alsaaudio
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from . import sink
 from . import model
 
 class PyAlsaSink(sink.Sink):
-    """Very simple ALSA sink in only Python.  The C version has a
-    separate thread to ensure that the device play loop runs without
-    interferance from the Python GC or Big Interpreter Lock, but we
-    don't gain anything from that here.
-
-    There may be some race conditions around pause/resume if things go
-    haywire in the sink thread at the same time, but this code does
-    not attempt to fix that.
+    """ALSA sink in only Python, for systems where c_alsa_sink can't
+    be built.  It works like the C version: add_packet() copies the
+    packet data into a preallocated ring buffer, and a separate writer
+    thread plays whole periods from it on the device.
+
+    The writer thread still needs the Big Interpreter Lock between
+    writes, so a busy Python process may cause underruns that the C
+    version wouldn't get.  Bytes are swapped with NumPy when it is
+    installed, otherwise with the array module.
+
+    The states and the interaction with the writer thread follow
+    c_alsa_sink.c.  All members below the lock are protected by it.
     """
 
-    # Run on approx 10 Hz.  pyalsaaudio will hardcode the hardware buffer to
-    # four periods.
+    # Run on approx 10 Hz by default.  pyalsaaudio will hardcode the
+    # hardware buffer to four periods.
     PERIOD_SIZE = 4096
 
-    def __init__(self, player, card, start_without_device, log_performance):
+    BUFFER_SECONDS = 5
+
+    # Seconds to wait before trying to open a failing device again
+    REOPEN_DELAY = 3
+
+    # Sink states
+    CLOSED = 'closed'
+    STARTING = 'starting'
+    PLAYING = 'playing'
+    PAUSING = 'pausing'
+    PAUSED = 'paused'
+    RESUME = 'resume'
+    DRAINING = 'draining'
+    CLOSING = 'closing'
+
+    # States in which add_packet() can put data into the buffer
+    BUFFER_STATES = (PLAYING, PAUSING, PAUSED, RESUME, DRAINING)
+
+    def __init__(self, player, card, start_without_device, log_performance,
+                 keep_open_seconds = 0, period_frames = PERIOD_SIZE,
+                 buffer_seconds = BUFFER_SECONDS, use_mmap = False):
+        # keep_open_seconds and use_mmap are not supported, the
+        # device is always closed when stopped and written with
+        # writei.
         self.log = player.log
         self.debug = player.debug
         self.alsa_card = card
+        self.start_without_device = start_without_device
+        self.period_size = period_frames
+        self.buffer_seconds = buffer_seconds
 
-        # State attributes protected by lock
-
-        self.lock = threading.Lock()
+        self.cond = threading.Condition()
 
-        self.alsa_pcm = None
-        self.paused = False
+        self.state = self.CLOSED
 
-        # End of thread state attributes
+        # State to return to on resume()
+        self.paused_in_state = None
 
-        # State attributes only used within the sink thread
+        # Current sound format, set by start()
         self.channels = None
         self.bytes_per_sample = None
         self.rate = None
         self.big_endian = None
-        self.alsa_swap_bytes = False
+
+        # Ring buffer of whole periods, set up by the writer thread
+        # when the device has been opened.  read_pos is where the
+        # writer thread plays from, and there are used bytes of data
+        # after it.
+        self.buffer = None
+        self.buffer_view = None
+        self.buffer_size = 0
         self.period_bytes = None
+        self.read_pos = 0
+        self.used = 0
+
+        # Packet objects mapping to each period in the buffer
+        self.packets = []
 
-        self.partial_period = None
-        self.partial_packet = None
         self.device_error = None
+        self.written_frames = 0
 
-        # End of sink thread state attributes
+        # pyalsaaudio recovers from xruns internally without telling us
+        self.stats_counters = sink.SinkStats()
 
-        self.log("using python implementation of ALSA sink - you might get glitchy sound");
+        # End of lock protected members
+
+        # Writer thread private data
+        self.alsa_pcm = None
+        self.alsa_swap_bytes = False
+
+        # Period swapped from the buffer when the device needs the
+        # other byte order.  The buffer itself is never swapped, so a
+        # period can be swapped again if writing it is retried.
+        self.swap_buffer = None
+        self.swap_view = None
+        self.buffer_array = None
+        self.swap_array = None
+
+        # Transport sink thread private data
+        self.prev_playing_packet = None
+        self.prev_device_error = None
+
+        if numpy is None:
+            self.log("using python implementation of ALSA sink without numpy")
+        else:
+            self.log("using python implementation of ALSA sink")
 
         # See if we can open the device, just for logging purposes -
         # this will be properly handled in start().
@@ -77,172 +143,459 @@ class PyAlsaSink(sink.Sink):
             else:
                 raise sink.SinkError(e)
 
+        t = threading.Thread(target = self._writer_loop, name = 'alsa writer')
+        t.daemon = True
+        t.start()
+
+
+    #
+    # Sink API, called by the Transport and AlsaSink
+    #
 
     def pause(self):
-        with self.lock:
-            if self.alsa_pcm:
-                try:
-                    if not self.paused:
-                        self.alsa_pcm.pause(1)
-                        self.paused = True
+        with self.cond:
+            if self.state in (self.PLAYING, self.DRAINING):
+                self.paused_in_state = self.state
+                self.state = self.PAUSING
+                self.cond.notify_all()
+
+                while self.state == self.PAUSING:
+                    self.cond.wait()
+
+                if self.state == self.PAUSED:
                     return True
-                except alsaaudio.ALSAAudioError, e:
-                    self.log('error while pausing: {0}', e)
+
+                self.log("alsa: sink didn't pause, state: {0}", self.state)
+            else:
+                self.log('alsa: pausing in invalid state: {0}', self.state)
 
         return False
 
 
     def resume(self):
-        with self.lock:
-            if self.paused:
-                self.paused = False
-                if self.alsa_pcm:
-                    try:
-                        self.alsa_pcm.pause(0)
-                    except alsaaudio.ALSAAudioError, e:
-                        self.log('error while resuming: {0}', e)
+        with self.cond:
+            if self.state == self.PAUSED:
+                self.state = self.RESUME
+                self.cond.notify_all()
+
+                # Accept any state after this, since we might stop
+                # while paused
+                while self.state == self.RESUME:
+                    self.cond.wait()
+            else:
+                self.log('alsa: resuming in invalid state: {0}', self.state)
 
 
     def stop(self):
-        with self.lock:
-            pcm = self.alsa_pcm
-            paused = self.paused
-            self.alsa_pcm = None
-            self.device_error = None
-            self.paused = False
-
-        # pyalsaaudio will drain the buffer on close, no way around that
-        if pcm:
-            try:
-                # And since it drains, it can't be paused
-                if paused:
-                    pcm.pause(0)
-                pcm.close()
-            except alsaaudio.ALSAAudioError, e:
-                self.log('PyAlsaSink.stop: error when closing: {0}'.format(e))
+        with self.cond:
+            if self.state != self.CLOSED:
+                self.state = self.CLOSING
+                self.cond.notify_all()
+
+            while self.state == self.CLOSING:
+                self.cond.wait()
 
 
     def start(self, channels, bytes_per_sample, rate, big_endian):
-        self.channels = channels
-        self.bytes_per_sample = bytes_per_sample
-        self.rate = rate
-        self.big_endian = big_endian
-        self.paused = False
-        self._try_open_pcm()
-
-
-    def add_packet(self, data, packet):
-        """Push data into the device.  To quickly(ish) react to
-        transport state changes we're not looping here, but rather
-        lets the sink thread do that.
+        if bytes_per_sample != 2:
+            raise sink.SinkError('only supports 2 bytes per sample, got {0}'
+                                 .format(bytes_per_sample))
+
+        with self.cond:
+            if self.state != self.CLOSED:
+                raise sink.SinkError('starting in invalid state: {0}'.format(self.state))
+
+            self.debug('alsa: starting sink')
+            self.state = self.STARTING
+            self.channels = channels
+            self.bytes_per_sample = bytes_per_sample
+            self.rate = rate
+            self.big_endian = big_endian
+            self.written_frames = 0
+            self.stats_counters.reset_fill()
+            self.cond.notify_all()
+
+
+    def add_packet(self, data, packet, offset = 0):
+        """Copy data, starting at offset, into the buffer.  Returns
+        when some data has been stored, or the playing packet or
+        device error has changed.
         """
 
+        if offset >= len(data):
+            raise ValueError('add_packet: offset out of range')
+
         stored = 0
+        playing_packet = self.prev_playing_packet
+        device_error = self.prev_device_error
 
-        if self.partial_period:
-            # Append to left-overs from last call
-            stored = min(self.period_bytes - len(self.partial_period), len(data))
+        while (stored == 0
+               and playing_packet is self.prev_playing_packet
+               and device_error == self.prev_device_error):
+            stored, playing_packet, device_error = self._playing_once(
+                data, packet, offset)
 
-            if stored > 0:
-                self.partial_period += str(buffer(data, 0, stored))
-            else:
-                assert stored == 0
+        self.prev_playing_packet = playing_packet
+        self.prev_device_error = device_error
 
-            packet = self.partial_packet
+        # stored is -1 when the sink has been stopped
+        return max(stored, 0), playing_packet, device_error
 
-            if len(self.partial_period) == self.period_bytes:
-                if self._play_period(self.partial_period):
-                    self.partial_period = None
-                    self.partial_packet = None
 
-        elif len(data) >= self.period_bytes:
-            # At least one whole period to push into the device
-            if self._play_period(buffer(data, 0, self.period_bytes)):
-                stored = self.period_bytes
+    def drain(self):
+        with self.cond:
+            if self.state == self.PLAYING:
+                self.debug('alsa: drain: switching to state draining')
+                self.state = self.DRAINING
+
+                # Zero out the end of the last period, if that one is
+                # only partially filled
+                partial = self.used % self.period_bytes
+                if partial > 0:
+                    pos = (self.read_pos + self.used) % self.buffer_size
+                    pad = self.period_bytes - partial
+                    self.buffer_view[pos : pos + pad] = bytearray(pad)
+                    self.used += pad
+
+                self.cond.notify_all()
+
+            elif self.state not in self.BUFFER_STATES:
+                # Already stopped
+                return None
 
-        else:
-            # Not enough data for a whole period, save it for the next call
-            assert len(data) < self.period_bytes
-            self.partial_period = str(data)
-            self.partial_packet = packet
-            stored = len(data)
+        stored = 0
+        playing_packet = self.prev_playing_packet
+        device_error = self.prev_device_error
 
-        return stored, packet, self.device_error
+        while (stored == 0
+               and playing_packet is self.prev_playing_packet
+               and device_error == self.prev_device_error):
+            stored, playing_packet, device_error = self._playing_once(
+                None, None, 0)
 
+        self.prev_playing_packet = playing_packet
+        self.prev_device_error = device_error
 
-    def drain(self):
-        if self.partial_period:
-            # Pad final packet and push into buffer
-            n = self.period_bytes - len(self.partial_period)
-            if n > 0:
-                self.partial_period = self.partial_period + ('\0' * n)
-
-            packet = self.partial_packet
-
-            if self._play_period(self.partial_period):
-                self.partial_period = None
-                self.partial_packet = None
-
-            # Always return here to ensure feedback on last packet.
-            # We'll get called again to drain properly after this.
-            return packet, self.device_error
-
-        # pyalsaaudio will (here usefully) drain before closing
-        with self.lock:
-            pcm = self.alsa_pcm
-            paused = self.paused
-            self.alsa_pcm = None
-            self.device_error = None
-            self.paused = False
+        if stored < 0:
+            # Now closed, tell Transport we're done
+            self.debug('alsa: drain: sink closed')
+            return None
+
+        return playing_packet, device_error
+
+
+    def played_frames(self):
+        # There's no way to get the device delay through pyalsaaudio,
+        # so this can be up to four periods ahead of what is heard
+        with self.cond:
+            return self.written_frames
+
+
+    def stats(self):
+        with self.cond:
+            return self.stats_counters.get_stats(self.buffer_size)
+
+
+    #
+    # Transport sink thread internals
+    #
+
+    def _playing_once(self, data, packet, offset):
+        """Store data (if not None) from offset in the buffer, waiting
+        for room if it is full.  Returns (stored, playing_packet,
+        device_error), where stored is -1 if the sink has stopped.
+        """
+
+        stored = 0
+        playing_packet = self.prev_playing_packet
+
+        with self.cond:
+            # Wait for the writer thread to open or close the device
+            if self.state in (self.STARTING, self.CLOSING):
+                self.cond.wait()
+
+            if self.state in self.BUFFER_STATES:
+                if data is not None:
+                    if self.used >= self.buffer_size:
+                        # Wait for more room in buffer
+                        self.cond.wait()
+
+                    if self.state in self.BUFFER_STATES and self.used < self.buffer_size:
+                        stored = self._store_data(data, packet, offset)
+                        self.cond.notify_all()
+                else:
+                    # Draining, so wait for updates to playing packet etc
+                    self.cond.wait()
+
+            if self.state not in self.BUFFER_STATES:
+                stored = -1
+
+            if self.used > 0:
+                playing_packet = self.packets[self.read_pos // self.period_bytes]
+
+            return stored, playing_packet, self.device_error
+
+
+    def _store_data(self, data, packet, offset):
+        """Copy as much data as fits into the buffer without wrapping
+        its end, returning the number of bytes stored.
+        """
+
+        write_pos = (self.read_pos + self.used) % self.buffer_size
+
+        stored = min(len(data) - offset,
+                     self.buffer_size - self.used,
+                     self.buffer_size - write_pos)
 
         try:
-            # Ensure we're not paused so this can drain
-            if paused:
-                pcm.pause(0)
-            pcm.close()
-        except alsaaudio.ALSAAudioError, e:
-            self.log('PyAlsaSink.drain: error when closing: {0}'.format(e))
+            src = memoryview(data)[offset : offset + stored]
+        except TypeError:
+            # Objects like mmaps only have the old buffer interface
+            src = buffer(data, offset, stored)
 
-        return None
+        self.buffer_view[write_pos : write_pos + stored] = src
+        self.used += stored
 
+        # Map the periods to this packet, always at least one even
+        # if less than a period was stored
+        first_period = write_pos // self.period_bytes
+        last_period = max((write_pos + stored) // self.period_bytes, first_period + 1)
+        for i in xrange(first_period, last_period):
+            self.packets[i] = packet
 
-    def _play_period(self, data):
-        with self.lock:
-            pcm = self.alsa_pcm
+        return stored
 
-        if pcm is None:
-            pcm = self._try_open_pcm()
-            if pcm is None:
-                # Don't busyloop here
-                time.sleep(3)
-                return False
 
+    #
+    # Writer thread
+    #
+
+    def _writer_loop(self):
+        with self.cond:
+            while True:
+                if self.state in (self.STARTING, self.PLAYING):
+                    self._play_once()
+
+                elif self.state == self.PAUSING:
+                    self._pause()
+
+                elif self.state == self.RESUME:
+                    self._resume()
+
+                elif self.state == self.DRAINING and self.used > 0:
+                    self._play_once()
+
+                elif self.state in (self.DRAINING, self.CLOSING):
+                    self._close_device(drain = self.state == self.DRAINING)
+
+                    self.state = self.CLOSED
+                    self.device_error = None
+                    self.read_pos = 0
+                    self.used = 0
+                    self.cond.notify_all()
+
+                else:
+                    # CLOSED or PAUSED, wait for something to happen
+                    self.cond.wait()
+
+
+    def _play_once(self):
+        if self.alsa_pcm is None:
+            if not self._open_device():
+                return
+
+        if self.used < self.period_bytes:
+            # Wait for data - we can block here as long as needed
+            self.cond.wait()
+            return
+
+        pos = self.read_pos
+
+        self.stats_counters.record_fill(self.used)
+
+        # pyalsaaudio only takes objects with the old buffer
+        # interface, but buffer() doesn't copy the data either
         if self.alsa_swap_bytes:
-            # Heavy-handed assumptions about data formats etc
-            a = array.array('h', str(data))
-            assert a.itemsize == 2
-            a.byteswap()
-            data = a.tostring()
+            start = time.time()
+            self._swap_bytes(pos)
+            self.stats_counters.record_swap(time.time() - start, self.period_bytes)
+            period = buffer(self.swap_buffer)
+        else:
+            period = buffer(self.buffer, pos, self.period_bytes)
 
+        pcm = self.alsa_pcm
+
+        # Let the Transport keep filling the buffer while writing.
+        # The period being played stays in place, since it is still
+        # counted as used, and only this thread moves the data.
+        self.cond.release()
         try:
-            n = pcm.write(data)
-            return n > 0
+            start = time.time()
+            n = pcm.write(period)
+            end = time.time()
+            error = None
         except alsaaudio.ALSAAudioError, e:
-            self.log('alsa: error writing to device: {0}', e)
-            self.device_error = str(e)
+            error = e
+        finally:
+            self.cond.acquire()
+
+        if error is not None:
+            self.log('alsa: error writing to device: {0}', error)
+            self.device_error = str(error)
+            self.stats_counters.write_errors += 1
+            self.cond.notify_all()
+            self._close_device(drain = False)
+
+        elif n > 0:
+            self.stats_counters.record_write(end - start)
+            self.read_pos = (pos + self.period_bytes) % self.buffer_size
+            self.used -= self.period_bytes
+            self.written_frames += n
+            self.cond.notify_all()
+
+
+    def _swap_bytes(self, pos):
+        """Copy the period at POS into swap_buffer, swapping the byte
+        order of the samples.
+        """
+
+        if self.swap_array is not None:
+            # NumPy views, so the copy and swap don't allocate anything
+            first = pos // 2
+            self.swap_array[:] = self.buffer_array[first : first + self.period_bytes // 2]
+            self.swap_array.byteswap(True)
+        else:
+            a = array.array('h')
+            a.fromstring(buffer(self.buffer, pos, self.period_bytes))
+            a.byteswap()
+            self.swap_view[:] = buffer(a)
 
-            with self.lock:
-                self.alsa_pcm = None
 
+    def _pause(self):
+        if self.alsa_pcm:
             try:
-                pcm.close()
+                self.alsa_pcm.pause(1)
             except alsaaudio.ALSAAudioError, e:
-                self.log('alsa: ignoring error when closing after write failure: {0}', e)
+                self.log('alsa: error while pausing: {0}', e)
+
+        # Even if pausing fails, go into PAUSED since the music will
+        # stop at this point anyway
+        self.state = self.PAUSED
+        self.cond.notify_all()
+
+
+    def _resume(self):
+        if self.alsa_pcm:
+            try:
+                self.alsa_pcm.pause(0)
+            except alsaaudio.ALSAAudioError, e:
+                # Reopen the device when playing the next period
+                self.log('alsa: error while resuming: {0}', e)
+                self._close_device(drain = False)
+
+        self.state = self.paused_in_state
+        self.cond.notify_all()
+
+
+    def _open_device(self):
+        """Open and set up the device, and the buffer if the period
+        size changes.  Returns True if successful.  On errors the
+        lock is released to wait a while before trying again.
+        """
+
+        starting = self.state == self.STARTING
+        channels = self.channels
+        rate = self.rate
+        big_endian = self.big_endian
+
+        self.cond.release()
+        try:
+            pcm, period_frames = self._open_pcm(channels, rate, big_endian)
+        finally:
+            self.cond.acquire()
+
+        if pcm is None:
+            self.cond.notify_all()
 
+            # Wait a while to avoid busy-looping on a bad device,
+            # unless the sink is stopped meanwhile
+            deadline = time.time() + self.REOPEN_DELAY
+            while self.state in (self.STARTING, self.PLAYING, self.DRAINING):
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                self.cond.wait(timeout)
+
+            return False
+
+        if self.state not in (self.STARTING, self.PLAYING, self.DRAINING):
+            # Stopped or paused while opening, so let the loop deal with that
+            self.alsa_pcm = pcm
             return False
 
+        period_bytes = period_frames * channels * self.bytes_per_sample
+        if period_bytes != self.period_bytes or self.buffer is None:
+            # It's OK to discard anything in the buffer, since that
+            # is anyway now the wrong format.
+            buffer_frames = rate * self.buffer_seconds
+            buffer_frames -= buffer_frames % period_frames
+            self.buffer_size = max(buffer_frames // period_frames, 1) * period_bytes
+            self.period_bytes = period_bytes
+            self.buffer = bytearray(self.buffer_size)
+            self.buffer_view = memoryview(self.buffer)
+            self.packets = [None] * (self.buffer_size // period_bytes)
+            self.read_pos = 0
+            self.used = 0
+
+            self.swap_buffer = bytearray(period_bytes)
+            self.swap_view = memoryview(self.swap_buffer)
+
+            if numpy is not None:
+                self.buffer_array = numpy.frombuffer(self.buffer, dtype = numpy.int16)
+                self.swap_array = numpy.frombuffer(self.swap_buffer, dtype = numpy.int16)
+
+        self.alsa_pcm = pcm
+        self.device_error = None
+
+        if starting:
+            self.debug('alsa: opened device: {0}',
+                       'swapping bytes' if self.alsa_swap_bytes else 'not swapping bytes')
+            # Now the transport thread can put frames into the buffer
+            self.state = self.PLAYING
+        else:
+            self.log('alsa: reopened device')
+
+        self.cond.notify_all()
+        return True
+
 
-    def _try_open_pcm(self):
+    def _close_device(self, drain):
+        pcm = self.alsa_pcm
+        self.alsa_pcm = None
+
+        if pcm is None:
+            return
+
+        self.debug('alsa: closing device: {0}', 'draining' if drain else 'dropping')
+
+        self.cond.release()
+        try:
+            # pyalsaaudio drains the buffer on close, but newer
+            # versions can drop it first
+            if not drain and hasattr(pcm, 'drop'):
+                pcm.drop()
+            pcm.close()
+        except alsaaudio.ALSAAudioError, e:
+            self.log('alsa: error when closing: {0}', e)
+        finally:
+            self.cond.acquire()
+
+
+    def _open_pcm(self, channels, rate, big_endian):
+        """Open the device and set the format.  Called without holding
+        the lock.  Returns (pcm, period_frames), or (None, None) on
+        errors, which are recorded in self.device_error.
+        """
         try:
             pcm = alsaaudio.PCM(type = alsaaudio.PCM_PLAYBACK,
                                 mode = alsaaudio.PCM_NORMAL,
@@ -251,28 +604,24 @@ class PyAlsaSink(sink.Sink):
         except alsaaudio.ALSAAudioError, e:
             self.log('alsa: error opening card {0}: {1}',
                      self.alsa_card, e)
-            return None
+            self._set_device_error(str(e))
+            return None, None
 
-        if self._set_device_format(pcm):
-            if self.paused:
-                # Reopen into the right state
-                try:
-                    pcm.pause(1)
-                except alsaaudio.ALSAAudioError, e:
-                    self.log('error while trying to pause newly opened device: {0}', e)
-                    pcm.close()
-                    pcm = None
-
-            with self.lock:
-                self.alsa_pcm = pcm
-            return pcm
-        else:
+        period_frames = self._set_device_format(pcm, channels, rate, big_endian)
+        if period_frames is None:
             pcm.close()
-            return None
+            return None, None
 
+        return pcm, period_frames
 
-    def _set_device_format(self, pcm):
-        if self.big_endian:
+
+    def _set_device_error(self, error):
+        with self.cond:
+            self.device_error = error
+
+
+    def _set_device_format(self, pcm, channels, rate, big_endian):
+        if big_endian:
             format = alsaaudio.PCM_FORMAT_S16_BE
         else:
             format = alsaaudio.PCM_FORMAT_S16_LE
@@ -297,33 +646,30 @@ class PyAlsaSink(sink.Sink):
                 v = pcm.setformat(format)
                 if v != format:
                     self.log("alsa: can't set S16_BE/S16_LE format, card stuck on {0}", v)
-                    self.device_error = "sample format not accepted"
-                    return False
+                    self._set_device_error("sample format not accepted")
+                    return None
 
 
-            v = pcm.setrate(self.rate)
-            if v != self.rate:
-                self.log("alsa: can't set rate to {0}, card stuck on {1}", self.rate, v)
-                self.device_error = "sample format not accepted"
-                return False
+            v = pcm.setrate(rate)
+            if v != rate:
+                self.log("alsa: can't set rate to {0}, card stuck on {1}", rate, v)
+                self._set_device_error("sample format not accepted")
+                return None
 
-            v = pcm.setchannels(self.channels)
-            if v != self.channels:
-                self.log("alsa: can't set channels to {0}, card stuck on {1}", self.channels, v)
-                self.device_error = "sample format not accepted"
-                return False
+            v = pcm.setchannels(channels)
+            if v != channels:
+                self.log("alsa: can't set channels to {0}, card stuck on {1}", channels, v)
+                self._set_device_error("sample format not accepted")
+                return None
 
-            v = pcm.setperiodsize(self.PERIOD_SIZE)
-            if v != self.PERIOD_SIZE:
+            v = pcm.setperiodsize(self.period_size)
+            if v != self.period_size:
                 self.log('alsa: card refused our period size of {0}, using {1} instead',
-                         self.PERIOD_SIZE, v)
+                         self.period_size, v)
 
-            self.period_bytes = v * self.channels * self.bytes_per_sample
-            return True
+            return v
 
         except alsaaudio.ALSAAudioError, e:
             self.log('alsa: error setting format: {0}', e)
-            self.device_error = str(e)
-            return False
-
-
+            self._set_device_error(str(e))
+            return None
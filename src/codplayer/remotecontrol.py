@@ -19,6 +19,8 @@ class RemoteControl(codaemon.Plugin):
         ('PAUSE', 'pause'),
         ('PREVIOUS', 'prev'),
         ('NEXT', 'next'),
+        ('REWIND', 'rew'),
+        ('FASTFORWARD', 'ff'),
         ('STOP', 'stop'),
         ('EJECT', 'eject'),
     )
@@ -127,12 +127,8 @@ class RemotePlayer(object):
                 self._cfg.state, io_loop=self._daemon.io_loop,
                 on_state=self._on_state,
                 on_rip_state=self._on_rip_state,
-                on_disc=self._on_disc)
-
-            # Fetch info immediately
-            self.call('state', on_response=self._on_state)
-            self.call('rip_state', on_response=self._on_rip_state)
-            self.call('source', on_response=self._on_disc)
+                on_disc=self._on_disc,
+                rpc_channel=self._cfg.player_rpc)
 
         else:
             connection.send({
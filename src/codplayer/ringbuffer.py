@@ -0,0 +1,225 @@
+# codplayer - transport buffer between the source and sink threads
+#
+# Copyright 2014 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+"""
+A preallocated ring buffer of audio data, used by the Transport to
+pass packets from the source thread to the sink thread.
+"""
+
+import threading
+import collections
+
+
+class PacketRingBuffer(object):
+    """Ring buffer holding the data of audio packets in a single
+    bytearray, with the packets themselves kept in a side table.
+
+    The source thread put()s packets into the buffer, which copies
+    their data into the ring and points packet.data at that copy.
+    Packets whose data is shared and never changes, such as silence
+    or views into a memory-mapped file, can be put() with copy=False
+    to be passed through without using any ring space.  Objects
+    without a data attribute (such as the end of stream marker) are
+    also passed through as they are.
+
+    The sink thread get()s one packet at a time, and must release()
+    it when done with the data.  Until then the packet data stays
+    valid, even if the buffer is flushed.
+
+    Each put() is tagged with the transport context.  flush() drops
+    all buffered packets in one go when the context changes, and
+    makes any put() for an older context return immediately.
+
+    The buffer can be resize()d at any time.  New packets are then
+    written to a new bytearray, while the old one is kept alive by the
+    packets still referring to it.
+    """
+
+    def __init__(self, size, max_packets):
+        self.size = size
+        self.max_packets = max_packets
+        self.data = bytearray(size)
+
+        self.lock = threading.Lock()
+        self.space_available = threading.Condition(self.lock)
+        self.packet_available = threading.Condition(self.lock)
+
+        # The following members can only be accessed when holding the lock
+        self.context = 0
+
+        # Entries: (packet, end_pos, used_bytes, data), where
+        # used_bytes includes any space skipped at the end of the ring
+        # to keep the packet data contiguous, and data is the
+        # bytearray holding the packet data
+        self.entries = collections.deque()
+        self.held = None
+        self.write_pos = 0
+        self.used_bytes = 0
+
+
+    def fill_level(self):
+        """Return a tuple (packets, bytes) of the buffered data."""
+        with self.lock:
+            return len(self.entries), self.used_bytes
+
+
+    def resize(self, size, max_packets):
+        """Change the buffer to hold SIZE bytes in MAX_PACKETS packets.
+        """
+        with self.lock:
+            if size == self.size and max_packets == self.max_packets:
+                return
+
+            if size != self.size:
+                self.size = size
+                self.data = bytearray(size)
+                self.write_pos = 0
+                self.used_bytes = 0
+
+            self.max_packets = max_packets
+            self.space_available.notify_all()
+
+
+    def flush(self, context):
+        """Drop all buffered packets and switch to CONTEXT.  This
+        will wake up any put() call blocked on a full buffer.
+        """
+        with self.lock:
+            self.context = context
+            self.entries = collections.deque()
+
+            if self.held and self.held[3] is self.data:
+                packet, self.write_pos, self.used_bytes, data = self.held
+            else:
+                self.write_pos = 0
+                self.used_bytes = 0
+
+            self.space_available.notify_all()
+
+
+    def put(self, packet, context, copy = True):
+        """Add PACKET to the buffer, waiting for space if necessary.
+        If COPY is False the packet data is not copied into the ring.
+
+        Returns True if added, or False if the buffer has been
+        flushed for a context newer than CONTEXT.
+        """
+
+        data = getattr(packet, 'data', None) if copy else None
+        length = len(data) if data is not None else 0
+
+        if length > self.size:
+            raise ValueError('packet larger than ring buffer: {0} bytes'.format(length))
+
+        with self.lock:
+            while True:
+                if context != self.context:
+                    return False
+
+                start = self.write_pos
+                skipped = 0
+                if start + length > self.size:
+                    # Keep packet data contiguous by wrapping early
+                    skipped = self.size - start
+                    start = 0
+
+                if (len(self.entries) < self.max_packets
+                    and self.size - self.used_bytes >= skipped + length):
+                    break
+
+                self.space_available.wait()
+
+            end = start + length
+            if data is not None:
+                self.data[start:end] = data
+                packet.data = buffer(self.data, start, length)
+
+            self.entries.append((packet, end, skipped + length, self.data))
+            self.write_pos = end
+            self.used_bytes += skipped + length
+
+            self.packet_available.notify()
+            return True
+
+
+    def get(self):
+        """Return the oldest packet in the buffer, waiting for one if
+        necessary.  Must be followed by a call to release() before
+        calling get() again.
+        """
+        with self.lock:
+            assert self.held is None, 'previous packet not released'
+
+            while not self.entries:
+                self.packet_available.wait()
+
+            self.held = self.entries.popleft()
+            return self.held[0]
+
+
+    def release(self, packet):
+        """Release PACKET returned by get(), freeing its data space.
+        """
+        with self.lock:
+            assert self.held and self.held[0] is packet, 'releasing wrong packet'
+
+            # Data in an old array doesn't use any space in the current one
+            if self.held[3] is self.data:
+                self.used_bytes -= self.held[2]
+            self.held = None
+
+            if self.used_bytes == 0:
+                # Start over at the beginning to keep the space contiguous
+                self.write_pos = 0
+
+            self.space_available.notify_all()
+
+
+class AdaptiveBufferSize(object):
+    """Decide how many seconds the transport buffer should hold,
+    based on how long the source takes to read packets.
+
+    The buffer grows as soon as a read is slow compared to the
+    current size, and is shrunk again step by step after a while
+    without any slow reads.
+    """
+
+    # The buffer should hold this many times the slowest read
+    SAFETY_FACTOR = 4
+
+    # Seconds without slow reads before shrinking the buffer
+    SHRINK_DELAY = 300
+
+    def __init__(self, min_secs, max_secs, now):
+        self.min_secs = min_secs
+        self.max_secs = max_secs
+        self.secs = min_secs
+        self.last_slow_read = now
+
+
+    def update(self, read_secs, now):
+        """Update with the READ_SECS taken to read a packet at time
+        NOW.  Returns the new buffer size in seconds if it should be
+        changed, otherwise None.
+        """
+
+        needed = read_secs * self.SAFETY_FACTOR
+
+        if needed > self.secs and self.secs < self.max_secs:
+            self.secs = min(self.max_secs, max(2 * self.secs, int(needed + 1)))
+            self.last_slow_read = now
+            return self.secs
+
+        # A read is still slow if it wouldn't fit a halved buffer
+        if 2 * needed > self.secs:
+            self.last_slow_read = now
+
+        elif now - self.last_slow_read > self.SHRINK_DELAY and self.secs > self.min_secs:
+            self.secs = max(self.min_secs, self.secs / 2)
+            self.last_slow_read = now
+            return self.secs
+
+        return None
@@ -22,6 +22,9 @@ class Ripper(object):
     """Class controlling the process of ripping a disc into the database.
     """
 
+    # Seconds between updates of the audio ripping progress
+    PROGRESS_INTERVAL = 1
+
     def __init__(self, player):
         self.player = player
         self.cfg = player.cfg
@@ -43,6 +46,10 @@ class Ripper(object):
         self.current_task = None
         self.current_process = None
 
+        # Seconds until the current task wants to be ticked again, or
+        # None if only when the current process exits
+        self.tick_interval = None
+
     def read_disc(self):
         """Read a physical disc and return a model.DbDisc instance
         representing it.
@@ -70,6 +77,7 @@ class Ripper(object):
             # This is new, so create it from the basic TOC we
             # got from mb2_disc
             disc = new_disc
+            disc.audio_format = self.get_rip_audio_format()
             self.log('ripping new disc: {}', disc)
             self.db.create_disc(disc)
             self.tasks = [self.rip_audio, self.rip_toc]
@@ -82,6 +90,7 @@ class Ripper(object):
 
                 self.log('re-ripping {}', disc)
                 toc.merge_basic_toc(disc, new_disc)
+                disc.audio_format = self.get_rip_audio_format()
                 self.db.save_disc_info(disc)
                 self.tasks = [self.rip_audio, self.rip_toc]
 
@@ -99,9 +108,18 @@ class Ripper(object):
         return disc
 
 
+    def get_rip_audio_format(self):
+        if self.cfg.rip_little_endian:
+            return model.PCM_LE
+        else:
+            return model.PCM
+
+
     def tick(self):
-        """Called by the main process to check on ripping progress.
-        The ripper returns True as long as it is still running.
+        """Called by the main process to check on ripping progress,
+        when the current process has exited or after tick_interval
+        seconds.  The ripper returns True as long as it is still
+        running.
         """
 
         try:
@@ -116,7 +134,7 @@ class Ripper(object):
                 self.current_task = self.tasks[0]()
                 del self.tasks[0]
 
-            self.current_task.next()
+            self.tick_interval = self.current_task.next()
             return True
 
         except StopIteration:
@@ -137,10 +155,11 @@ class Ripper(object):
         """
         # Drop any pending tasks
         self.tasks = []
-        if self.current_process:
+        if self.current_process and self.current_process.poll() is None:
             self.log('killing rip process {} on stop from player',
                      self.current_process.pid)
             self.current_process.terminate()
+            self.current_process.wait()
 
         while self.tick():
             time.sleep(1)
@@ -156,8 +175,12 @@ class Ripper(object):
         span = '-{}'.format(len(self.disc.tracks))
 
         args = [self.cfg.cdparanoia_command,
-                '--force-cdrom-device', self.cfg.cdrom_device,
-                '--output-raw-big-endian']
+                '--force-cdrom-device', self.cfg.cdrom_device]
+
+        if self.disc.audio_format.big_endian:
+            args.append('--output-raw-big-endian')
+        else:
+            args.append('--output-raw-little-endian')
 
         if self.cfg.cdrom_read_speed:
             args += ['--force-read-speed', str(self.cfg.cdrom_read_speed)]
@@ -186,8 +209,8 @@ class Ripper(object):
                     self.state.progress = progress
                     self.update_state(log_state = False)
 
-                # Keep going
-                yield
+                # Keep going, checking the progress again in a while
+                yield self.PROGRESS_INTERVAL
             else:
                 break
 
@@ -237,8 +260,8 @@ class Ripper(object):
         while True:
             rc = toc_process.poll()
             if rc is None:
-                # Still in progress, keep going
-                yield
+                # Still in progress, wait for the process to exit
+                yield None
             else:
                 break
 
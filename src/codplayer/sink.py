@@ -10,9 +10,140 @@ Classes implementing various audio packet sinks.
 
 import time
 import threading
+import collections
 
 class SinkError(Exception): pass
 
+# Upper limits of the write latency histogram buckets in stats, with
+# an additional last bucket (limit None) for slower writes
+WRITE_LATENCY_LIMITS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class SinkStats(object):
+    """Performance counters for sink implementations written in
+    Python, reported in the same format as CAlsaSink.stats().
+
+    Counters that the implementation can't measure are reported as
+    None.  The buffer fill is measured since the last reset_fill(),
+    typically called on start(), the other counters for the life of
+    the sink.
+    """
+
+    def __init__(self, xruns = None, recovers = None):
+        self.periods_written = 0
+        self.xruns = xruns
+        self.recovers = recovers
+        self.write_errors = 0
+        self.write_seconds = 0.0
+        self.write_max_seconds = 0.0
+        self.write_latency = [0] * (len(WRITE_LATENCY_LIMITS_MS) + 1)
+        self.swap_seconds = 0.0
+        self.swap_bytes = 0
+        self.reset_fill()
+
+    def reset_fill(self):
+        self.fill_min = None
+        self.fill_max = None
+        self.fill_sum = 0
+        self.fill_samples = 0
+
+    def record_fill(self, used):
+        """Record that the buffer held USED bytes before a write."""
+        if self.fill_samples == 0 or used < self.fill_min:
+            self.fill_min = used
+        if used > self.fill_max:
+            self.fill_max = used
+        self.fill_sum += used
+        self.fill_samples += 1
+
+    def record_write(self, seconds):
+        """Record a period written to the device in SECONDS."""
+        self.periods_written += 1
+        self.write_seconds += seconds
+        self.write_max_seconds = max(self.write_max_seconds, seconds)
+
+        ms = seconds * 1000
+        for i, limit in enumerate(WRITE_LATENCY_LIMITS_MS):
+            if ms < limit:
+                break
+        else:
+            i = len(WRITE_LATENCY_LIMITS_MS)
+
+        self.write_latency[i] += 1
+
+    def record_swap(self, seconds, length):
+        self.swap_seconds += seconds
+        self.swap_bytes += length
+
+    def get_stats(self, buffer_size):
+        limits = WRITE_LATENCY_LIMITS_MS + (None, )
+        if self.fill_samples:
+            fill_avg = float(self.fill_sum) / self.fill_samples
+        else:
+            fill_avg = None
+
+        return {
+            'periods_written': self.periods_written,
+            'xruns': self.xruns,
+            'recovers': self.recovers,
+            'write_errors': self.write_errors,
+            'write_seconds': self.write_seconds,
+            'write_max_seconds': self.write_max_seconds,
+            'write_latency_ms': zip(limits, self.write_latency),
+            'buffer_size': buffer_size,
+            'buffer_fill_min': self.fill_min,
+            'buffer_fill_max': self.fill_max,
+            'buffer_fill_avg': fill_avg,
+            'swap_seconds': self.swap_seconds,
+            'swap_bytes': self.swap_bytes,
+            }
+
+
+class StreamPackets(object):
+    """Track where each packet starts in the stream of bytes added
+    to a sink since it was started, to map a count of played frames
+    back to a packet and a frame offset into it.
+    """
+
+    def __init__(self):
+        # Entries: (stream_pos, packet)
+        self.packets = collections.deque()
+        self.stream_pos = 0
+        self.frame_size = 0
+
+    def reset(self, frame_size):
+        self.packets.clear()
+        self.stream_pos = 0
+        self.frame_size = frame_size
+
+    def add(self, packet, start, end):
+        """Record that bytes START to END of PACKET has been added to
+        the stream.
+        """
+        if start == 0 and end > 0:
+            self.packets.append((self.stream_pos, packet))
+        self.stream_pos += end - start
+
+    def find(self, played_frames):
+        """Return (packet, frame_offset) for PLAYED_FRAMES into the
+        stream, or None if unknown.
+        """
+        if not self.packets:
+            return None
+
+        played = played_frames * self.frame_size
+
+        # Forget packets that have been played completely
+        while len(self.packets) > 1 and self.packets[1][0] <= played:
+            self.packets.popleft()
+
+        start, packet = self.packets[0]
+        if played < start:
+            return None
+
+        return packet, min((played - start) / self.frame_size, packet.length - 1)
+
+
 class Sink(object):
     """Abstract base class for audio sinks (i.e. typically sound devices).
     """
@@ -71,6 +202,28 @@ class Sink(object):
         raise NotImplementedError()
 
 
+    def add_packets(self, packets, offset):
+        """Add the data of a sequence of packets to the sink, starting
+        at offset in the first packet.  Sinks that can add several
+        packets in one go without returning to the Transport should
+        override this, the default just calls add_packet() once.
+
+        Returns (packets_done, offset, current_packet, error), where:
+          packets_done: number of packets that have been stored completely
+          offset: how far into the next packet data has been stored
+          current_packet: current packet being played by the sink
+          error: any current sink error, or None
+
+        This method is only called from the Transport sink thread.
+        """
+        stored, current_packet, error = self.add_packet(packets[0], offset)
+        offset += stored
+        if offset >= len(packets[0].data):
+            return 1, 0, current_packet, error
+        else:
+            return 0, offset, current_packet, error
+
+
     def drain(self):
         """Drain any data buffered in the sink.
 
@@ -86,6 +239,45 @@ class Sink(object):
         return None
 
 
+    def get_playing_offset(self):
+        """Return the position currently heard from the device, taking
+        its buffer delay into account.
+
+        Returns (packet, frame_offset), where frame_offset is the
+        number of frames into packet, or None if the sink can't tell.
+        In that case the current_packet returned by add_packet() and
+        drain() is used as the playing position.
+
+        This method is only called from the Transport sink thread.
+        """
+        return None
+
+
+    def get_stats(self):
+        """Return a dict of performance counters, or None if the sink
+        doesn't keep any.  The keys are:
+
+          periods_written: periods written to the device
+          xruns: device buffer underruns
+          recovers: calls to recover the device after an error
+          write_errors: writes that failed even after recovering
+          write_seconds: total time spent writing to the device
+          write_max_seconds: slowest single write
+          write_latency_ms: histogram of write times, as a list of
+            (limit_ms, count), where the last limit is None
+          buffer_size: bytes in the sink buffer
+          buffer_fill_min/max/avg: bytes in the sink buffer before
+            each write since the sink was started
+          swap_seconds: total time spent swapping the byte order
+          swap_bytes: bytes swapped
+
+        Counters the sink can't measure are None.
+
+        This method may be called from any thread.
+        """
+        return None
+
+
 class FileSink(Sink):
     """A simple sink to a file, mainly for testing purposes.
     """
@@ -137,6 +329,10 @@ class AlsaSink(Sink):
     """ALSA sink, relying on a C or Python implementation behind it.
     It unpacks the objects passed in somewhat to make the C
     implementation simpler.
+
+    Packet data can be any object supporting the buffer interface
+    (strings, buffers, bytearrays, mmaps, memoryviews), and is passed
+    to the implementation as it is, without copying it.
     """
 
     def __init__(self, player):
@@ -149,7 +345,28 @@ class AlsaSink(Sink):
         self.impl = AlsaSinkImpl(player,
                                  player.cfg.alsa_card,
                                  player.cfg.start_without_device,
-                                 player.cfg.log_performance)
+                                 player.cfg.log_performance,
+                                 player.cfg.alsa_keep_open_seconds,
+                                 player.cfg.alsa_period_frames,
+                                 player.cfg.alsa_buffer_seconds,
+                                 player.cfg.alsa_mmap)
+
+        # Silent packets can be written without touching their data
+        # if supported by the implementation
+        self.add_silence = getattr(self.impl, 'add_silence', None)
+
+        # Batches of packets can be added in one call, if supported
+        # by the implementation
+        self.impl_add_packets = getattr(self.impl, 'add_packets', None)
+
+        # Frames heard from the device, if supported by the implementation
+        self.played_frames = getattr(self.impl, 'played_frames', None)
+
+        # Performance counters, if supported by the implementation
+        self.impl_stats = getattr(self.impl, 'stats', None)
+
+        # Map played_frames() back to a packet
+        self.stream = StreamPackets()
 
         if hasattr(self.impl, 'log_helper'):
             # Kick off a thread that helps the C thread to log through
@@ -168,16 +385,542 @@ class AlsaSink(Sink):
         self.impl.stop()
 
     def start(self, format):
+        self.stream.reset(format.channels * format.bytes_per_sample)
         self.impl.start(format.channels, format.bytes_per_sample, format.rate, format.big_endian)
 
     def add_packet(self, packet, offset):
-        return self.impl.add_packet(buffer(packet.data, offset), packet)
+        if packet.file_pos is None and self.add_silence:
+            res = self.add_silence(len(packet.data) - offset, packet)
+        else:
+            res = self.impl.add_packet(packet.data, packet, offset)
+
+        if self.played_frames:
+            self.stream.add(packet, offset, offset + res[0])
+        return res
+
+    def add_packets(self, packets, offset):
+        if not self.impl_add_packets:
+            return super(AlsaSink, self).add_packets(packets, offset)
+
+        res = self.impl_add_packets(packets, offset)
+
+        if self.played_frames:
+            done, end_offset = res[0], res[1]
+            for i, packet in enumerate(packets[:done + 1]):
+                start = offset if i == 0 else 0
+                end = len(packet.data) if i < done else end_offset
+                self.stream.add(packet, start, end)
+
+        return res
 
     def drain(self):
         return self.impl.drain()
 
+    def get_playing_offset(self):
+        if not self.played_frames:
+            return None
+
+        return self.stream.find(self.played_frames())
+
+    def get_stats(self):
+        if self.impl_stats:
+            return self.impl_stats()
+        return None
+
+
+def network_sink(protocol):
+    def create(player, address = None):
+        # Imported here since netsink depends on this module
+        from .netsink import NetworkSink
+        return NetworkSink(player, protocol, address)
+    return create
+
+
+class FanoutPacket(object):
+    """A packet queued in the fanout outputs, holding a copy of the
+    data since the Transport may reuse the packet data as soon as
+    add_packet() returns.  Other attributes are those of the original
+    packet.
+    """
+
+    __slots__ = ('packet', 'data')
+
+    def __init__(self, packet):
+        self.packet = packet
+
+        # Strings never change, while anything else may be a view
+        # into the Transport ring buffer
+        if isinstance(packet.data, str):
+            self.data = packet.data
+        else:
+            self.data = str(packet.data)
+
+    def __getattr__(self, name):
+        return getattr(self.packet, name)
+
+
+def original_packet(packet):
+    """Return the Transport packet for a packet reported by a
+    fanout output sink.
+    """
+    if isinstance(packet, FanoutPacket):
+        return packet.packet
+    return packet
+
+
+class FanoutOutput(object):
+    """One of the sinks fed by a FanoutSink, with a thread feeding
+    it from a queue of packets.  All state is protected by the
+    FanoutSink condition.
+    """
+
+    def __init__(self, fanout, device, sink):
+        self.fanout = fanout
+        self.device = device
+        self.sink = sink
+
+        # Serialises start(), stop(), pause() and resume() on the sink
+        self.control_lock = threading.Lock()
+
+        # Entries: (packet, offset)
+        self.packets = collections.deque()
+        self.queued_bytes = 0
+
+        self.started = False
+        self.drained = False
+        self.detached = False
+        self.lag_paused = False
+
+        self.current_packet = None
+        self.playing_offset = None
+        self.error = None
+
+        self.dropped_bytes = 0
+        self.lag_pauses = 0
+        self.detaches = 0
+
+        t = threading.Thread(target = self.run, name = 'fanout {0}'.format(device))
+        t.daemon = True
+        t.start()
+
+
+    def reset(self):
+        self.packets.clear()
+        self.queued_bytes = 0
+        self.started = False
+        self.drained = False
+        self.detached = False
+        self.lag_paused = False
+        self.current_packet = None
+        self.playing_offset = None
+        self.error = None
+
+
+    def run(self):
+        fanout = self.fanout
+        cond = fanout.cond
+
+        while True:
+            with cond:
+                while True:
+                    generation = fanout.generation
+                    format = fanout.format
+                    if format is not None and not self.detached:
+                        if not self.started or self.packets:
+                            break
+                        if fanout.draining and not self.drained:
+                            break
+                    cond.wait()
+
+                packet = None
+                if self.started and self.packets:
+                    packet, offset = self.packets[0]
+
+            if not self.started:
+                with self.control_lock:
+                    if generation != fanout.generation:
+                        continue
+                    self.sink.start(format)
+                    self.started = True
+
+            elif packet:
+                stored, current_packet, error = self.sink.add_packet(packet, offset)
+                playing_offset = self.sink.get_playing_offset()
+
+                with cond:
+                    if generation != fanout.generation or not self.packets:
+                        continue
+
+                    self.update_position(current_packet, playing_offset, error)
+
+                    if self.packets[0][0] is packet:
+                        offset += stored
+                        self.queued_bytes -= stored
+                        if offset >= len(packet.data):
+                            self.packets.popleft()
+                        else:
+                            self.packets[0] = (packet, offset)
+
+                    cond.notify_all()
+
+            else:
+                res = self.sink.drain()
+                playing_offset = self.sink.get_playing_offset()
+
+                with cond:
+                    if generation != fanout.generation:
+                        continue
+
+                    if res is None:
+                        self.drained = True
+                    else:
+                        self.update_position(res[0], playing_offset, res[1])
+
+                    cond.notify_all()
+
+
+    def update_position(self, current_packet, playing_offset, error):
+        if current_packet:
+            self.current_packet = original_packet(current_packet)
+        if playing_offset:
+            packet, frame_offset = playing_offset
+            self.playing_offset = (original_packet(packet), frame_offset)
+        self.error = error
+
+
+class FanoutSink(Sink):
+    """Play the same audio on several sinks, e.g. the local sound
+    card and network receivers in other rooms.
+
+    Each output has its own queue of up to fanout_buffer_seconds of
+    audio, fed to the sink by a separate thread, so a slow output
+    doesn't hold up the others until its queue is full.  An output
+    whose queue holds more than fanout_max_lag_seconds more than the
+    emptiest queue has fallen behind, and is handled according to
+    fanout_lag_policy:
+
+      drop: drop queued audio from the output so it catches up
+      pause: pause the other outputs until it has caught up
+      detach: stop the output until playing is restarted, e.g. when
+        skipping to another track or disc
+
+    The first output that isn't detached provides the playing
+    position.
+    """
+
+    POLICIES = ('drop', 'pause', 'detach')
+
+    # Seconds to wait for room in the queues before returning to the
+    # Transport
+    QUEUE_WAIT = 0.5
+
+    def __init__(self, player):
+        cfg = player.cfg
+        if cfg.fanout_lag_policy not in self.POLICIES:
+            raise SinkError('fanout_lag_policy must be one of: {0}'.format(
+                    ', '.join(self.POLICIES)))
+
+        if not cfg.fanout_devices:
+            raise SinkError('fanout_devices must list at least one device')
+
+        if cfg.fanout_max_lag_seconds >= cfg.fanout_buffer_seconds:
+            raise SinkError('fanout_max_lag_seconds must be less than fanout_buffer_seconds')
+
+        self.log = player.log
+        self.debug = player.debug
+        self.policy = cfg.fanout_lag_policy
+        self.buffer_seconds = cfg.fanout_buffer_seconds
+        self.max_lag_seconds = cfg.fanout_max_lag_seconds
+
+        # Protects the state of the fanout and all the outputs
+        self.cond = threading.Condition()
+
+        # Increased on start() and stop() to let the output threads
+        # detect that they should abandon what they are doing
+        self.generation = 0
+
+        self.format = None
+        self.max_bytes = 0
+        self.max_lag_bytes = 0
+        self.paused = False
+        self.draining = False
+
+        self.outputs = [FanoutOutput(self, device, create_sink(player, device))
+                        for device in cfg.fanout_devices]
+
+
+    def pause(self):
+        with self.cond:
+            if self.format is None:
+                return False
+
+            self.paused = True
+            paused = False
+            for output in self.outputs:
+                if output.lag_paused:
+                    paused = True
+                elif self.sink_control(output, 'pause'):
+                    paused = True
+
+            return paused
+
+
+    def resume(self):
+        with self.cond:
+            self.paused = False
+            for output in self.outputs:
+                if not output.lag_paused:
+                    self.sink_control(output, 'resume')
+
+
+    def stop(self):
+        with self.cond:
+            self.generation += 1
+            self.format = None
+            self.paused = False
+            self.draining = False
+
+            for output in self.outputs:
+                output.reset()
+                with output.control_lock:
+                    output.sink.stop()
+
+            self.cond.notify_all()
+
+
+    def start(self, format):
+        with self.cond:
+            self.generation += 1
+            self.format = format
+            self.paused = False
+            self.draining = False
+
+            bytes_per_second = format.rate * format.channels * format.bytes_per_sample
+            self.max_bytes = self.buffer_seconds * bytes_per_second
+            self.max_lag_bytes = self.max_lag_seconds * bytes_per_second
+
+            for output in self.outputs:
+                output.reset()
+
+            self.cond.notify_all()
+
+
+    def add_packet(self, packet, offset):
+        with self.cond:
+            if self.format is None:
+                # stopped in flight
+                return 0, packet, None
+
+            length = len(packet.data) - offset
+
+            self.check_lag()
+            if not self.has_room(length):
+                self.cond.wait(self.QUEUE_WAIT)
+                self.check_lag()
+
+                if self.format is None or not self.has_room(length):
+                    current_packet, error = self.get_current()
+                    return 0, current_packet, error
+
+            # All outputs share a single copy of the data
+            queued = FanoutPacket(packet)
+            for output in self.outputs:
+                if not output.detached:
+                    output.packets.append((queued, offset))
+                    output.queued_bytes += length
+
+            self.cond.notify_all()
+
+            current_packet, error = self.get_current()
+            return length, current_packet, error
+
+
+    def drain(self):
+        with self.cond:
+            if self.format is None:
+                return None
+
+            if not self.draining:
+                self.draining = True
+                self.cond.notify_all()
+
+            if not self.all_drained():
+                self.cond.wait(self.QUEUE_WAIT)
+
+            if self.format is None or self.all_drained():
+                return None
+
+            return self.get_current()
+
+
+    def get_playing_offset(self):
+        with self.cond:
+            output = self.get_primary()
+            return output.playing_offset if output else None
+
+
+    def get_stats(self):
+        """Fanout sinks report the policy and a list of outputs, each
+        with these keys:
+
+          device: the fanout_devices entry
+          detached: True if detached after falling behind
+          queued_bytes: bytes in the output queue
+          dropped_bytes: bytes dropped after falling behind
+          lag_pauses: times the other outputs were paused for this one
+          detaches: times it has been detached
+          sink: the stats of the output sink
+        """
+        with self.cond:
+            outputs = [{
+                    'device': output.device,
+                    'detached': output.detached,
+                    'queued_bytes': output.queued_bytes,
+                    'dropped_bytes': output.dropped_bytes,
+                    'lag_pauses': output.lag_pauses,
+                    'detaches': output.detaches,
+                    } for output in self.outputs]
+
+        for output, stats in zip(self.outputs, outputs):
+            stats['sink'] = output.sink.get_stats()
+
+        return {
+            'policy': self.policy,
+            'outputs': outputs,
+            }
+
+
+    #
+    # Internal methods, called with self.cond held
+    #
+
+    def get_active(self):
+        return [output for output in self.outputs if not output.detached]
+
+
+    def get_primary(self):
+        for output in self.outputs:
+            if not output.detached:
+                return output
+        return None
+
+
+    def get_current(self):
+        output = self.get_primary()
+        if output:
+            return output.current_packet, output.error
+        return None, None
+
+
+    def all_drained(self):
+        return all(output.drained for output in self.get_active())
+
+
+    def has_room(self, length):
+        return all(output.queued_bytes + length <= self.max_bytes
+                   for output in self.get_active())
+
+
+    def sink_control(self, output, method):
+        with output.control_lock:
+            if output.started:
+                return getattr(output.sink, method)()
+        return False
+
+
+    def check_lag(self):
+        active = self.get_active()
+        if not active:
+            return
+
+        least_queued = min(output.queued_bytes for output in active)
+
+        for output in active:
+            lag = output.queued_bytes - least_queued
+            if lag <= self.max_lag_bytes:
+                continue
+
+            if self.policy == 'drop':
+                self.log('fanout output {0} is {1} bytes behind, dropping audio',
+                         output.device, lag)
+                self.drop_queued(output, lag)
+
+            elif self.policy == 'detach':
+                self.log('fanout output {0} is {1} bytes behind, detaching it',
+                         output.device, lag)
+                output.detached = True
+                output.detaches += 1
+                output.packets.clear()
+                output.queued_bytes = 0
+                with output.control_lock:
+                    output.sink.stop()
+
+            elif self.policy == 'pause' and not any(o.lag_paused for o in active):
+                self.log('fanout output {0} is {1} bytes behind, pausing the others',
+                         output.device, lag)
+                output.lag_pauses += 1
+                for other in active:
+                    if other is not output:
+                        other.lag_paused = True
+                        if not self.paused:
+                            self.sink_control(other, 'pause')
+
+        # Resume outputs paused for a lagging one when it has caught up
+        lag_paused = [output for output in active if output.lag_paused]
+        if lag_paused:
+            running = [output for output in active if not output.lag_paused]
+            if (not running or max(output.queued_bytes for output in running)
+                - least_queued <= self.max_lag_bytes / 2):
+                self.debug('fanout outputs caught up, resuming')
+                for output in lag_paused:
+                    output.lag_paused = False
+                    if not self.paused:
+                        self.sink_control(output, 'resume')
+
+        self.cond.notify_all()
+
+
+    def drop_queued(self, output, length):
+        """Drop LENGTH bytes of the oldest whole packets queued in
+        OUTPUT.  The packet currently being added to the sink is kept.
+        """
+        while len(output.packets) > 1 and length > 0:
+            packet, offset = output.packets[1]
+            dropped = len(packet.data) - offset
+            del output.packets[1]
+            output.queued_bytes -= dropped
+            output.dropped_bytes += dropped
+            length -= dropped
+
+
+def create_sink(player, device):
+    """Create a sink for DEVICE, which is a key in SINKS.  For the
+    network sinks it can also be 'tcp:host' or 'tcp:host:port' (or
+    udp) to stream to other receivers than the configured one.
+    """
+    name, sep, address = device.partition(':')
+
+    if name == 'fanout':
+        raise SinkError("fanout sinks can't be nested")
+
+    if address and name in ('tcp', 'udp'):
+        host, sep, port = address.partition(':')
+        try:
+            port = int(port) if port else player.cfg.net_sink_port
+        except ValueError:
+            raise SinkError('invalid port in sink device: {0}'.format(device))
+        return SINKS[name](player, (host, port))
+
+    try:
+        return SINKS[device](player)
+    except KeyError:
+        raise SinkError('unknown sink device: {0}'.format(device))
+
 
 SINKS = {
     'file': FileSink,
     'alsa': AlsaSink,
+    'tcp': network_sink('tcp'),
+    'udp': network_sink('udp'),
+    'fanout': FanoutSink,
     }
@@ -11,23 +11,58 @@ Classes implementing sources of audio packets to be used by the player Transport
 import os
 import time
 import errno
+import mmap
 import threading
 
 from . import audio
+from . import fileio
 
 class SourceError(Exception): pass
 
+
+# Silent packets are shared, read-only buffers kept by length in
+# bytes.  There are typically only a few different packet lengths, but
+# keep the cache from growing unbounded on unusual discs anyway.
+MAX_SILENCE_BUFFERS = 16
+_silence_buffers = {}
+
+def get_silence(length):
+    """Return a string of LENGTH null bytes, reusing a previously
+    returned one if possible.
+    """
+    try:
+        return _silence_buffers[length]
+    except KeyError:
+        if len(_silence_buffers) >= MAX_SILENCE_BUFFERS:
+            _silence_buffers.clear()
+
+        silence = _silence_buffers[length] = '\0' * length
+        return silence
+
+
 class Source(object):
     """Abstract base class representing a source of audio packets.
+
+    The transport may set packet_pool to an audio.PacketPool that
+    the source should take packets from.
+
+    Sources reading from slow media should set read_seconds to the
+    time it took to read the data of the last packet, which the
+    transport can use to size its buffer.
     """
 
+    packet_pool = None
+    read_seconds = None
+
     def __init__(self, disc):
         self.disc = disc
+        self.frame_map = audio.DiscFrameMap(disc)
 
-    def iter_packets(self, track_number, packet_rate):
+    def iter_packets(self, track_number, packet_rate, position = 0):
         """Iterate over audio packets from this source, starting at
         TRACK_NUMBER (counting from 0) and running at approximately
-        PACKET_RATE Hz.
+        PACKET_RATE Hz.  If POSITION is provided, start that many
+        frames from index 1 of the track (negative for the pregap).
 
         Raise SourceError if running into errors, and just return
         normally at the end of the stream.
@@ -36,12 +71,27 @@ class Source(object):
         after a delay to give control back to the transport.
         """
         raise NotImplementedError()
+
+
+    def is_shared_data(self, packet):
+        """Return True if the data of PACKET is shared and will not
+        change, so the transport doesn't have to copy it.
+        """
+        return False
     
 
 class PCMDiscSource(Source):
     """Generate audio packets from a database disc in PCM format.
     """
 
+    # Max seconds to wait for the ripping process to write to the
+    # audio file before checking if it is still running
+    RIP_WAIT_TIMEOUT = 1
+
+    # Tell the kernel to drop pages that have been read in chunks of
+    # at least this many bytes
+    DONTNEED_CHUNK_SIZE = 1024 * 1024
+
     def __init__(self, player, disc, is_ripping):
         super(PCMDiscSource, self).__init__(disc)
 
@@ -59,8 +109,46 @@ class PCMDiscSource(Source):
         else:
             self.is_ripping = None
             
+        self.audio_path = None
         self.audio_file = None
 
+        # Created by the source thread when it has to wait for the
+        # ripping process
+        self.file_waiter = None
+
+        # If enabled, packet data are read-only buffers pointing
+        # straight into a memory mapping of the audio file instead of
+        # strings read from it.  The mapping is replaced by a larger
+        # one when the ripping process has extended the file, while
+        # any packets still in flight keep the old one alive.
+        self.use_mmap = player.cfg.audio_file_mmap
+        self.audio_map = None
+
+        # Page cache hints: ask the kernel to read ahead this many
+        # bytes of the file, and to drop pages that have been read
+        # (unless they are in use by the memory mapping).
+        self.readahead_bytes = (player.cfg.readahead_seconds
+                                * disc.audio_format.rate
+                                * disc.audio_format.bytes_per_frame)
+        self.readahead_end = None
+        self.dontneed_start = None
+        self.read_end = None
+        self.readahead_track = None
+
+        # Optional cache of the first seconds of each track, used to
+        # start playing while the file is opened in the background
+        # (waiting for the disk to spin up), and updated with the
+        # track starts read from the file
+        self.head_cache = player.head_cache
+        self.head_cache_bytes = (player.cfg.head_cache_seconds
+                                 * disc.audio_format.rate
+                                 * disc.audio_format.bytes_per_frame)
+        self.file_opener = None
+        self.file_opener_error = None
+        self.head_pos = None
+        self.head_frames = 0
+        self.head_data = None
+
 
     def rip_finished(self):
         """Call to inform that the any concurrent ripping process is finished."""
@@ -68,29 +156,60 @@ class PCMDiscSource(Source):
         if self.is_ripping:
             self.is_ripping.clear()
 
+            # Don't let the source thread wait for data that won't come
+            waiter = self.file_waiter
+            if waiter:
+                waiter.wake()
+
+
+    def iter_packets(self, track_number, packet_rate, position = 0):
+        try:
+            for p in self.iter_file_packets(track_number, packet_rate, position):
+                yield p
+        finally:
+            self.close_file_waiter()
+
+
+    def is_shared_data(self, packet):
+        # Silence buffers are shared, and views into the memory-mapped
+        # file or the cached head are never written to
+        return packet.file_pos is None or isinstance(packet.data, buffer)
+
 
-    def iter_packets(self, track_number, packet_rate):
-        self.debug('generating packets for {0} track {1}',
-                   self.disc, track_number)
+    def iter_file_packets(self, track_number, packet_rate, position):
+        self.debug('generating packets for {0} track {1} position {2}',
+                   self.disc, track_number, position)
 
         # Construct full path to data file and open it
 
         db_id = self.player.db.disc_to_db_id(self.disc.disc_id)
-        path = os.path.join(
+        path = self.audio_path = os.path.join(
             self.player.db.get_disc_dir(db_id),
             self.disc.data_file_name)
 
 
+        # Play from the head cache while the file is opened, if possible
+
+        # Keep cached data apart if the disc is converted to another
+        # byte order
+        head_cache_id = db_id if self.disc.audio_format.big_endian else db_id + '-le'
+
+        head, head_pos = self.get_cached_head(head_cache_id, track_number)
+        if head is not None:
+            self.start_file_opener(path, head_pos * self.disc.audio_format.bytes_per_frame + len(head))
+        else:
+            self.join_file_opener()
+
         # Retry opening file if the ripping process is in progress
         # and might not have had time to create it yet
 
-        while self.audio_file is None:
+        while head is None and self.audio_file is None:
             try:
                 self.debug('opening file {0}', path)
                 self.audio_file = open(path, 'rb')
             except IOError, e:
                 if e.errno == errno.ENOENT and self.is_ripping and self.is_ripping.is_set():
-                    time.sleep(1)
+                    self.wait_for_rip()
                     # Give transport control 
                     yield None
                 else:
@@ -98,19 +217,234 @@ class PCMDiscSource(Source):
 
         # Iterate over all packets, reading data into them
 
-        for p in audio.AudioPacket.iterate(self.disc, track_number, packet_rate):
+        for p in audio.AudioPacket.iterate(self.disc, track_number, packet_rate,
+                                           position, self.frame_map,
+                                           self.packet_pool):
+
+            if head is not None:
+                self.read_seconds = None
+                if self.read_cached_head_into_packet(p, head, head_pos):
+                    yield p
+                    continue
+
+                # Ran out of cached data, switch to the file
+                self.debug('switching from head cache to file {0}', path)
+                head = None
+                self.join_file_opener()
 
             try:
                 self.read_data_into_packet(p)
             except IOError, e:
                 raise SourceError('error reading from file {0}: {1}'.format(path, e))
 
+            if self.readahead_bytes > 0:
+                self.advise_page_cache(p)
+
+            if self.head_cache:
+                self.update_head_cache(head_cache_id, p)
+
             # Send out packet to transport
             yield p
 
         self.debug('iterator reached end of disc, finishing')
 
 
+    def wait_for_rip(self):
+        """Thread helper method to wait for the ripping process to
+        create or extend the audio file.
+        """
+
+        if self.file_waiter is None:
+            self.file_waiter = fileio.FileGrowthWaiter(self.audio_path)
+            if not self.file_waiter.using_inotify:
+                self.debug('inotify not available, polling {0}', self.audio_path)
+
+        self.file_waiter.wait(self.RIP_WAIT_TIMEOUT)
+
+
+    def close_file_waiter(self):
+        waiter = self.file_waiter
+        if waiter:
+            self.file_waiter = None
+            waiter.close()
+
+
+    def get_cached_head(self, db_id, track_number):
+        """Thread helper method to look up the cached start of
+        TRACK_NUMBER.  Returns a tuple (data, file_pos), where data is
+        None if not cached.
+        """
+
+        # The file is already awake when ripping
+        if not self.head_cache or self.is_ripping:
+            return None, None
+
+        track = self.disc.tracks[track_number]
+        if track.pregap_offset < track.pregap_silence:
+            return None, None
+
+        file_pos = track.file_offset + track.pregap_offset - track.pregap_silence
+        return self.head_cache.get(db_id, file_pos), file_pos
+
+
+    def read_cached_head_into_packet(self, p, head, head_pos):
+        """Thread helper method for populating packet P from the
+        cached HEAD, starting at frame HEAD_POS in the file.  Returns
+        False if P isn't covered by the cache.
+        """
+
+        if p.file_pos is None:
+            self.read_data_into_packet(p)
+            return True
+
+        bytes_per_frame = self.disc.audio_format.bytes_per_frame
+        start = (p.file_pos - head_pos) * bytes_per_frame
+        end = start + p.length * bytes_per_frame
+
+        if start < 0 or end > len(head):
+            return False
+
+        p.data = buffer(head, start, end - start)
+        return True
+
+
+    def start_file_opener(self, path, wake_pos):
+        """Thread helper method to open the audio file in a
+        background thread, also reading from WAKE_POS to spin up the
+        disk if necessary.
+        """
+
+        if self.file_opener is not None:
+            # Still busy from an earlier call
+            return
+
+        self.file_opener_error = None
+        self.file_opener = threading.Thread(target = self.file_opener_thread,
+                                            name = 'file opener',
+                                            args = (path, wake_pos))
+        self.file_opener.daemon = True
+        self.file_opener.start()
+
+
+    def file_opener_thread(self, path, wake_pos):
+        try:
+            f = self.audio_file
+            if f is None:
+                self.debug('opening file {0} in background', path)
+                f = open(path, 'rb')
+
+            f.seek(wake_pos)
+            f.read(1)
+            self.audio_file = f
+
+        except IOError, e:
+            self.file_opener_error = SourceError('error opening file {0}: {1}'.format(path, e))
+
+
+    def join_file_opener(self):
+        """Thread helper method to wait for any background opening
+        of the audio file to finish.
+        """
+
+        if self.file_opener is None:
+            return
+
+        self.file_opener.join()
+        self.file_opener = None
+
+        e = self.file_opener_error
+        if e:
+            self.file_opener_error = None
+            raise e
+
+
+    def update_head_cache(self, db_id, p):
+        """Thread helper method to collect the start of tracks that
+        aren't in the head cache yet, storing them when complete.
+        """
+
+        if p.file_pos is None:
+            return
+
+        if p.rel_pos == 0:
+            if (db_id, p.file_pos) in self.head_cache:
+                self.head_data = None
+            else:
+                self.head_pos = p.file_pos
+                self.head_data = []
+                self.head_frames = 0
+
+        elif self.head_data is not None and p.file_pos != self.head_pos + self.head_frames:
+            # Jumped somewhere else
+            self.head_data = None
+
+        if self.head_data is None:
+            return
+
+        self.head_data.append(str(p.data))
+        self.head_frames += p.length
+
+        if (self.head_frames * self.disc.audio_format.bytes_per_frame >= self.head_cache_bytes
+            or p.abs_pos + p.length == p.track.length):
+            self.debug('storing start of track {0} in head cache', p.track_number)
+            data = ''.join(self.head_data)
+            self.head_cache.store(db_id, self.head_pos, data[:self.head_cache_bytes])
+            self.head_data = None
+
+
+    def advise_page_cache(self, p):
+        """Thread helper method to give page cache hints for the
+        audio file after reading packet P.
+        """
+
+        if p.file_pos is None:
+            return
+
+        bytes_per_frame = self.disc.audio_format.bytes_per_frame
+        file_pos = p.file_pos * bytes_per_frame
+        end_pos = file_pos + len(p.data)
+
+        try:
+            if file_pos != self.read_end:
+                # Started reading, or jumped to a new position
+                self.readahead_end = file_pos
+                self.dontneed_start = file_pos
+
+            self.read_end = end_pos
+
+            # Keep the readahead window filled, but don't bother the
+            # kernel for every single packet
+            if end_pos + self.readahead_bytes / 2 > self.readahead_end:
+                fileio.fadvise(self.audio_file, self.readahead_end,
+                               end_pos + self.readahead_bytes - self.readahead_end,
+                               fileio.POSIX_FADV_WILLNEED)
+                self.readahead_end = end_pos + self.readahead_bytes
+
+            # When starting a new track, also get the start of the
+            # following one to speed up skipping to it
+            if p.track_number != self.readahead_track:
+                self.readahead_track = p.track_number
+
+                if p.track_number + 1 < len(self.disc.tracks):
+                    next_track = self.disc.tracks[p.track_number + 1]
+                    fileio.fadvise(self.audio_file,
+                                   next_track.file_offset * bytes_per_frame,
+                                   self.readahead_bytes,
+                                   fileio.POSIX_FADV_WILLNEED)
+
+            # Pages used by the memory mapping may still be needed by
+            # packets in the transport buffer, so leave them be
+            if not self.use_mmap and end_pos - self.dontneed_start >= self.DONTNEED_CHUNK_SIZE:
+                fileio.fadvise(self.audio_file, self.dontneed_start,
+                               end_pos - self.dontneed_start,
+                               fileio.POSIX_FADV_DONTNEED)
+                self.dontneed_start = end_pos
+
+        except OSError, e:
+            self.log('disabling page cache hints after error: {0}', e)
+            self.readahead_bytes = 0
+
+
     def read_data_into_packet(self, p):
         """Thread helper method for populating data into packet P."""
 
@@ -118,35 +452,43 @@ class PCMDiscSource(Source):
 
         length = p.length * self.disc.audio_format.bytes_per_frame
 
+        # With memory mapping the reads happen when the data is used,
+        # so they can't be timed here
+        self.read_seconds = None
+
         if p.file_pos is None:
             # Silence, so send on null bytes to player
-            p.data = '\0' * length
+            p.data = get_silence(length)
 
         else:
             file_pos = p.file_pos * self.disc.audio_format.bytes_per_frame
 
-            if perf_log:
-                start_read = time.time()
-            
+            if self.use_mmap:
+                p.data = self.map_data(file_pos, length)
+                return
+
+            start_read = time.time()
+
             self.audio_file.seek(file_pos)
             p.data = self.audio_file.read(length)
 
+            now = time.time()
+            self.read_seconds = now - start_read
+
             if perf_log:
-                now = time.time()
                 perf_log.write(
                     '{0:06f} {1:06f} read {2}\n'.format(start_read, now, len(p.data)))
 
             length -= len(p.data)
             file_pos += len(p.data)
             
-            # If we didn't get all data, iterate with a timeout until
-            # it's all been read or the ripping process has stopped.
-            # This is not very efficient, and there's a small race
-            # condition at the end of the disc, but this should be
-            # very rare so keep it unoptimised for now.
+            # If we didn't get all data, wait for the ripping process
+            # to write more until it's all been read or the ripping
+            # process has stopped.  There's a small race condition at
+            # the end of the disc, but this should be very rare.
 
             while length > 0 and self.is_ripping and self.is_ripping.is_set():
-                time.sleep(1)
+                self.wait_for_rip()
                 
                 if perf_log:
                     start_read = time.time()
@@ -168,4 +510,50 @@ class PCMDiscSource(Source):
             if length > 0:
                 raise SourceError('unexpected end of file, expected at least {0} bytes'
                                   .format(length))
-    
+
+
+    def map_data(self, file_pos, length):
+        """Thread helper method for returning a buffer of LENGTH bytes
+        at FILE_POS in the memory mapping of the audio file.
+        """
+
+        end_pos = file_pos + length
+
+        if self.audio_map is None or end_pos > len(self.audio_map):
+            self.remap_file(end_pos)
+
+        return buffer(self.audio_map, file_pos, length)
+
+
+    def remap_file(self, end_pos):
+        """Thread helper method for mapping the audio file so that
+        at least END_POS bytes are covered, waiting for the ripping
+        process if the file isn't that big yet.
+        """
+
+        perf_log = self.player.audio_streamer_perf_log
+
+        if perf_log:
+            start_read = time.time()
+
+        try:
+            file_size = os.fstat(self.audio_file.fileno()).st_size
+
+            while file_size < end_pos and self.is_ripping and self.is_ripping.is_set():
+                self.wait_for_rip()
+                file_size = os.fstat(self.audio_file.fileno()).st_size
+
+            if file_size < end_pos:
+                raise SourceError('unexpected end of file, file is {0} bytes, expected at least {1}'
+                                  .format(file_size, end_pos))
+
+            self.audio_map = mmap.mmap(self.audio_file.fileno(), file_size,
+                                       access = mmap.ACCESS_READ)
+
+        except EnvironmentError, e:
+            raise SourceError('error mapping audio file: {0}'.format(e))
+
+        if perf_log:
+            now = time.time()
+            perf_log.write(
+                '{0:06f} {1:06f} map {2}\n'.format(start_read, now, file_size))
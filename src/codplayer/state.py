@@ -41,6 +41,13 @@ class State(serialize.Serializable):
     position: Current position in track in whole seconds, counting
     from index 1 (so the pregap is negative).
 
+    position_frames: Current position in track in audio frames
+    (1/44100 s for CD audio), counting from index 1.  When the sink
+    can tell, this is the position currently heard rather than the
+    position buffered by the sink.  Since state updates are published
+    when the position moves a whole second, clients can use this to
+    interpolate the position between updates.
+
     length: Length of current track in whole seconds, counting
     from index 1.
 
@@ -58,20 +65,20 @@ class State(serialize.Serializable):
 
     class PLAY:
         valid_commands = ('quit', 'disc', 'pause', 'play_pause',
-                          'next', 'prev', 'stop', 'eject')
+                          'next', 'prev', 'seek', 'ff', 'rew', 'stop', 'eject')
 
     class PAUSE:
         valid_commands = ('quit', 'disc', 'play', 'play_pause',
-                          'next', 'prev', 'stop', 'eject')
+                          'next', 'prev', 'seek', 'ff', 'rew', 'stop', 'eject')
 
     class STOP:
         valid_commands = ('quit', 'disc', 'play', 'play_pause',
-                          'next', 'prev', 'eject')
+                          'next', 'prev', 'seek', 'eject')
 
 
     def __init__(self, state = NO_DISC, disc_id = None, source_disc_id = None,
                  track = 0, no_tracks = 0, index = 0, position = 0, length = 0,
-                 error = None):
+                 error = None, position_frames = 0):
         self.state = state
         self.disc_id = disc_id
         self.source_disc_id = source_disc_id
@@ -79,6 +86,7 @@ class State(serialize.Serializable):
         self.no_tracks = no_tracks
         self.index = index
         self.position = position
+        self.position_frames = position_frames
         self.length = length
         self.error = error
 
@@ -100,6 +108,7 @@ class State(serialize.Serializable):
         serialize.Attr('no_tracks', int),
         serialize.Attr('index', int),
         serialize.Attr('position', int),
+        serialize.Attr('position_frames', int, optional = True, default = 0),
         serialize.Attr('length', int),
         serialize.Attr('error', serialize.str_unicode),
         )
@@ -149,10 +158,18 @@ class RipState(serialize.Serializable):
 
 
 class StateClient(object):
-    """Subscribe to state published on a zerohub.Topic."""
+    """Subscribe to state published on a zerohub.Topic.
+
+    If rpc_channel is provided, the current state, rip_state and disc
+    are also fetched from the player each time the subscription
+    connects to it.  Only this client gets those replies, and it
+    doesn't miss the state if it starts before the player or the
+    player is restarted.
+    """
 
     def __init__(self, channel, io_loop = None,
-                 on_state = None, on_rip_state = None, on_disc = None):
+                 on_state = None, on_rip_state = None, on_disc = None,
+                 rpc_channel = None):
 
         subscriptions = {}
         if on_state:
@@ -162,14 +179,49 @@ class StateClient(object):
         if on_disc:
             subscriptions['disc'] = (lambda receiver, msg: on_disc(self._parse_message(msg, model.ExtDisc)))
 
+        self._io_loop = io_loop
+        self._subscriptions = subscriptions
+        self._rpc_channel = rpc_channel
+        self._rpc_client = None
+
         self._reciever = zerohub.Receiver(
-            channel, io_loop = io_loop, callbacks = subscriptions, )
+            channel, io_loop = io_loop, callbacks = subscriptions,
+            on_connect = self._fetch_current if rpc_channel else None)
 
     def close(self):
         if self._reciever:
             self._reciever.close()
             self._reciever = None
 
+        if self._rpc_client:
+            self._rpc_client.close()
+            self._rpc_client = None
+
+    def _fetch_current(self, receiver):
+        # A new client each time, since a request sent to a player
+        # that went away will never get a reply
+        if self._rpc_client:
+            self._rpc_client.close()
+
+        self._rpc_client = zerohub.AsyncRPCClient(
+            self._rpc_channel, io_loop = self._io_loop)
+
+        # The replies have the same format as the published messages,
+        # except that the source command replies with a disc
+        for cmd, msg_name in (('state', 'state'),
+                              ('rip_state', 'rip_state'),
+                              ('source', 'disc')):
+            if msg_name in self._subscriptions:
+                self._rpc_client.call([cmd], self._on_current)
+
+    def _on_current(self, msg, error):
+        if error or not msg:
+            return
+
+        callback = self._subscriptions.get(msg[0])
+        if callback:
+            callback(self._reciever, msg)
+
     def _parse_message(self, msg, cls):
         if len(msg) < 2:
             raise StateError('zeromq: missing message parts: {0}'.format(msg))
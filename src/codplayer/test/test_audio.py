@@ -292,3 +292,144 @@ FILE "data.cdr" 00:02:00 00:00:17
         with self.assertRaises(StopIteration):
             splitter.next()
 
+
+
+    def test_start_at_position(self):
+        # Two tracks, second with a partly silent pregap
+        disc = model.DbDisc()
+        disc.audio_format = model.PCM
+
+        t1 = model.DbTrack()
+        t1.length = model.PCM.rate * 2
+        disc.tracks.append(t1)
+
+        t2 = model.DbTrack()
+        t2.length = model.PCM.rate * 3
+        t2.file_offset = t1.length
+        t2.pregap_offset = model.PCM.rate
+        t2.pregap_silence = 300
+        disc.tracks.append(t2)
+
+        # Start in the middle of the first track
+        splitter = audio.AudioPacket.iterate(disc, 0, 1, 1000)
+
+        p = splitter.next()
+        self.assertIs(p.track, t1)
+        self.assertEqual(p.rel_pos, 1000)
+        self.assertEqual(p.length, model.PCM.rate)
+        self.assertEqual(p.file_pos, 1000)
+
+        p = splitter.next()
+        self.assertIs(p.track, t1)
+        self.assertEqual(p.rel_pos, 1000 + model.PCM.rate)
+        self.assertEqual(p.length, model.PCM.rate - 1000)
+
+        # Start in the pregap of the second track, where the silence
+        # should be split into a packet of its own
+        splitter = audio.AudioPacket.iterate(disc, 1, 1, 200 - model.PCM.rate)
+
+        p = splitter.next()
+        self.assertIs(p.track, t2)
+        self.assertEqual(p.index, 0)
+        self.assertEqual(p.abs_pos, 200)
+        self.assertEqual(p.length, 100)
+        self.assertIsNone(p.file_pos)
+
+        p = splitter.next()
+        self.assertEqual(p.index, 0)
+        self.assertEqual(p.abs_pos, 300)
+        self.assertEqual(p.length, model.PCM.rate - 300)
+        self.assertEqual(p.file_pos, t1.length)
+
+        p = splitter.next()
+        self.assertEqual(p.index, 1)
+        self.assertEqual(p.rel_pos, 0)
+
+
+class TestDiscFrameMap(unittest.TestCase):
+
+    def test_lookups(self):
+        disc = model.DbDisc()
+        disc.audio_format = model.PCM
+
+        t1 = model.DbTrack()
+        t1.length = 1000
+        t1.index = [600, 800]
+        disc.tracks.append(t1)
+
+        t2 = model.DbTrack()
+        t2.length = model.PCM.rate * 3
+        t2.pregap_offset = model.PCM.rate
+        disc.tracks.append(t2)
+
+        fm = audio.DiscFrameMap(disc)
+        self.assertEqual(list(fm.track_starts), [0, 1000])
+        self.assertEqual(list(fm.length_secs), [0, 2])
+        self.assertEqual(fm.disc_length, 1000 + t2.length)
+
+        self.assertEqual(fm.get_index(0, 0), 1)
+        self.assertEqual(fm.get_index(0, 599), 1)
+        self.assertEqual(fm.get_index(0, 600), 2)
+        self.assertEqual(fm.get_index(0, 999), 3)
+        self.assertEqual(fm.get_index(1, 0), 0)
+        self.assertEqual(fm.get_index(1, model.PCM.rate), 1)
+
+        self.assertEqual(fm.get_disc_pos(1, -10), 1000 + model.PCM.rate - 10)
+        self.assertEqual(fm.get_track_pos(-5), (0, 0))
+        self.assertEqual(fm.get_track_pos(999), (0, 999))
+        self.assertEqual(fm.get_track_pos(1000), (1, -model.PCM.rate))
+        self.assertIsNone(fm.get_track_pos(fm.disc_length))
+
+        # Packets should get the same index from the map as without
+        for abs_pos in (0, 599, 600, 800, 999):
+            self.assertEqual(
+                audio.AudioPacket(disc, t1, 0, abs_pos, 1, frame_map = fm).index,
+                audio.AudioPacket(disc, t1, 0, abs_pos, 1).index)
+
+
+class TestPacketPool(unittest.TestCase):
+
+    def test_reuse(self):
+        disc = model.DbDisc()
+        disc.audio_format = model.PCM
+
+        t = model.DbTrack()
+        t.length = model.PCM.rate * 10
+        disc.tracks.append(t)
+
+        pool = audio.PacketPool(10)
+        packets = list(audio.AudioPacket.iterate(disc, 0, 1, pool = pool))
+        self.assertEqual(len(packets), 10)
+        self.assertEqual(pool.allocated, 10)
+
+        # Packets still referenced elsewhere must not be reused
+        held = packets[0]
+        for p in packets:
+            pool.release(p)
+        del p, packets
+
+        packets = list(audio.AudioPacket.iterate(disc, 0, 1, pool = pool))
+        self.assertEqual(pool.reused, 0)
+        self.assertEqual(pool.allocated, 20)
+
+        del held
+        del packets
+
+        # The first pool contents are now free, but since the second
+        # batch was never released nothing should be clobbered
+        packets = []
+        for p in audio.AudioPacket.iterate(disc, 0, 1, pool = pool):
+            packets.append(p)
+            self.assertIsNone(p.data)
+            self.assertIsNone(p.context)
+        del p
+
+        self.assertEqual(pool.reused, 10)
+        self.assertEqual(pool.allocated, 20)
+        self.assertEqual([p.abs_pos for p in packets],
+                         [i * model.PCM.rate for i in range(10)])
+
+    def test_slots(self):
+        p = audio.AudioPacket(DummyDisc, model.DbTrack(), 0, 0, 0)
+        with self.assertRaises(AttributeError):
+            p.foo = 17
@@ -0,0 +1,60 @@
+# codplayer - test the daemon helpers
+#
+# Copyright 2015 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import subprocess
+import time
+
+from .. import codaemon
+from .. import zerohub
+
+
+class TestProcessSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = zerohub.IOLoop()
+        self.supervisor = codaemon.ProcessSupervisor(self.io_loop)
+        self.exited = []
+
+        # Don't hang if the exit isn't detected
+        self.timeout = self.io_loop.add_timeout(time.time() + 5, self.io_loop.stop)
+
+    def tearDown(self):
+        self.supervisor.close()
+        self.io_loop.close()
+
+    def on_exit(self, name, returncode):
+        self.exited.append((name, returncode))
+        if len(self.exited) == self.expected:
+            self.io_loop.stop()
+
+
+    def test_exit_detected(self):
+        self.expected = 2
+        start = time.time()
+
+        slow = subprocess.Popen(['sh', '-c', 'sleep 0.2; exit 3'])
+        self.supervisor.watch(slow, lambda rc: self.on_exit('slow', rc))
+
+        fast = subprocess.Popen(['true'])
+        self.supervisor.watch(fast, lambda rc: self.on_exit('fast', rc))
+
+        self.io_loop.start()
+
+        self.assertEqual(self.exited, [('fast', 0), ('slow', 3)])
+        self.assertLess(time.time() - start, 2)
+
+
+    def test_already_exited(self):
+        self.expected = 1
+
+        done = subprocess.Popen(['true'])
+        done.wait()
+
+        self.supervisor.watch(done, lambda rc: self.on_exit('done', rc))
+        self.io_loop.start()
+
+        self.assertEqual(self.exited, [('done', 0)])
@@ -410,3 +410,63 @@ FILE "{0}.cdr" 0 02:54:53
         self.assertListEqual(new_track.index, [])
 
         
+
+
+#
+# Test converting the audio file byte order
+#
+
+class TestAudioConversion(TestDir, unittest.TestCase):
+    DISC_ID = 'uP.sebZoiZSYakZh.g3coKrme8I-'
+    DB_ID = 'b8ffac79b6688994986a4661fa0ddca0aae67bc2'
+
+    def setUp(self):
+        super(TestAudioConversion, self).setUp()
+        db.Database.init_db(self.test_dir)
+        self.db = db.Database(self.test_dir)
+
+        # Mock up a disc from a simple TOC
+        disc = toc.parse_toc("""
+TRACK AUDIO
+TWO_CHANNEL_AUDIO
+FILE "{0}.cdr" 0 00:00:01
+""".format(self.DB_ID[:8]), self.DISC_ID)
+
+        disc.rip = True
+        self.db.create_disc(disc)
+
+        self.audio_file = self.db.get_audio_path(self.DB_ID)
+        with open(self.audio_file, 'wb') as f:
+            f.write('\x01\x02\x03\x04' * 588)
+
+
+    def test_convert(self):
+        disc = self.db.convert_audio_format(self.DB_ID, model.PCM_LE)
+        self.assertIs(disc.audio_format, model.PCM_LE)
+
+        with open(self.audio_file, 'rb') as f:
+            self.assertEqual(f.read(), '\x02\x01\x04\x03' * 588)
+
+        disc = self.db.get_disc_by_disc_id(self.DISC_ID)
+        self.assertIs(disc.audio_format, model.PCM_LE)
+
+        # Converting to the current format does nothing
+        self.db.convert_audio_format(self.DB_ID, model.PCM_LE)
+        with open(self.audio_file, 'rb') as f:
+            self.assertEqual(f.read(), '\x02\x01\x04\x03' * 588)
+
+        # And back again
+        disc = self.db.convert_audio_format(self.DB_ID, model.PCM)
+        self.assertIs(disc.audio_format, model.PCM)
+
+        with open(self.audio_file, 'rb') as f:
+            self.assertEqual(f.read(), '\x01\x02\x03\x04' * 588)
+
+
+    def test_convert_unripped_disc(self):
+        disc = self.db.get_disc_by_disc_id(self.DISC_ID)
+        disc.rip = False
+        self.db.save_disc_info(disc)
+
+        with self.assertRaises(db.DatabaseError):
+            self.db.convert_audio_format(self.DB_ID, model.PCM_LE)
@@ -0,0 +1,66 @@
+# codplayer - test the head cache
+#
+# Copyright 2014 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import tempfile
+import shutil
+import os
+
+from .. import headcache
+
+DB_ID = '0123456789abcdef0123456789abcdef01234567'
+
+
+class TestHeadCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_store_and_get(self):
+        cache = headcache.HeadCache(self.cache_dir, 1000)
+        self.assertIsNone(cache.get(DB_ID, 0))
+
+        cache.store(DB_ID, 0, 'foo')
+        self.assertIn((DB_ID, 0), cache)
+        self.assertNotIn((DB_ID, 1), cache)
+        self.assertEqual(cache.get(DB_ID, 0), 'foo')
+
+        # Should survive restarts
+        cache = headcache.HeadCache(self.cache_dir, 1000)
+        self.assertEqual(cache.total_bytes, 3)
+        self.assertEqual(cache.get(DB_ID, 0), 'foo')
+
+    def test_lru_eviction(self):
+        cache = headcache.HeadCache(self.cache_dir, 250)
+        cache.store(DB_ID, 0, 'a' * 100)
+        cache.store(DB_ID, 1, 'b' * 100)
+
+        # Using the first one makes the second the oldest
+        self.assertEqual(cache.get(DB_ID, 0), 'a' * 100)
+
+        cache.store(DB_ID, 2, 'c' * 100)
+        self.assertIn((DB_ID, 0), cache)
+        self.assertNotIn((DB_ID, 1), cache)
+        self.assertIn((DB_ID, 2), cache)
+        self.assertEqual(cache.total_bytes, 200)
+        self.assertFalse(os.path.exists(cache.get_path(DB_ID, 1)))
+
+    def test_shrink_on_start(self):
+        cache = headcache.HeadCache(self.cache_dir, 1000)
+        cache.store(DB_ID, 0, 'a' * 100)
+        cache.store('another_disc', 0, 'b' * 100)
+
+        cache = headcache.HeadCache(self.cache_dir, 150)
+        self.assertEqual(len(cache.entries), 1)
+        self.assertEqual(cache.total_bytes, 100)
+
+    def test_too_big(self):
+        cache = headcache.HeadCache(self.cache_dir, 10)
+        cache.store(DB_ID, 0, 'a' * 100)
+        self.assertNotIn((DB_ID, 0), cache)
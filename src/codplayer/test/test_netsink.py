@@ -0,0 +1,266 @@
+# codplayer - test the network sink and receiver
+#
+# Copyright 2014 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import threading
+import time
+import sys
+import os
+
+from .. import netsink
+from .. import sink
+from .. import model
+
+debug = os.getenv('DEBUG_TEST', 'fake-string-to-disable-logging')
+
+
+class TestMessages(unittest.TestCase):
+
+    def test_split_stream(self):
+        data = (netsink.encode_message(netsink.DATA, 17, model.PCM, 4711, 1.5,
+                                       payload = 'abcd')
+                + netsink.encode_message(netsink.ACK, 17, None, 100, flags = netsink.ACK_PAUSED,
+                                         payload = 'device error'))
+
+        parser = netsink.MessageParser()
+        self.assertEqual(parser.feed(data[:10]), [])
+
+        msgs = parser.feed(data[10:-3])
+        self.assertEqual(len(msgs), 1)
+        msg = msgs[0]
+        self.assertEqual(msg.type, netsink.DATA)
+        self.assertEqual(msg.stream_id, 17)
+        self.assertEqual(msg.channels, 2)
+        self.assertEqual(msg.bytes_per_sample, 2)
+        self.assertEqual(msg.big_endian, 1)
+        self.assertEqual(msg.rate, 44100)
+        self.assertEqual(msg.frame_pos, 4711)
+        self.assertEqual(msg.timestamp, 1.5)
+        self.assertEqual(msg.payload, 'abcd')
+
+        msgs = parser.feed(data[-3:])
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(msgs[0].type, netsink.ACK)
+        self.assertEqual(msgs[0].flags, netsink.ACK_PAUSED)
+        self.assertEqual(msgs[0].payload, 'device error')
+
+
+    def test_bad_magic(self):
+        parser = netsink.MessageParser()
+        with self.assertRaises(netsink.ProtocolError):
+            parser.feed('X' * netsink.HEADER.size)
+
+
+class TestJitterBuffer(unittest.TestCase):
+
+    def test_buffer_to_target(self):
+        jb = netsink.JitterBuffer(4, 3)
+        jb.put(0, 'aaaa')
+        jb.put(1, 'bbbb')
+        self.assertIsNone(jb.get())
+
+        jb.put(2, 'cccc')
+        self.assertEqual(jb.get(), (0, 'aaaa', False))
+        self.assertEqual(jb.get(), (1, 'bbbb', False))
+        self.assertEqual(jb.get(), (2, 'cccc', False))
+
+        # Underrun, so fill up to the target again
+        self.assertIsNone(jb.get())
+        self.assertEqual(jb.underruns, 1)
+        jb.put(3, 'dddd')
+        self.assertIsNone(jb.get())
+
+
+    def test_reorder_and_fill_gaps(self):
+        jb = netsink.JitterBuffer(4, 1)
+        jb.put(2, 'cccc')
+        jb.put(0, 'aaaaaaaa')
+        jb.put(5, 'ffff')
+
+        self.assertEqual(jb.get(), (0, 'aaaaaaaa', False))
+        self.assertEqual(jb.get(), (2, 'cccc', False))
+        self.assertEqual(jb.get(), (3, '\0' * 8, True))
+        self.assertEqual(jb.silent_frames, 2)
+
+        # Too late to be played
+        self.assertFalse(jb.put(3, 'dddd'))
+        self.assertEqual(jb.late_frames, 1)
+
+        self.assertEqual(jb.get(), (5, 'ffff', False))
+
+
+    def test_end_of_stream(self):
+        jb = netsink.JitterBuffer(4, 100)
+        jb.put(0, 'aaaa')
+        self.assertIsNone(jb.get())
+        self.assertFalse(jb.at_end())
+
+        # Play what's left without waiting for the target level
+        jb.set_end(1)
+        self.assertEqual(jb.get(), (0, 'aaaa', False))
+        self.assertTrue(jb.at_end())
+        self.assertIsNone(jb.get())
+        self.assertEqual(jb.underruns, 0)
+
+
+#
+# Loopback tests of sender and receiver
+#
+
+class RecordingSink(sink.Sink):
+    """Receiver sink keeping the audio in memory, like a FileSink
+    without the file.
+    """
+
+    def __init__(self):
+        self.data = ''
+        self.calls = []
+        self.paused = threading.Event()
+
+    def pause(self):
+        self.calls.append('pause')
+        self.paused.set()
+        return True
+
+    def resume(self):
+        self.calls.append('resume')
+        self.paused.clear()
+
+    def stop(self):
+        self.calls.append('stop')
+
+    def start(self, format):
+        self.calls.append('start')
+        self.format = format
+
+    def add_packet(self, packet, offset):
+        self.data += packet.data[offset:]
+        return len(packet.data) - offset, packet, None
+
+    def drain(self):
+        self.calls.append('drain')
+        return None
+
+
+class AudioPacket(object):
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data) / model.PCM.bytes_per_frame
+        self.file_pos = 0
+
+
+class Config(object):
+    net_sink_host = '127.0.0.1'
+    net_sink_buffer_seconds = 1
+
+
+class DummyPlayer(object):
+    def __init__(self, test, port):
+        self._id = test.id()
+        self.cfg = Config()
+        self.cfg.net_sink_port = port
+
+    def log(self, msg, *args, **kwargs):
+        if debug in self._id:
+            sys.stderr.write('{0}: {1}: {2}\n'.format(
+                    self._id, threading.current_thread().name,
+                    msg.format(*args, **kwargs)))
+
+    debug = log
+
+
+class LoopbackTests(object):
+    PROTOCOL = None
+
+    def setUp(self):
+        player = DummyPlayer(self, None)
+        self.receiver = netsink.SinkReceiver(self.PROTOCOL, ('127.0.0.1', 0), 0,
+                                             player.log, player.debug)
+        host, port = self.receiver.bind()
+
+        self.recorder = RecordingSink()
+        self.receiver.start(self.recorder)
+
+        self.sink = netsink.NetworkSink(DummyPlayer(self, port), self.PROTOCOL)
+
+
+    def tearDown(self):
+        self.sink.close()
+        self.receiver.close()
+
+
+    def drain(self):
+        for i in range(20):
+            res = self.sink.drain()
+            if res is None:
+                return
+        self.fail('sink did not drain')
+
+
+    def test_play_and_drain(self):
+        # Frames of different values, split over several messages
+        packets = [AudioPacket(''.join(chr(i % 256) * 4 for i in range(n, n + 1000)))
+                   for n in range(0, 5000, 1000)]
+
+        self.sink.start(model.PCM)
+        for packet in packets:
+            offset = 0
+            while offset < len(packet.data):
+                stored, current_packet, error = self.sink.add_packet(packet, offset)
+                self.assertIsNone(error)
+                offset += stored
+
+        self.drain()
+
+        self.assertEqual(self.recorder.data, ''.join(p.data for p in packets))
+        self.assertEqual(self.recorder.calls, ['start', 'drain'])
+        self.assertEqual(self.recorder.format.rate, 44100)
+        self.assertTrue(self.recorder.format.big_endian)
+
+        # The receiver has played everything
+        self.assertEqual(self.sink.get_playing_offset(), (packets[-1], 999))
+
+        self.sink.stop()
+        for i in range(20):
+            if 'stop' in self.recorder.calls:
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.recorder.calls, ['start', 'drain', 'stop'])
+
+
+    def test_pause_resume(self):
+        packet = AudioPacket('\1' * 4000)
+        self.sink.start(model.PCM)
+        self.assertEqual(self.sink.add_packet(packet, 0)[0], 4000)
+
+        # Pause while playing
+        for i in range(20):
+            if len(self.recorder.data) == len(packet.data):
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.recorder.data, packet.data)
+
+        self.assertTrue(self.sink.pause())
+        self.assertTrue(self.recorder.paused.wait(5))
+
+        # The pause is acknowledged
+        for i in range(20):
+            if self.sink.acked_flags & netsink.ACK_PAUSED:
+                break
+            time.sleep(0.1)
+        self.assertTrue(self.sink.acked_flags & netsink.ACK_PAUSED)
+
+        self.sink.resume()
+        self.drain()
+        self.assertEqual(self.recorder.calls, ['start', 'pause', 'resume', 'drain'])
+
+
+class TestTCPLoopback(LoopbackTests, unittest.TestCase):
+    PROTOCOL = 'tcp'
+
+
+class TestUDPLoopback(LoopbackTests, unittest.TestCase):
+    PROTOCOL = 'udp'
@@ -18,6 +18,8 @@ from .. import sink
 from .. import model
 from .. import audio
 
+from .test_sink import RecordingSink, FanoutPlayer
+
 debug = os.getenv('DEBUG_TEST', 'fake-string-to-disable-logging')
 
 #
@@ -73,11 +75,14 @@ class DummySource(source.Source):
         self.num_packets = num_packets or self.TRACK_LENGTH_SECS
 
 
-    def iter_packets(self, track_number, packet_rate):
+    def iter_packets(self, track_number, packet_rate, position = 0):
+        # Start on the packet (i.e. second) containing the position
+        first_packet = position / model.PCM.rate
+
         while track_number < len(self.disc.tracks):
             track = self.disc.tracks[track_number]
 
-            for i in xrange(self.num_packets):
+            for i in xrange(first_packet, self.num_packets):
                 if track.pause_after and i + 1 == self.num_packets:
                     flags = audio.AudioPacket.PAUSE_AFTER
                 else:
@@ -89,6 +94,7 @@ class DummySource(source.Source):
                 yield packet
 
             track_number += 1
+            first_packet = 0
 
 
 class DummySink(sink.Sink):
@@ -144,6 +150,15 @@ class DummySink(sink.Sink):
         return self.on_call('drain')
 
 
+class DelaySink(DummySink):
+    """Sink which can tell the position heard from the device."""
+
+    playing_offset = None
+
+    def get_playing_offset(self):
+        return self.playing_offset
+
+
 class Expect(object):
     def __init__(self, func, msg = None, checks = None, ret = None):
         self.func = func
@@ -894,6 +909,164 @@ class TestTransport(unittest.TestCase):
         self.assertEqual(t.state.state, player.State.STOP)
 
 
+    def test_seek_and_skip(self):
+        # Two tracks with five packets each
+        src = DummySource('disc1', 2, 5)
+
+        # Wait for test to finish on an event
+        done = threading.Event()
+
+        expects = DummySink(
+            self,
+            Expect('start', 'should call start on new disc',
+                   checks = lambda format: (
+                    self.assertEqual(t.state.track, 1, 'should start playing first track'),
+                    ),
+                ),
+
+            Expect('add_packet', 'should add first packet of first track',
+                   checks = lambda packet, offset: (
+                    self.assertEqual(packet.track_number, 0, 'should be first track record'),
+
+                    # Jump into the second track
+                    t.seek(2, 3),
+
+                    self.assertIs(t.state.state, player.State.WORKING,
+                                  'state should be WORKING while waiting for seek'),
+                    self.assertEqual(t.state.track, 2, 'track should be updated'),
+                    self.assertEqual(t.state.position, 3, 'position should be updated'),
+                    ),
+
+                   ret = lambda packet, offset: (len(packet.data), packet, None),
+                   ),
+
+            Expect('stop', 'should be told to stop by transport on seeking'),
+
+            Expect('start', 'should call start after seeking'),
+
+            Expect('add_packet', 'should add packet at seek position',
+                   checks = lambda packet, offset: (
+                    self.assertEqual(packet.track_number, 1, 'should be second track record'),
+                    self.assertEqual(packet.abs_pos, 3 * model.PCM.rate),
+
+                    self.assertIs(t.state.state, player.State.PLAY),
+                    self.assertEqual(t.state.position, 3),
+
+                    # Skip forward a second
+                    t.skip(1),
+
+                    self.assertIs(t.state.state, player.State.WORKING,
+                                  'state should be WORKING while waiting for skip'),
+                    self.assertEqual(t.state.track, 2),
+                    self.assertEqual(t.state.position, 4),
+                    ),
+
+                   ret = lambda packet, offset: (len(packet.data), packet, None),
+                   ),
+
+            Expect('stop', 'should be told to stop by transport on skipping'),
+
+            Expect('start', 'should call start after skipping'),
+
+            Expect('add_packet', 'should add packet at skipped position',
+                   checks = lambda packet, offset: (
+                    self.assertEqual(packet.track_number, 1, 'should be second track record'),
+                    self.assertEqual(packet.abs_pos, 4 * model.PCM.rate),
+
+                    # Skipping past the end of the disc stops
+                    t.skip(src.TRACK_LENGTH_SECS),
+
+                    self.assertIs(t.state.state, player.State.STOP,
+                                  'state should be STOP after skipping past last track'),
+                    ),
+
+                   ret = lambda packet, offset: (len(packet.data), packet, None),
+                   ),
+
+            Expect('stop', 'should call stop when skipping past end of disc',
+                   checks = lambda: (
+                    done.set(),
+                    ),
+                ),
+           )
+
+        # Kick off test and wait for it
+        t, p = create_transport(self, expects)
+        t.new_source(src)
+        self.assertTrue(done.wait(5), 'timeout waiting for test to finish')
+
+        expects.done()
+        self.assertEqual(t.state.state, player.State.STOP)
+
+        # Invalid positions
+        with self.assertRaises(player.CommandError):
+            t.seek(3, 0)
+        with self.assertRaises(player.CommandError):
+            t.seek(1, src.TRACK_LENGTH_SECS)
+
+
+    def test_audible_position(self):
+        # Single track with three packets
+        src = DummySource('disc1', 1, 3)
+
+        # Wait for test to finish on an event
+        done = threading.Event()
+
+        expects = DelaySink(
+            self,
+            Expect('start', 'should call start on new disc'),
+
+            Expect('add_packet', 'should add first packet',
+                   checks = lambda packet, offset: (
+                    # Device is halfway into the first packet
+                    setattr(expects, 'playing_offset', (packet, model.PCM.rate / 2)),
+                    ),
+
+                   ret = lambda packet, offset: (len(packet.data), packet, None),
+                   ),
+
+            Expect('add_packet', 'should add second packet',
+                   checks = lambda packet, offset: (
+                    self.assertEqual(t.state.position, 0,
+                                     'state should show position heard in first packet'),
+                    self.assertEqual(t.state.position_frames, model.PCM.rate / 2),
+
+                    # Device can't tell, so fall back on the packet played by the sink
+                    setattr(expects, 'playing_offset', None),
+                    ),
+
+                   ret = lambda packet, offset: (len(packet.data), packet, None),
+                   ),
+
+            Expect('add_packet', 'should add third packet',
+                   checks = lambda packet, offset: (
+                    self.assertEqual(t.state.position, 1,
+                                     'state should show second packet'),
+                    self.assertEqual(t.state.position_frames, model.PCM.rate),
+                    ),
+
+                   ret = lambda packet, offset: (len(packet.data), packet, None),
+                   ),
+
+            Expect('drain', 'final call to be notified that draining is done',
+                   ret = lambda: None,
+                   ),
+
+            Expect('stop', 'should call stop at end of disc',
+                   checks = lambda: (
+                    done.set(),
+                    ),
+                ),
+           )
+
+        # Kick off test and wait for it
+        t, p = create_transport(self, expects)
+        t.new_source(src)
+        self.assertTrue(done.wait(5), 'timeout waiting for test to finish')
+
+        expects.done()
+
+
     def test_prev_track(self):
         # Two tracks with four packets each, to be able to test restarting track
         src = DummySource('disc1', 2, 4)
@@ -1476,3 +1649,82 @@ class TestTransport(unittest.TestCase):
         # Check final state
         expects.done()
         self.assertEqual(t.state.state, player.State.STOP)
+
+
+
+#
+# Transport feeding a fanout sink through the ring buffer
+#
+
+class RingConfig(object):
+    transport_buffer_seconds = 1
+    transport_packets_per_second = 5
+    transport_buffer_adaptive = False
+
+
+class LetterSource(DummySource):
+    """Packet source where each packet is a quarter of a second of
+    a single letter.
+    """
+    PACKET_FRAMES = model.PCM.rate / 4
+
+    def iter_packets(self, track_number, packet_rate, position = 0):
+        track = self.disc.tracks[0]
+        for i in xrange(self.num_packets):
+            packet = audio.AudioPacket(self.disc, track, 0, i * self.PACKET_FRAMES,
+                                       self.PACKET_FRAMES)
+            packet.data = chr(ord('A') + i) * (self.PACKET_FRAMES * model.PCM.bytes_per_frame)
+            yield packet
+
+
+class TestTransportFanout(unittest.TestCase):
+
+    def setUp(self):
+        sink.SINKS['test'] = RecordingSink
+
+    def tearDown(self):
+        del sink.SINKS['test']
+
+    def test_queued_data_survives_ring_reuse(self):
+        fanout_player = FanoutPlayer('detach')
+        fanout = sink.FanoutSink(fanout_player)
+        outputs = fanout_player.outputs
+        for output in outputs:
+            output.blocked.set()
+
+        publisher = TestPublisher(self)
+        transport_player = DummyPlayer(self, publisher)
+        transport_player.cfg = RingConfig()
+        t = player.Transport(transport_player, fanout)
+        self.addCleanup(t.shutdown)
+
+        # More packets than fit in the ring, but not in the fanout queues
+        src = LetterSource('disc1', 1, 16)
+        total_bytes = 16 * LetterSource.PACKET_FRAMES * model.PCM.bytes_per_frame
+        self.assertGreater(total_bytes, t.buffer.size)
+        t.new_source(src)
+
+        # Let the transport reuse the ring while the outputs are blocked
+        for i in range(100):
+            stats = fanout.get_stats()['outputs']
+            if all(o['queued_bytes'] == total_bytes for o in stats):
+                break
+            time.sleep(0.05)
+        else:
+            self.fail('packets not queued in fanout outputs')
+
+        for output in outputs:
+            output.blocked.clear()
+
+        for i in range(100):
+            if t.state.state == player.State.STOP:
+                break
+            time.sleep(0.05)
+        self.assertEqual(t.state.state, player.State.STOP)
+
+        packet_bytes = total_bytes / 16
+        expected = ''.join(chr(ord('A') + i) * packet_bytes for i in range(16))
+        for output in outputs:
+            letters = output.data[::packet_bytes]
+            self.assertEqual(letters, 'ABCDEFGHIJKLMNOP')
+            self.assertTrue(output.data == expected, 'overwritten packet data')
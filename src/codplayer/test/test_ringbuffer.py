@@ -0,0 +1,178 @@
+# codplayer - test the transport ring buffer
+#
+# Copyright 2014 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import threading
+
+from .. import ringbuffer
+
+
+class Packet(object):
+    def __init__(self, data):
+        self.data = data
+
+class EndOfStream(object):
+    pass
+
+
+class TestPacketRingBuffer(unittest.TestCase):
+
+    def test_put_get(self):
+        buf = ringbuffer.PacketRingBuffer(10, 5)
+
+        p1 = Packet('abcd')
+        self.assertTrue(buf.put(p1, 0))
+        self.assertEqual(str(p1.data), 'abcd')
+
+        eos = EndOfStream()
+        self.assertTrue(buf.put(eos, 0))
+        self.assertEqual(buf.fill_level(), (2, 4))
+
+        self.assertIs(buf.get(), p1)
+        self.assertEqual(str(p1.data), 'abcd')
+        buf.release(p1)
+
+        self.assertIs(buf.get(), eos)
+        buf.release(eos)
+        self.assertEqual(buf.fill_level(), (0, 0))
+
+    def test_put_without_copy(self):
+        buf = ringbuffer.PacketRingBuffer(10, 5)
+
+        silence = '\0' * 20
+        p1 = Packet(silence)
+        self.assertTrue(buf.put(p1, 0, copy = False))
+        self.assertIs(p1.data, silence)
+
+        # Only takes a slot in the side table
+        p2 = Packet('abcd')
+        buf.put(p2, 0)
+        self.assertEqual(buf.fill_level(), (2, 4))
+
+        self.assertIs(buf.get(), p1)
+        buf.release(p1)
+        self.assertEqual(buf.fill_level(), (1, 4))
+
+        self.assertIs(buf.get(), p2)
+        self.assertEqual(str(p2.data), 'abcd')
+        buf.release(p2)
+        self.assertEqual(buf.fill_level(), (0, 0))
+
+    def test_wrap_keeps_data_contiguous(self):
+        buf = ringbuffer.PacketRingBuffer(10, 5)
+
+        p1 = Packet('abcdef')
+        p2 = Packet('ghi')
+        buf.put(p1, 0)
+        buf.put(p2, 0)
+
+        self.assertIs(buf.get(), p1)
+        buf.release(p1)
+
+        # Doesn't fit at the end, so should start over at the beginning
+        p3 = Packet('jklm')
+        buf.put(p3, 0)
+        self.assertEqual(buf.fill_level(), (2, 3 + 1 + 4))
+
+        self.assertIs(buf.get(), p2)
+        self.assertEqual(str(p2.data), 'ghi')
+        buf.release(p2)
+
+        self.assertIs(buf.get(), p3)
+        self.assertEqual(str(p3.data), 'jklm')
+        buf.release(p3)
+
+    def test_flush_wakes_blocked_put(self):
+        buf = ringbuffer.PacketRingBuffer(10, 5)
+        buf.put(Packet('0123456789'), 0)
+
+        result = []
+        t = threading.Thread(target = lambda: result.append(buf.put(Packet('x'), 0)))
+        t.start()
+
+        buf.flush(1)
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(result, [False])
+        self.assertEqual(buf.fill_level(), (0, 0))
+
+        # Puts for the new context work
+        self.assertTrue(buf.put(Packet('y'), 1))
+
+    def test_flush_keeps_held_packet(self):
+        buf = ringbuffer.PacketRingBuffer(10, 5)
+        p1 = Packet('abcde')
+        buf.put(p1, 0)
+        buf.put(Packet('fgh'), 0)
+
+        self.assertIs(buf.get(), p1)
+        buf.flush(1)
+
+        # Held data must not be overwritten by new packets
+        p2 = Packet('ijklm')
+        buf.put(p2, 1)
+        self.assertEqual(str(p1.data), 'abcde')
+        self.assertEqual(str(p2.data), 'ijklm')
+        buf.release(p1)
+
+        self.assertIs(buf.get(), p2)
+        buf.release(p2)
+        self.assertEqual(buf.fill_level(), (0, 0))
+
+    def test_max_packets(self):
+        buf = ringbuffer.PacketRingBuffer(100, 1)
+        buf.put(Packet('a'), 0)
+
+        t = threading.Thread(target = buf.put, args = (Packet('b'), 0))
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive(), 'put should block on full side table')
+
+        buf.release(buf.get())
+        t.join(5)
+        self.assertFalse(t.is_alive())
+
+    def test_resize(self):
+        buf = ringbuffer.PacketRingBuffer(10, 5)
+        p1 = Packet('abcdefgh')
+        buf.put(p1, 0)
+
+        buf.resize(20, 5)
+        self.assertEqual(buf.fill_level(), (1, 0))
+
+        # Old packet data is still valid, and doesn't take space
+        p2 = Packet('0123456789' * 2)
+        self.assertTrue(buf.put(p2, 0))
+        self.assertEqual(str(p1.data), 'abcdefgh')
+
+        buf.release(buf.get())
+        self.assertEqual(buf.fill_level(), (1, 20))
+        buf.release(buf.get())
+        self.assertEqual(buf.fill_level(), (0, 0))
+
+
+class TestAdaptiveBufferSize(unittest.TestCase):
+
+    def test_grow_and_shrink(self):
+        sizer = ringbuffer.AdaptiveBufferSize(2, 20, 0)
+        self.assertEqual(sizer.secs, 2)
+
+        # Fast reads change nothing
+        self.assertIsNone(sizer.update(0.01, 1))
+
+        # Slow reads grow the buffer immediately
+        self.assertEqual(sizer.update(1, 2), 5)
+        self.assertEqual(sizer.update(3, 3), 13)
+        self.assertEqual(sizer.update(10, 4), 20)
+        self.assertIsNone(sizer.update(10, 5))
+
+        # Shrink step by step after a while of fast reads
+        self.assertIsNone(sizer.update(0.01, 5 + sizer.SHRINK_DELAY))
+        self.assertEqual(sizer.update(0.01, 6 + sizer.SHRINK_DELAY), 10)
+        self.assertIsNone(sizer.update(0.01, 7 + sizer.SHRINK_DELAY))
+        self.assertEqual(sizer.update(0.01, 7 + 2 * sizer.SHRINK_DELAY), 5)
+        self.assertEqual(sizer.update(0.01, 8 + 3 * sizer.SHRINK_DELAY), 2)
+        self.assertIsNone(sizer.update(0.01, 9 + 4 * sizer.SHRINK_DELAY))
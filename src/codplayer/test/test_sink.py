@@ -0,0 +1,514 @@
+# codplayer - test the sink helpers
+#
+# Copyright 2014 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import threading
+import time
+import sys
+
+from .. import sink
+
+
+class TestSinkStats(unittest.TestCase):
+
+    def test_no_writes(self):
+        stats = sink.SinkStats().get_stats(0)
+
+        self.assertEqual(stats['periods_written'], 0)
+        self.assertIsNone(stats['xruns'])
+        self.assertIsNone(stats['buffer_fill_avg'])
+        self.assertEqual(len(stats['write_latency_ms']),
+                         len(sink.WRITE_LATENCY_LIMITS_MS) + 1)
+
+
+    def test_write_latency(self):
+        counters = sink.SinkStats()
+        counters.record_write(0.0005)
+        counters.record_write(0.095)
+        counters.record_write(0.099)
+        counters.record_write(0.1)
+        counters.record_write(2)
+
+        stats = counters.get_stats(0)
+        self.assertEqual(stats['periods_written'], 5)
+        self.assertAlmostEqual(stats['write_seconds'], 2.2945)
+        self.assertEqual(stats['write_max_seconds'], 2)
+
+        latency = dict(stats['write_latency_ms'])
+        self.assertEqual(latency[1], 1)
+        self.assertEqual(latency[100], 2)
+        self.assertEqual(latency[200], 1)
+        self.assertEqual(latency[None], 1)
+        self.assertEqual(sum(latency.values()), 5)
+
+
+    def test_buffer_fill(self):
+        counters = sink.SinkStats()
+        counters.record_fill(100)
+        counters.record_fill(0)
+        counters.record_fill(500)
+
+        stats = counters.get_stats(1000)
+        self.assertEqual(stats['buffer_size'], 1000)
+        self.assertEqual(stats['buffer_fill_min'], 0)
+        self.assertEqual(stats['buffer_fill_max'], 500)
+        self.assertEqual(stats['buffer_fill_avg'], 200)
+
+        counters.reset_fill()
+        self.assertIsNone(counters.get_stats(1000)['buffer_fill_min'])
+
+
+class Format(object):
+    channels = 1
+    bytes_per_sample = 1
+    big_endian = False
+    rate = 100
+
+
+class Packet(object):
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+        self.file_pos = 0
+
+
+class RecordingSink(sink.Sink):
+    """Fanout output keeping the audio in memory.  If blocked, it
+    stores nothing, like a sink with a full buffer.
+    """
+
+    def __init__(self, player):
+        self.data = ''
+        self.calls = []
+        self.blocked = threading.Event()
+        player.outputs.append(self)
+
+    def pause(self):
+        self.calls.append('pause')
+        return True
+
+    def resume(self):
+        self.calls.append('resume')
+
+    def stop(self):
+        self.calls.append('stop')
+
+    def start(self, format):
+        self.calls.append('start')
+
+    def add_packet(self, packet, offset):
+        if self.blocked.is_set():
+            time.sleep(0.01)
+            return 0, None, None
+
+        self.data += packet.data[offset:]
+        return len(packet.data) - offset, packet, None
+
+    def drain(self):
+        return None
+
+
+class FanoutConfig(object):
+    fanout_devices = ['test', 'test']
+    fanout_buffer_seconds = 5
+    fanout_max_lag_seconds = 2
+
+
+class FanoutPlayer(object):
+    def __init__(self, policy):
+        self.cfg = FanoutConfig()
+        self.cfg.fanout_lag_policy = policy
+        self.outputs = []
+
+    def log(self, msg, *args, **kwargs):
+        pass
+
+    debug = log
+
+
+class TestFanoutSink(unittest.TestCase):
+
+    def setUp(self):
+        sink.SINKS['test'] = RecordingSink
+
+    def tearDown(self):
+        del sink.SINKS['test']
+
+        # Let the output threads go idle
+        for output in self.outputs:
+            output.blocked.clear()
+        self.fanout.stop()
+
+    def create(self, policy):
+        player = FanoutPlayer(policy)
+        self.fanout = sink.FanoutSink(player)
+        self.outputs = player.outputs
+        self.fanout.start(Format)
+        return self.fanout, self.outputs
+
+    def play(self, fanout, packets):
+        for packet in packets:
+            offset = 0
+            for i in range(100):
+                stored, current_packet, error = fanout.add_packet(packet, offset)
+                offset += stored
+                if offset == len(packet.data):
+                    break
+            else:
+                self.fail('packet not stored')
+
+        for i in range(20):
+            if fanout.drain() is None:
+                return
+        self.fail('fanout did not drain')
+
+
+    def test_play_all(self):
+        fanout, outputs = self.create('detach')
+        packets = [Packet(chr(i) * 50) for i in range(30)]
+        self.play(fanout, packets)
+
+        for output in outputs:
+            self.assertEqual(output.data, ''.join(p.data for p in packets))
+            self.assertEqual(output.calls, ['start'])
+
+        self.assertTrue(fanout.pause())
+        fanout.resume()
+        fanout.stop()
+        for output in outputs:
+            self.assertEqual(output.calls, ['start', 'pause', 'resume', 'stop'])
+
+
+    def test_detach(self):
+        fanout, outputs = self.create('detach')
+        outputs[1].blocked.set()
+
+        packets = [Packet(chr(i) * 50) for i in range(30)]
+        self.play(fanout, packets)
+
+        self.assertEqual(outputs[0].data, ''.join(p.data for p in packets))
+        self.assertEqual(outputs[1].data, '')
+        self.assertIn('stop', outputs[1].calls)
+
+        stats = fanout.get_stats()
+        self.assertEqual(stats['outputs'][1]['detaches'], 1)
+        self.assertTrue(stats['outputs'][1]['detached'])
+
+        # Attached again when restarted
+        fanout.start(Format)
+        self.assertFalse(fanout.get_stats()['outputs'][1]['detached'])
+
+
+    def test_drop(self):
+        fanout, outputs = self.create('drop')
+        outputs[1].blocked.set()
+
+        packets = [Packet(chr(i) * 50) for i in range(10)]
+        for packet in packets:
+            self.assertEqual(fanout.add_packet(packet, 0)[0], 50)
+
+        # Wait for the first output to play the queued audio
+        for i in range(100):
+            if len(outputs[0].data) == 500:
+                break
+            time.sleep(0.01)
+
+        # Catch up by dropping all but the packet being played
+        self.assertEqual(fanout.add_packet(Packet('x' * 50), 0)[0], 50)
+        stats = fanout.get_stats()['outputs'][1]
+        self.assertEqual(stats['dropped_bytes'], 450)
+        self.assertEqual(stats['queued_bytes'], 100)
+
+
+    def test_pause_others(self):
+        fanout, outputs = self.create('pause')
+        outputs[1].blocked.set()
+
+        for i in range(10):
+            fanout.add_packet(Packet(chr(i) * 50), 0)
+
+        for i in range(100):
+            if len(outputs[0].data) == 500:
+                break
+            time.sleep(0.01)
+
+        # No room in the lagging output
+        self.assertEqual(fanout.add_packet(Packet('x' * 50), 0)[0], 0)
+        self.assertEqual(outputs[0].calls, ['start', 'pause'])
+        self.assertEqual(outputs[1].calls, ['start'])
+
+        # Resume when the lagging output has caught up
+        outputs[1].blocked.clear()
+        for i in range(100):
+            if len(outputs[1].data) == 500:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(outputs[1].data), 500)
+
+        self.assertEqual(fanout.add_packet(Packet('y' * 50), 0)[0], 50)
+        self.assertEqual(outputs[0].calls, ['start', 'pause', 'resume'])
+
+
+#
+# PyAlsaSink tests, with a fake alsaaudio module
+#
+
+class FakeAlsaAudio(object):
+    """Stands in for the alsaaudio module, recording what is written
+    to the device.  Writes block while unblocked is cleared.
+    """
+
+    class ALSAAudioError(Exception): pass
+
+    PCM_PLAYBACK = 0
+    PCM_NORMAL = 0
+    PCM_FORMAT_S16_LE = 2
+    PCM_FORMAT_S16_BE = 3
+
+    def __init__(self):
+        self.missing = False
+        self.failing_writes = 0
+        self.formats = [self.PCM_FORMAT_S16_BE, self.PCM_FORMAT_S16_LE]
+        self.unblocked = threading.Event()
+        self.unblocked.set()
+        self.writing = threading.Event()
+        self.data = ''
+        self.calls = []
+
+    def PCM(self, type, mode, card):
+        if self.missing:
+            raise self.ALSAAudioError('no such device')
+        return FakePCM(self)
+
+
+class FakePCM(object):
+    def __init__(self, alsa):
+        self.alsa = alsa
+        self.channels = None
+
+    def setformat(self, format):
+        if format in self.alsa.formats:
+            return format
+        return self.alsa.formats[0]
+
+    def setrate(self, rate):
+        return rate
+
+    def setchannels(self, channels):
+        self.channels = channels
+        return channels
+
+    def setperiodsize(self, frames):
+        return frames
+
+    def write(self, data):
+        self.alsa.writing.set()
+        self.alsa.unblocked.wait()
+        if self.alsa.failing_writes > 0:
+            self.alsa.failing_writes -= 1
+            raise self.alsa.ALSAAudioError('write failed')
+        self.alsa.data += str(data)
+        return len(data) / (self.channels * 2)
+
+    def pause(self, enable):
+        self.alsa.calls.append(('pause', enable))
+
+    def drop(self):
+        self.alsa.calls.append('drop')
+
+    def close(self):
+        self.alsa.calls.append('close')
+
+
+# Import with the fake module in place, since alsaaudio may not be
+# installed.  The tests replace it again for each sink anyway.
+_alsaaudio = sys.modules.get('alsaaudio')
+sys.modules['alsaaudio'] = FakeAlsaAudio()
+try:
+    from .. import py_alsa_sink
+finally:
+    if _alsaaudio is None:
+        del sys.modules['alsaaudio']
+    else:
+        sys.modules['alsaaudio'] = _alsaaudio
+
+
+class AlsaPlayer(object):
+    def log(self, msg, *args, **kwargs):
+        pass
+
+    debug = log
+
+
+class TestPyAlsaSink(unittest.TestCase):
+    # 4 byte frames, 16 byte periods and four periods in the buffer
+    RATE = 16
+    PERIOD_FRAMES = 4
+
+    def setUp(self):
+        self.alsa = FakeAlsaAudio()
+        self.orig_alsaaudio = py_alsa_sink.alsaaudio
+        py_alsa_sink.alsaaudio = self.alsa
+
+    def tearDown(self):
+        self.alsa.unblocked.set()
+        py_alsa_sink.alsaaudio = self.orig_alsaaudio
+
+    def create(self, start_without_device = False):
+        alsa_sink = py_alsa_sink.PyAlsaSink(
+            AlsaPlayer(), 'default', start_without_device, False,
+            period_frames = self.PERIOD_FRAMES, buffer_seconds = 1)
+        alsa_sink.REOPEN_DELAY = 0.1
+        self.addCleanup(alsa_sink.stop)
+
+        # Forget about the device being probed when created
+        del self.alsa.calls[:]
+        return alsa_sink
+
+    def add(self, alsa_sink, data, check_error = True):
+        offset = 0
+        for i in range(100):
+            stored, playing_packet, error = alsa_sink.add_packet(data, data, offset)
+            if check_error:
+                self.assertIsNone(error)
+            offset += stored
+            if offset == len(data):
+                return
+        self.fail('data not stored')
+
+    def drain(self, alsa_sink):
+        for i in range(100):
+            if alsa_sink.drain() is None:
+                return
+        self.fail('sink did not drain')
+
+
+    def test_play_and_drain(self):
+        alsa_sink = self.create()
+        alsa_sink.start(2, 2, self.RATE, True)
+
+        data = ''.join(chr(i) for i in range(100))
+        self.add(alsa_sink, data)
+        self.drain(alsa_sink)
+
+        # The last period is padded with silence
+        self.assertEqual(self.alsa.data, data + '\0' * 12)
+        self.assertEqual(alsa_sink.played_frames(), 28)
+        self.assertEqual(self.alsa.calls, ['close'])
+        self.assertEqual(alsa_sink.stats()['periods_written'], 7)
+
+
+    def test_no_swap(self):
+        self.alsa.formats = [self.alsa.PCM_FORMAT_S16_LE]
+        alsa_sink = self.create()
+        alsa_sink.start(2, 2, self.RATE, False)
+
+        self.add(alsa_sink, 'abcd' * 8)
+        self.drain(alsa_sink)
+        self.assertEqual(self.alsa.data, 'abcd' * 8)
+
+
+    def test_swap(self):
+        # Device only accepts little endian
+        self.alsa.formats = [self.alsa.PCM_FORMAT_S16_LE]
+        alsa_sink = self.create()
+        alsa_sink.start(2, 2, self.RATE, True)
+
+        self.add(alsa_sink, 'abcd' * 8)
+        self.drain(alsa_sink)
+        self.assertEqual(self.alsa.data, 'badc' * 8)
+
+
+    def test_swap_retried_write(self):
+        self.alsa.formats = [self.alsa.PCM_FORMAT_S16_LE]
+        self.alsa.failing_writes = 1
+        alsa_sink = self.create()
+        alsa_sink.start(2, 2, self.RATE, True)
+
+        # The period is written again after reopening the device,
+        # and must not be swapped twice
+        self.add(alsa_sink, 'abcd' * 8, check_error = False)
+        self.drain(alsa_sink)
+        self.assertEqual(self.alsa.data, 'badc' * 8)
+        self.assertEqual(self.alsa.calls, ['drop', 'close', 'close'])
+
+
+    def test_pause_resume(self):
+        alsa_sink = self.create()
+        alsa_sink.start(2, 2, self.RATE, True)
+        self.add(alsa_sink, 'a' * 32)
+
+        self.assertTrue(alsa_sink.pause())
+        self.assertEqual(self.alsa.calls, [('pause', 1)])
+
+        alsa_sink.resume()
+        self.assertEqual(self.alsa.calls, [('pause', 1), ('pause', 0)])
+
+        self.add(alsa_sink, 'b' * 32)
+        self.drain(alsa_sink)
+        self.assertEqual(self.alsa.data, 'a' * 32 + 'b' * 32)
+
+
+    def test_stop_while_blocked(self):
+        alsa_sink = self.create()
+        alsa_sink.start(2, 2, self.RATE, True)
+
+        # Fill the buffer while the device is blocked in a write
+        self.alsa.unblocked.clear()
+        self.add(alsa_sink, 'a' * 64)
+        self.assertTrue(self.alsa.writing.wait(5))
+
+        result = []
+        t = threading.Thread(
+            target = lambda: result.append(alsa_sink.add_packet('b' * 16, None)))
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive(), 'add_packet should wait for room')
+
+        stopper = threading.Thread(target = alsa_sink.stop)
+        stopper.start()
+
+        # Only let the device write finish when stopping, so no room
+        # is freed up for add_packet() before that
+        for i in range(100):
+            if alsa_sink.state == alsa_sink.CLOSING:
+                break
+            time.sleep(0.01)
+        self.assertEqual(alsa_sink.state, alsa_sink.CLOSING)
+        self.alsa.unblocked.set()
+
+        stopper.join(5)
+        t.join(5)
+        self.assertFalse(stopper.is_alive())
+        self.assertFalse(t.is_alive())
+
+        # Nothing stored after stopping, and the rest dropped
+        self.assertEqual(result[0][0], 0)
+        self.assertEqual(alsa_sink.state, alsa_sink.CLOSED)
+        self.assertEqual(self.alsa.calls, ['drop', 'close'])
+        self.assertEqual(alsa_sink.drain(), None)
+
+
+    def test_device_missing(self):
+        self.alsa.missing = True
+        with self.assertRaises(sink.SinkError):
+            py_alsa_sink.PyAlsaSink(AlsaPlayer(), 'default', False, False)
+
+        alsa_sink = self.create(start_without_device = True)
+        alsa_sink.start(2, 2, self.RATE, True)
+
+        for i in range(100):
+            stored, playing_packet, error = alsa_sink.add_packet('a' * 16, None)
+            if error:
+                break
+        self.assertEqual(stored, 0)
+        self.assertEqual(error, 'no such device')
+
+        # Plays once the device is back
+        self.alsa.missing = False
+        self.add(alsa_sink, 'a' * 16)
+        self.drain(alsa_sink)
+        self.assertEqual(self.alsa.data, 'a' * 16)
@@ -0,0 +1,256 @@
+# codplayer - test the audio sources
+#
+# Copyright 2014 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import tempfile
+import shutil
+import threading
+import time
+import os
+
+from .. import source
+from .. import model
+from .. import fileio
+from .. import audio
+from .. import headcache
+
+# Two tracks of two seconds each, the second one having a one second
+# pregap where the first 0.4 seconds are silence
+TRACK_SECS = 2
+TRACK_FRAMES = TRACK_SECS * model.PCM.rate
+FILE_BYTES = 2 * TRACK_FRAMES * model.PCM.bytes_per_frame
+
+AUDIO_DATA = ''.join([chr(i % 251) for i in xrange(FILE_BYTES)])
+
+
+class DummyConfig:
+    audio_file_mmap = False
+    readahead_seconds = 0
+    head_cache_seconds = 1
+
+class DummyDB:
+    def __init__(self, disc_dir):
+        self.disc_dir = disc_dir
+
+    def disc_to_db_id(self, disc_id):
+        return '0123456789abcdef0123456789abcdef01234567'
+
+    def get_disc_dir(self, db_id):
+        return self.disc_dir
+
+class DummyPlayer:
+    audio_streamer_perf_log = None
+
+    def __init__(self, disc_dir, cfg, head_cache = None):
+        self.db = DummyDB(disc_dir)
+        self.cfg = cfg
+        self.head_cache = head_cache
+
+    def log(self, msg, *args, **kwargs):
+        pass
+
+    debug = log
+
+
+def create_disc():
+    disc = model.DbDisc()
+    disc.disc_id = 'disc1'
+    disc.audio_format = model.PCM
+    disc.data_file_name = 'data.cdr'
+
+    for i in range(2):
+        track = model.DbTrack()
+        track.length = TRACK_FRAMES
+        track.file_offset = i * TRACK_FRAMES
+        disc.add_track(track)
+
+    disc.tracks[1].pregap_offset = model.PCM.rate
+    disc.tracks[1].pregap_silence = 2 * model.PCM.rate / 5
+    return disc
+
+
+class TestPCMDiscSource(unittest.TestCase):
+    def setUp(self):
+        self.disc_dir = tempfile.mkdtemp()
+        self.data_path = os.path.join(self.disc_dir, 'data.cdr')
+        self.cfg = DummyConfig()
+
+    def tearDown(self):
+        shutil.rmtree(self.disc_dir)
+
+    def write_data(self, data, mode = 'wb'):
+        with open(self.data_path, mode) as f:
+            f.write(data)
+
+    def check_packets(self, src, track_number = 0):
+        count = 0
+        for p in src.iter_packets(track_number, 5):
+            if p is None:
+                continue
+
+            count += 1
+            length = p.length * model.PCM.bytes_per_frame
+            self.assertEqual(len(p.data), length)
+
+            if p.file_pos is None:
+                self.assertEqual(str(p.data), '\0' * length)
+            else:
+                pos = p.file_pos * model.PCM.bytes_per_frame
+                self.assertEqual(str(p.data), AUDIO_DATA[pos : pos + length])
+
+        return count
+
+    def test_read_file(self):
+        self.write_data(AUDIO_DATA)
+        src = source.PCMDiscSource(DummyPlayer(self.disc_dir, self.cfg), create_disc(), False)
+        self.assertEqual(self.check_packets(src), 20)
+
+    def test_read_data_is_not_shared(self):
+        self.write_data(AUDIO_DATA)
+        src = source.PCMDiscSource(DummyPlayer(self.disc_dir, self.cfg), create_disc(), False)
+        for p in src.iter_packets(0, 5):
+            if p is not None:
+                self.assertEqual(src.is_shared_data(p), p.file_pos is None)
+
+    def test_read_file_with_readahead(self):
+        self.cfg.readahead_seconds = 1
+        self.write_data(AUDIO_DATA)
+        src = source.PCMDiscSource(DummyPlayer(self.disc_dir, self.cfg), create_disc(), False)
+        self.assertEqual(self.check_packets(src), 20)
+
+        # Hints should have been given, unless not supported at all
+        if src.readahead_bytes > 0:
+            self.assertEqual(src.readahead_track, 1)
+            self.assertGreater(src.readahead_end, src.read_end)
+
+    def test_mmap_file(self):
+        self.cfg.audio_file_mmap = True
+        self.write_data(AUDIO_DATA)
+        src = source.PCMDiscSource(DummyPlayer(self.disc_dir, self.cfg), create_disc(), False)
+        self.assertEqual(self.check_packets(src), 20)
+        self.assertIsNotNone(src.audio_map)
+
+        # The mapped data doesn't have to be copied
+        for p in src.iter_packets(0, 5):
+            if p is not None:
+                self.assertTrue(src.is_shared_data(p))
+
+    def test_mmap_growing_file(self):
+        self.cfg.audio_file_mmap = True
+        self.write_data(AUDIO_DATA[:10000])
+        src = source.PCMDiscSource(DummyPlayer(self.disc_dir, self.cfg), create_disc(), True)
+
+        def rip():
+            time.sleep(0.2)
+            self.write_data(AUDIO_DATA[10000:], 'ab')
+            src.rip_finished()
+
+        t = threading.Thread(target = rip)
+        t.start()
+        self.assertEqual(self.check_packets(src), 20)
+        t.join()
+
+    def test_mmap_truncated_file(self):
+        self.cfg.audio_file_mmap = True
+        self.write_data(AUDIO_DATA[:10000])
+        src = source.PCMDiscSource(DummyPlayer(self.disc_dir, self.cfg), create_disc(), False)
+        with self.assertRaisesRegexp(source.SourceError, 'file is 10000 bytes, expected at least'):
+            self.check_packets(src)
+
+    def test_head_cache(self):
+        self.write_data(AUDIO_DATA)
+        cache = headcache.HeadCache(os.path.join(self.disc_dir, 'cache'), FILE_BYTES)
+        player = DummyPlayer(self.disc_dir, self.cfg, cache)
+
+        # First play populates the cache with the start of both tracks
+        src = source.PCMDiscSource(player, create_disc(), False)
+        self.assertEqual(self.check_packets(src), 20)
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(cache.total_bytes, 2 * model.PCM.rate * model.PCM.bytes_per_frame)
+
+        # Next play starts from the cache and switches over to the file
+        src = source.PCMDiscSource(player, create_disc(), False)
+        self.assertEqual(self.check_packets(src), 20)
+        self.assertIsNone(src.file_opener)
+        self.assertIsNotNone(src.audio_file)
+
+    def test_head_cache_missing_file(self):
+        cache = headcache.HeadCache(os.path.join(self.disc_dir, 'cache'), FILE_BYTES)
+        cache.store('0123456789abcdef0123456789abcdef01234567', 0,
+                    AUDIO_DATA[:model.PCM.rate * model.PCM.bytes_per_frame])
+
+        src = source.PCMDiscSource(DummyPlayer(self.disc_dir, self.cfg, cache), create_disc(), False)
+        with self.assertRaises(source.SourceError):
+            self.check_packets(src)
+
+
+class TestSilence(unittest.TestCase):
+    def test_reuse_buffers(self):
+        s1 = source.get_silence(100)
+        self.assertEqual(s1, '\0' * 100)
+        self.assertIs(source.get_silence(100), s1)
+        self.assertEqual(len(source.get_silence(200)), 200)
+
+    def test_shared_silent_packets(self):
+        disc_dir = tempfile.mkdtemp()
+        try:
+            src = source.PCMDiscSource(DummyPlayer(disc_dir, DummyConfig()), create_disc(), False)
+            packets = [p for p in audio.AudioPacket.iterate(src.disc, 0, 5)
+                       if p.file_pos is None]
+            self.assertEqual(len(packets), 2)
+
+            for p in packets:
+                src.read_data_into_packet(p)
+
+            self.assertIs(packets[0].data, packets[1].data)
+        finally:
+            shutil.rmtree(disc_dir)
+
+
+class TestFileGrowthWaiter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data.cdr')
+        self.waiter = fileio.FileGrowthWaiter(self.path)
+
+    def tearDown(self):
+        self.waiter.close()
+        shutil.rmtree(self.dir)
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertFalse(self.waiter.wait(0.1))
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_wake(self):
+        self.waiter.wake()
+        start = time.time()
+        self.assertFalse(self.waiter.wait(5))
+        self.assertLess(time.time() - start, 1)
+
+    def test_file_created(self):
+        if not self.waiter.using_inotify:
+            self.skipTest('inotify not available')
+
+        # Changes to other files should not count
+        with open(os.path.join(self.dir, 'rip_audio.log'), 'wt') as f:
+            f.write('foo')
+        self.assertFalse(self.waiter.wait(0.1))
+
+        with open(self.path, 'wb') as f:
+            f.write('bar')
+        self.assertTrue(self.waiter.wait(5))
+
+
+class TestFadvise(unittest.TestCase):
+    def test_fadvise(self):
+        with tempfile.TemporaryFile() as f:
+            f.write('\0' * 10000)
+            f.flush()
+
+            # Either works or isn't supported, but shouldn't fail
+            fileio.fadvise(f, 0, 10000, fileio.POSIX_FADV_WILLNEED)
+            fileio.fadvise(f.fileno(), 0, 10000, fileio.POSIX_FADV_DONTNEED)
@@ -0,0 +1,81 @@
+# codplayer - test the state subscriber
+#
+# Copyright 2015 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import threading
+import tempfile
+import shutil
+import Queue
+
+import zmq
+
+from .. import zerohub
+from .. import serialize
+from ..state import State, StateClient
+
+
+class TestStateClient(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.topic = zerohub.Topic(
+            player = 'ipc://{0}/state'.format(self.tmpdir))
+        self.rpc = zerohub.RPC('ipc://{0}/rpc'.format(self.tmpdir))
+        self.io_loop = zerohub.IOLoop()
+
+        # Fake player, serving the current state over RPC
+        self.player = zerohub.Receiver(
+            self.rpc, io_loop = self.io_loop,
+            state = lambda receiver, msg: [
+                'state', serialize.get_jsons(State(state = State.PLAY))],
+            source = lambda receiver, msg: [
+                'disc', serialize.get_jsons(None)])
+
+        self.pub = zerohub.get_context().socket(zmq.PUB)
+        self.pub.setsockopt(zmq.LINGER, 0)
+        self.pub.bind('ipc://{0}/state'.format(self.tmpdir))
+
+        self.clients = []
+        self.thread = threading.Thread(target = self.io_loop.start)
+        self.thread.start()
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.thread.join()
+        self.player._do_close()
+        self.pub.close()
+        self.io_loop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def client(self):
+        received = Queue.Queue()
+
+        # Create the client in the IO loop thread
+        def create():
+            self.clients.append(StateClient(
+                self.topic, io_loop = self.io_loop,
+                on_state = lambda state: received.put(('state', state.state)),
+                on_disc = lambda disc: received.put(('disc', disc)),
+                rpc_channel = self.rpc))
+
+        self.io_loop.add_callback(create)
+        return received
+
+
+    def test_fetch_on_connect(self):
+        first = self.client()
+        received = sorted([first.get(timeout = 5), first.get(timeout = 5)])
+        self.assertEqual(received, [('disc', None), ('state', State.PLAY)])
+
+        # Another client connecting doesn't send the state to the
+        # first one again
+        second = self.client()
+        received = sorted([second.get(timeout = 5), second.get(timeout = 5)])
+        self.assertEqual(received, [('disc', None), ('state', State.PLAY)])
+
+        self.assertRaises(Queue.Empty, first.get, timeout = 0.5)
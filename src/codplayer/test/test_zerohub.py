@@ -0,0 +1,124 @@
+# codplayer - test the message hub
+#
+# Copyright 2015 Peter Liljenberg <peter.liljenberg@gmail.com>
+#
+# Distributed under an MIT license, please see LICENSE in the top dir.
+
+import unittest
+import threading
+import time
+import tempfile
+import shutil
+
+import zmq
+
+from .. import zerohub
+
+
+class TestRPC(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = zerohub.IOLoop()
+        self.rpc = zerohub.RPC('inproc://test-rpc-{0}'.format(id(self)))
+        self.pending = []
+
+        self.receiver = zerohub.Receiver(
+            self.rpc, io_loop = self.io_loop,
+            fast = lambda receiver, msg: ['fast', msg[1]],
+            slow = self.on_slow)
+
+        self.thread = threading.Thread(target = self.io_loop.start)
+        self.thread.start()
+
+    def tearDown(self):
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.thread.join()
+        self.receiver._do_close()
+        self.io_loop.close()
+
+    def on_slow(self, receiver, msg):
+        reply = zerohub.AsyncReply()
+        self.pending.append((reply, msg[1]))
+        return reply
+
+    def client(self):
+        socket = zerohub.get_context().socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.RCVTIMEO, 5000)
+        socket.connect(self.rpc._address)
+        self.addCleanup(socket.close)
+        return socket
+
+
+    def test_sync_reply(self):
+        client = self.client()
+        client.send_multipart(['fast', 'a'])
+        self.assertEqual(client.recv_multipart(), ['fast', 'a'])
+
+
+    def test_async_reply_does_not_block(self):
+        slow_client = self.client()
+        slow_client.send_multipart(['slow', 'a'])
+
+        # Other requests are handled while the slow one is pending
+        fast_client = self.client()
+        fast_client.send_multipart(['fast', 'b'])
+        self.assertEqual(fast_client.recv_multipart(), ['fast', 'b'])
+
+        for i in range(100):
+            if self.pending:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(len(self.pending), 1)
+        reply, arg = self.pending[0]
+
+        # Reply from another thread
+        t = threading.Thread(target = reply.send, args = (('slow', arg), ))
+        t.start()
+        t.join()
+
+        self.assertEqual(slow_client.recv_multipart(), ['slow', 'a'])
+
+
+class TestReceiverConnect(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.address = 'ipc://{0}/topic'.format(self.tmpdir)
+        self.io_loop = zerohub.IOLoop()
+        self.connected = threading.Event()
+
+        self.receiver = zerohub.Receiver(
+            zerohub.Topic(player = self.address), io_loop = self.io_loop,
+            callbacks = { 'state': lambda receiver, msg: None },
+            on_connect = lambda receiver: self.connected.set())
+
+        self.thread = threading.Thread(target = self.io_loop.start)
+        self.thread.start()
+
+    def tearDown(self):
+        self.io_loop.add_callback(self.io_loop.stop)
+        self.thread.join()
+        self.receiver._do_close()
+        self.io_loop.close()
+        shutil.rmtree(self.tmpdir)
+
+    def publisher(self):
+        socket = zerohub.get_context().socket(zmq.PUB)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.bind(self.address)
+        return socket
+
+
+    def test_on_connect_after_restart(self):
+        # The subscriber starts before the publisher
+        pub = self.publisher()
+        self.assertTrue(self.connected.wait(5))
+
+        # And reconnects when it is restarted
+        self.connected.clear()
+        pub.close()
+        pub = self.publisher()
+        self.addCleanup(pub.close)
+        self.assertTrue(self.connected.wait(5))
@@ -20,7 +20,10 @@ Tornado) IOLoop class, and zerohub.IOLoop().instance() to get the
 default instance.
 """
 
+import threading
+
 import zmq
+import zmq.utils.monitor
 from zmq.eventloop.zmqstream import ZMQStream
 
 # Provide the ZeroMQ mini-version of the Tornado ioloop
@@ -44,11 +47,15 @@ class Channel(object):
     defined as subclasses.
     """
 
-    def get_receiver_stream(self, subscriptions, io_loop = None):
+    def get_receiver_stream(self, subscriptions, io_loop = None,
+                            before_connect = None):
         """Return a ZMQStream for receiving messages from this channel.
 
         subscriptions is an iterable of event names that the stream
         should subscribe to (if applicable).
+
+        If before_connect is provided, it is called with the socket
+        before it is connected or bound, e.g. to set up a monitor.
         """
         raise NotImplementedError()
 
@@ -93,12 +100,16 @@ class Topic(Channel):
                        in self._pub_addresses.iteritems()]))
 
 
-    def get_receiver_stream(self, subscriptions, io_loop = None):
+    def get_receiver_stream(self, subscriptions, io_loop = None,
+                            before_connect = None):
         """Return a SUB socket stream.
         """
         socket = get_context().socket(zmq.SUB)
         socket.set_hwm(10)
 
+        if before_connect:
+            before_connect(socket)
+
         for address in self._pub_addresses.itervalues():
             socket.connect(address)
 
@@ -154,10 +165,14 @@ class RPC(Channel):
         return '<RPC {0} on {1}>'.format(self.name or id(self), self._address)
 
 
-    def get_receiver_stream(self, subscriptions, io_loop = None):
-        """Return a REP socket stream.
+    def get_receiver_stream(self, subscriptions, io_loop = None,
+                            before_connect = None):
+        """Return a ROUTER socket stream, so replies can be sent in
+        any order.
         """
-        socket = get_context().socket(zmq.REP)
+        socket = get_context().socket(zmq.ROUTER)
+        if before_connect:
+            before_connect(socket)
         socket.bind(self._address)
         return ZMQStream(socket, io_loop)
 
@@ -172,14 +187,68 @@ class RPC(Channel):
 
 
     def dispatch_message(self, stream, callbacks, fallback, receiver, msg_parts):
-        """Send messages to all the callbacks matching a prefix of the message name.
+        """Send the request to the callback matching the message name,
+        and the reply back to the client.
         """
-        func = callbacks.get(msg_parts[0], fallback)
-        reply = func(receiver, msg_parts) if func else None
+        # Split off the routing envelope, which ends with an empty part
+        try:
+            i = msg_parts.index('')
+        except ValueError:
+            return
+
+        envelope = msg_parts[:i + 1]
+        request = msg_parts[i + 1:]
+        if not request:
+            return
+
+        func = callbacks.get(request[0], fallback)
+        reply = func(receiver, request) if func else None
+
+        if isinstance(reply, AsyncReply):
+            reply.bind(stream, envelope, receiver.io_loop)
+            return
 
         if reply is None:
             reply = ['']
-        stream.send_multipart(reply)
+        stream.send_multipart(envelope + list(reply))
+
+
+class AsyncReply(object):
+    """RPC callbacks can return an AsyncReply instead of the reply
+    message parts, and later call send() with the reply, e.g. when a
+    worker thread has finished.  Other requests are handled in the
+    meantime.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._target = None
+        self._reply = None
+
+    def send(self, reply):
+        """Send the list of REPLY message parts.  May be called from
+        any thread, but only once.
+        """
+        with self._lock:
+            self._reply = list(reply or [''])
+            target = self._target
+
+        if target:
+            self._send(target)
+
+    def bind(self, stream, envelope, io_loop):
+        """Called by the channel with where to send the reply."""
+        with self._lock:
+            self._target = (stream, envelope, io_loop)
+            ready = self._reply is not None
+
+        if ready:
+            self._send(self._target)
+
+    def _send(self, target):
+        stream, envelope, io_loop = target
+        reply = envelope + self._reply
+        io_loop.add_callback(lambda: stream.send_multipart(reply))
 
 
 
@@ -201,10 +270,13 @@ class Queue(Channel):
         return '<Queue {0} on {1}>'.format(self.name or id(self), self._address)
 
 
-    def get_receiver_stream(self, subscriptions, io_loop = None):
+    def get_receiver_stream(self, subscriptions, io_loop = None,
+                            before_connect = None):
         """Return a PULL socket stream.
         """
         socket = get_context().socket(zmq.PULL)
+        if before_connect:
+            before_connect(socket)
         socket.bind(self._address)
         return ZMQStream(socket, io_loop)
 
@@ -229,7 +301,8 @@ class Receiver(object):
     """A message receiver for a channel."""
 
     def __init__(self, channel, name = None, io_loop = None,
-                 callbacks = {}, fallback = None, **kw_callbacks):
+                 callbacks = {}, fallback = None, on_connect = None,
+                 **kw_callbacks):
         """Create a message receiver for a channel, passing received messages
         to callback functions. The callbacks are called with two
         argument:
@@ -256,6 +329,12 @@ class Receiver(object):
 
         If no callback match and fallback is provided, it is called
         instead.
+
+        If on_connect is provided, it is called as on_connect(receiver)
+        each time the underlying socket has connected to a peer,
+        including reconnects after the peer has been restarted.  Topic
+        subscribers can use this to fetch the current state from the
+        publisher, since messages sent before the connection are lost.
         """
         self.io_loop = io_loop or IOLoop.instance()
         self.channel = channel
@@ -263,8 +342,11 @@ class Receiver(object):
         self._callbacks = kw_callbacks
         self._callbacks.update(callbacks)
         self._fallback = fallback
+        self._on_connect = on_connect
+        self._monitor_stream = None
         self._stream = channel.get_receiver_stream(
-            callbacks.iterkeys(), io_loop)
+            callbacks.iterkeys(), io_loop,
+            before_connect = self._setup_monitor if on_connect else None)
         self._stream.on_recv(self._on_message)
 
 
@@ -280,6 +362,11 @@ class Receiver(object):
 
 
     def _do_close(self):
+        if self._monitor_stream:
+            self._stream.socket.disable_monitor()
+            self._monitor_stream.close()
+            self._monitor_stream = None
+
         if self._stream:
             self._stream.close()
             self._stream = None
@@ -294,6 +381,19 @@ class Receiver(object):
             self._stream, self._callbacks, self._fallback, self, msg_parts)
 
 
+    def _setup_monitor(self, socket):
+        # Must be done before connecting, to not miss the first event
+        monitor = socket.get_monitor_socket(zmq.EVENT_CONNECTED)
+        self._monitor_stream = ZMQStream(monitor, self.io_loop)
+        self._monitor_stream.on_recv(self._on_monitor_event)
+
+
+    def _on_monitor_event(self, msg_parts):
+        event = zmq.utils.monitor.parse_monitor_message(msg_parts)
+        if event['event'] == zmq.EVENT_CONNECTED:
+            self._on_connect(self)
+
+
 class AsyncSender(object):
     """An asynchronous message sender to Topic and Queue channels.
     """
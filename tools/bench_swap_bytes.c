@@ -0,0 +1,120 @@
+/* Micro-benchmark of the byte swapping in c_alsa_sink.
+ *
+ * Build and run on the target (e.g. the Raspberry Pi):
+ *
+ *   gcc -O2 -I src/codplayer -o bench_swap_bytes tools/bench_swap_bytes.c
+ *   ./bench_swap_bytes [periods]
+ *
+ * Add -mfpu=neon on ARM boards that have it.  Each implementation
+ * copies and swaps one period of CD audio (4096 frames) at a time, as
+ * the sink does, and the time per period is printed.  The output of
+ * each implementation is checked against the original byte-by-byte
+ * loop.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "c_swap_bytes.h"
+
+#define PERIOD_BYTES (4096 * 4)
+
+/* Write into a ring of a few periods, like the sink buffer */
+#define RING_PERIODS 8
+
+
+typedef void (*swap_func_t)(unsigned char *dest, const unsigned char *src,
+                            size_t length);
+
+static void
+swap_bytewise(unsigned char *dest, const unsigned char *src, size_t length)
+{
+    swap_bytes_copy_bytewise(dest, 0, src, length);
+}
+
+static void
+swap_dispatch(unsigned char *dest, const unsigned char *src, size_t length)
+{
+    swap_bytes_copy(dest, 0, src, length);
+}
+
+static const struct {
+    const char *name;
+    swap_func_t func;
+} impls[] = {
+    { "bytewise (original)", swap_bytewise },
+    { "samples", swap_bytes_copy_samples },
+    { "words", swap_bytes_copy_words },
+#ifdef SWAP_BYTES_SSE2
+    { "sse2", swap_bytes_copy_sse2 },
+#endif
+#ifdef SWAP_BYTES_NEON
+    { "neon", swap_bytes_copy_neon },
+#endif
+    { "swap_bytes_copy (used by sink)", swap_dispatch },
+};
+
+
+static double
+now(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+
+int
+main(int argc, char **argv)
+{
+    int periods = argc > 1 ? atoi(argv[1]) : 20000;
+    unsigned char *src = malloc(PERIOD_BYTES * RING_PERIODS + 1);
+    unsigned char *ring = malloc(PERIOD_BYTES * RING_PERIODS);
+    unsigned char *expected = malloc(PERIOD_BYTES);
+    size_t i;
+    int n, p;
+
+    if (!src || !ring || !expected)
+    {
+        fprintf(stderr, "out of memory\n");
+        return 1;
+    }
+
+    for (i = 0; i < PERIOD_BYTES * RING_PERIODS + 1; i++)
+    {
+        src[i] = rand();
+    }
+
+    /* Use a source misaligned by one byte, as packet data may be */
+    swap_bytewise(expected, src + 1, PERIOD_BYTES);
+
+    for (n = 0; n < sizeof(impls) / sizeof(impls[0]); n++)
+    {
+        double start, secs;
+
+        memset(ring, 0, PERIOD_BYTES);
+        impls[n].func(ring, src + 1, PERIOD_BYTES);
+        if (memcmp(ring, expected, PERIOD_BYTES) != 0)
+        {
+            printf("%-32s WRONG OUTPUT\n", impls[n].name);
+            continue;
+        }
+
+        start = now();
+        for (p = 0; p < periods; p++)
+        {
+            int offset = (p % RING_PERIODS) * PERIOD_BYTES;
+            impls[n].func(ring + offset, src + offset + 1, PERIOD_BYTES);
+        }
+        secs = now() - start;
+
+        printf("%-32s %8.2f us/period %8.1f MB/s\n",
+               impls[n].name,
+               secs * 1e6 / periods,
+               (double) PERIOD_BYTES * periods / secs / 1e6);
+    }
+
+    return 0;
+}